@@ -0,0 +1,120 @@
+import os
+import json
+import math
+from ruamel.yaml import YAML
+from ruamel.yaml.scalarbool import ScalarBoolean
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Output backends for ini2yaml, e.g., parser(...,output='json')
+# Every backend holds the same content as the .yml (Metadata, globalVars, Trace, Include)
+#   * yaml: written by parser.write, references to globalVars and Metadata are anchors and aliases
+#   * json and msgpack (pip install msgpack): plain values, a value which yaml would write as an alias
+#     is written as {"$ref": path of its first occurrence}, a json pointer (e.g., "/globalVars/Trace/TA_1_1_1/minMax")
+#     json has no Inf or NaN, they are written as {"$float": "inf"}, {"$float": "-inf"} or {"$float": "nan"} so the file stays valid json
+# load(path) reads any backend and returns the same structure as loading the .yml (aliases resolved to shared objects)
+
+extensions = {'yaml':'.yml','json':'.json','msgpack':'.msgpack'}
+ref_key = '$ref'
+float_key = '$float'
+
+def check(output):
+    if output not in extensions:
+        raise ValueError(f'Unknown output: {output}, expected one of {list(extensions)}')
+    if output == 'msgpack' and msgpack is None:
+        raise ImportError('msgpack output requires msgpack (pip install msgpack)')
+
+def escape(key):
+    return(str(key).replace('~','~0').replace('/','~1'))
+
+def unescape(key):
+    return(key.replace('~1','/').replace('~0','~'))
+
+def plain(data,finite=False):
+    # Plain python values (ruamel types converted), values seen before are replaced by references
+    # As in ruamel's representer, lists, dicts and anchored scalars are aliased, other scalars never are
+    # If finite, Inf and NaN are replaced by {float_key:str(value)} (see resolve)
+    seen = {}
+    def walk(value,path):
+        if isinstance(value,(dict,list)) or getattr(getattr(value,'anchor',None),'value',None) is not None:
+            if id(value) in seen:
+                return({ref_key:seen[id(value)]})
+            seen[id(value)] = path
+        if isinstance(value,dict):
+            return({k:walk(v,f'{path}/{escape(k)}') for k,v in value.items()})
+        elif isinstance(value,list):
+            return([walk(v,f'{path}/{i}') for i,v in enumerate(value)])
+        elif type(value) is ScalarBoolean or type(value) is bool:
+            return(bool(value))
+        elif isinstance(value,int):
+            return(int(value))
+        elif isinstance(value,float):
+            value = float(value)
+            if finite and not math.isfinite(value):
+                return({float_key:str(value)})
+            return(value)
+        elif isinstance(value,str):
+            return(str(value))
+        return(value)
+    return(walk(data,''))
+
+def dumps(data,output):
+    # Serialize parser content (e.g., parser.config.__dict__ with translated keys) to str (json) or bytes (msgpack)
+    check(output)
+    if output == 'json':
+        return(json.dumps(plain(data,finite=True),separators=(',',':'),allow_nan=False))
+    elif output == 'msgpack':
+        return(msgpack.packb(plain(data)))
+    raise ValueError('yaml is written by parser.write')
+
+def pointer(root,path):
+    value = root
+    for part in path.split('/')[1:]:
+        part = unescape(part)
+        value = value[int(part)] if type(value) is list else value[part]
+    return(value)
+
+def resolve(data,lookup=None):
+    # Replace references by the value they point to, in place, so every alias of a value is the same object
+    # and non-finite floats written by plain(finite=True) by their value
+    # Values are resolved in document order, references always point to an earlier (already resolved) value
+    # lookup(path) finds the value of a reference, by default in data
+    if lookup is None:
+        lookup = lambda path:pointer(data,path)
+    def walk(value):
+        if type(value) is dict:
+            if len(value) == 1 and ref_key in value:
+                return(lookup(value[ref_key]))
+            if len(value) == 1 and float_key in value:
+                return(float(value[float_key]))
+            for k,v in value.items():
+                if type(v) in (dict,list):
+                    value[k] = walk(v)
+        elif type(value) is list:
+            for i,v in enumerate(value):
+                if type(v) in (dict,list):
+                    value[i] = walk(v)
+        return(value)
+    return(walk(data))
+
+def output_of(path):
+    extension = os.path.splitext(path)[-1]
+    for output,ext in extensions.items():
+        if ext == extension or (output == 'yaml' and extension == '.yaml'):
+            return(output)
+    raise ValueError(f'Unknown output for {path}')
+
+def load(path):
+    # Load the output of any backend, by extension
+    output = output_of(path)
+    check(output)
+    if output == 'yaml':
+        with open(path,encoding='utf-8') as f:
+            return(YAML(typ='safe').load(f))
+    elif output == 'json':
+        with open(path,encoding='utf-8') as f:
+            return(resolve(json.load(f)))
+    with open(path,'rb') as f:
+        return(resolve(msgpack.unpackb(f.read())))
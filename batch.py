@@ -0,0 +1,261 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from dataclasses import dataclass,field
+from concurrent.futures import ProcessPoolExecutor
+import ini2yaml
+import matlabValue
+import backends
+
+stages = ['firststage','secondstage']
+
+# One include cache per worker process, created by init_worker
+worker_cache = None
+
+def discover(root,siteList=None,stageList=stages):
+    # Find the (SiteID, stage) pairs which have an ini file under root
+    # If siteList is None, every sub-folder of root is treated as a candidate site
+    if siteList is None:
+        siteList = sorted(d for d in os.listdir(root) if os.path.isdir(os.path.join(root,d)))
+    jobs = []
+    for stage in stageList:
+        for SiteID in siteList:
+            if os.path.isfile(os.path.join(root,SiteID,f'{SiteID}_{stage}.ini')):
+                jobs.append((SiteID,stage))
+    return(jobs)
+
+def file_hash(fname):
+    if not os.path.isfile(fname):
+        return(None)
+    with open(fname,'rb') as f:
+        return(hashlib.sha1(f.read()).hexdigest())
+
+def converter_hash():
+    # Hash of every module which shapes the output
+    h = hashlib.sha1()
+    for module in [ini2yaml,matlabValue,backends]:
+        h.update(file_hash(module.__file__).encode())
+    return(h.hexdigest())
+
+@dataclass(kw_only=True)
+class conversionManifest:
+    # Content hashes of every converted ini, its (transitive) #include files and its output
+    # Used to skip conversions whose inputs and output are unchanged since the last run
+    # Paths are stored relative to root so the manifest survives moving the database
+    root: str
+    path: str = None
+    # relative ini path > {'inputs':{relative path:hash},'output':relative path,'outputs':{relative path:hash}}
+    # outputs holds the site .yml and the .yml of every include it (transitively) writes
+    files: dict = field(default_factory=dict)
+    # include dependency graph, relative path > {'hash':hash,'includes':[direct includes]}
+    graph: dict = field(default_factory=dict)
+    converter: str = None
+
+    def __post_init__(self):
+        if self.path is None:
+            self.path = os.path.join(self.root,'.ini2yaml_manifest.json')
+        # Hashes are computed at most once per run
+        self.hashes = {}
+        # Entries recorded during this run, their output hashes are taken when saving
+        self.recorded = set()
+        # Entries found current by their last is_current check, their output hashes are updated as well
+        self.confirmed = set()
+        converter = converter_hash()
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+            self.graph = saved.get('graph',{})
+            # Any change to the converter itself invalidates every output
+            if saved.get('converter') == converter:
+                self.files = saved.get('files',{})
+        self.converter = converter
+
+    def hash(self,rel):
+        if rel not in self.hashes:
+            self.hashes[rel] = file_hash(os.path.join(self.root,rel))
+        return(self.hashes[rel])
+
+    def includes_of(self,rel):
+        # Direct #include files of rel, only re-scanned when rel has changed
+        h = self.hash(rel)
+        node = self.graph.get(rel)
+        if node is None or node['hash'] != h:
+            includes = []
+            if h is not None:
+                with open(os.path.join(self.root,rel),encoding='utf-8') as f:
+                    tokens = ini2yaml.tokenize_ini(f.read())
+                includes = [t.text.split('#include')[-1].strip() for t in tokens if t.kind == 'include']
+            node = self.graph[rel] = {'hash':h,'includes':includes}
+        return(node['includes'])
+
+    def inputs(self,SiteID,stage):
+        # Hashes of the site ini and every file it includes, directly or transitively
+        rel = os.path.join(SiteID,f'{SiteID}_{stage}.ini')
+        inputs,pending = {},[rel]
+        while pending:
+            r = pending.pop()
+            if r not in inputs:
+                inputs[r] = self.hash(r)
+                pending += self.includes_of(r)
+        return(inputs)
+
+    def is_current(self,SiteID,stage,inputs,output='yaml'):
+        rel = os.path.join(SiteID,f'{SiteID}_{stage}.ini')
+        entry = self.files.get(rel)
+        current = (entry is not None and entry['inputs'] == inputs and 'outputs' in entry
+                   # Converted to another format
+                   and os.path.splitext(entry['output'])[-1] == backends.extensions[output]
+                   and all(self.hash(o) == h for o,h in entry['outputs'].items()))
+        if current:
+            self.confirmed.add(rel)
+        else:
+            self.confirmed.discard(rel)
+        return(current)
+
+    def forget_outputs(self):
+        # Conversions rewrite outputs shared with other files (e.g., an include .yml written by every stage),
+        # call after converting so the next is_current hashes them again instead of trusting a stale hash
+        for entry in self.files.values():
+            for o in entry.get('outputs',{}):
+                self.hashes.pop(o,None)
+
+    def record(self,SiteID,stage,inputs,outpath,include_outputs=[]):
+        rel = os.path.join(SiteID,f'{SiteID}_{stage}.ini')
+        output = os.path.relpath(outpath,self.root)
+        outputs = [output]+[os.path.relpath(o,self.root) for o in include_outputs]
+        self.files[rel] = {
+            'inputs':inputs,
+            'output':output,
+            'outputs':dict.fromkeys(outputs),
+        }
+        self.recorded.add(rel)
+
+    def output_paths(self,SiteID,stage):
+        # The site .yml and the include .yml files of a recorded conversion
+        entry = self.files[os.path.join(SiteID,f'{SiteID}_{stage}.ini')]
+        return([os.path.join(self.root,o) for o in entry['outputs']])
+
+    def dependents(self,rel):
+        # Site files which include rel, directly or transitively
+        return(sorted(f for f,entry in self.files.items() if rel in entry['inputs'] and f != rel))
+
+    def save(self):
+        # Hash outputs once the whole batch is done, include .yml files are shared by
+        # every stage and site that uses them so only their final content is current
+        # Only entries converted or found current in this run are updated, others (e.g., a stage
+        # which wasn't run) keep their hashes and are converted again if a shared output changed
+        outputs = {o for rel in self.recorded for o in self.files[rel]['outputs']}
+        for o in outputs:
+            self.hashes.pop(o,None)
+        for rel in self.recorded | self.confirmed:
+            entry = self.files.get(rel)
+            if entry is not None and outputs.intersection(entry.get('outputs',{})):
+                entry['outputs'] = {o:self.hash(o) for o in entry['outputs']}
+        self.recorded = set()
+        with open(self.path,'w') as f:
+            json.dump({'converter':self.converter,'files':self.files,'graph':self.graph},f,indent=1,sort_keys=True)
+
+def init_worker():
+    global worker_cache
+    worker_cache = ini2yaml.includeCache()
+
+def new_summary(SiteID,stage,status='ok'):
+    return({'SiteID':SiteID,'stage':stage,'status':status,'seconds':0.0,'outpath':None,'error':None,
+            'include_outputs':[],'include_hits':0,'include_misses':0,'diagnostics':[]})
+
+def convert(root,SiteID,stage,fields_on_the_fly=True,verbose=False,output='yaml',fail_soft=False):
+    # Convert one site/stage, return a summary rather than raising so one bad file doesn't stop the batch
+    # If fail_soft, items which can't be parsed are skipped and listed in the summary's diagnostics (see parser.diagnose)
+    if worker_cache is None:
+        init_worker()
+    summary = new_summary(SiteID,stage)
+    hits,misses = worker_cache.hits,worker_cache.misses
+    T1 = time.perf_counter()
+    try:
+        i2y = ini2yaml.parser(root=root,SiteID=SiteID,stage=stage,fields_on_the_fly=fields_on_the_fly,verbose=verbose,cache=worker_cache,output=output,
+                              fail_soft=fail_soft,diagnostics=summary['diagnostics'])
+        summary['outpath'] = i2y.outpath
+        summary['include_outputs'] = i2y.include_outputs
+    except Exception as e:
+        summary['status'] = 'error'
+        summary['error'] = f'{type(e).__name__}: {e}'
+    summary['seconds'] = time.perf_counter()-T1
+    summary['include_hits'] = worker_cache.hits-hits
+    summary['include_misses'] = worker_cache.misses-misses
+    return(summary)
+
+def convert_batch(root,siteList=None,stageList=stages,workers=None,fields_on_the_fly=True,verbose=False,incremental=False,manifest=None,output='yaml',
+                  fail_soft=False):
+    # Convert many sites across a pool of worker processes
+    # Stages are run one after another so shared includes (written to one .yml for all stages)
+    # always end up with the same content as a serial run
+    # If incremental, files whose ini, includes and output match the manifest are skipped
+    # Files converted with diagnostics (fail_soft) are not recorded, so they are converted (and reported) again by the next run
+    backends.check(output)
+    jobs = discover(root,siteList=siteList,stageList=stageList)
+    if incremental and manifest is None:
+        manifest = conversionManifest(root=root)
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers,initializer=init_worker) as pool:
+        for stage in stageList:
+            batch = []
+            for SiteID,s in jobs:
+                if s != stage:
+                    continue
+                inputs = manifest.inputs(SiteID,stage) if manifest is not None else None
+                if manifest is not None and manifest.is_current(SiteID,stage,inputs,output):
+                    summary = new_summary(SiteID,stage,status='skipped')
+                    summary['outpath'],*summary['include_outputs'] = manifest.output_paths(SiteID,stage)
+                    summaries.append(summary)
+                else:
+                    batch.append((SiteID,inputs,pool.submit(convert,root,SiteID,stage,fields_on_the_fly,verbose,output,fail_soft)))
+            for SiteID,inputs,future in batch:
+                summary = future.result()
+                if manifest is not None and summary['status'] == 'ok' and not summary['diagnostics']:
+                    manifest.record(SiteID,stage,inputs,summary['outpath'],summary['include_outputs'])
+                summaries.append(summary)
+            if manifest is not None and batch:
+                # Later stages may share include outputs which this stage rewrote
+                manifest.forget_outputs()
+    if manifest is not None:
+        manifest.save()
+    return(summaries)
+
+def write_report(path,summaries):
+    # Every failed file and skipped item of a batch, as json
+    report = {
+        'errors':[{k:s[k] for k in ['SiteID','stage','error']} for s in summaries if s['status'] == 'error'],
+        'diagnostics':[dict(SiteID=s['SiteID'],stage=s['stage'],**d) for s in summaries for d in s['diagnostics']],
+    }
+    with open(path,'w') as f:
+        json.dump(report,f,indent=1)
+    return(report)
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Convert a TraceAnalysis_ini folder to yaml in parallel')
+    args.add_argument('root',help='Path to the TraceAnalysis_ini folder')
+    args.add_argument('--sites',nargs='*',default=None,help='SiteIDs to convert (default: all sub-folders of root)')
+    args.add_argument('--stages',nargs='*',default=stages)
+    args.add_argument('--workers',type=int,default=None)
+    args.add_argument('--incremental',action='store_true',help='Skip files which are unchanged since the last run')
+    args.add_argument('--output',default='yaml',choices=list(backends.extensions),help='Output format')
+    args.add_argument('--fail-soft',action='store_true',help='Skip values, traces and includes which can not be parsed instead of failing the file')
+    args.add_argument('--report',default=None,help='Write the errors and skipped items to this json file')
+    args = args.parse_args()
+    T1 = time.perf_counter()
+    summaries = convert_batch(args.root,siteList=args.sites,stageList=args.stages,workers=args.workers,incremental=args.incremental,output=args.output,
+                              fail_soft=args.fail_soft)
+    for s in summaries:
+        print(f"{s['SiteID']:>8} {s['stage']:<12} {s['status']:<6} {s['seconds']:8.3f}s {s['error'] or ''}")
+        for d in s['diagnostics']:
+            print(f"{'':>8} {os.path.relpath(d['fname'],args.root)}, line {d['line']}: {d['action']}: {d['reason']}")
+    counts = {status:sum(s['status'] == status for s in summaries) for status in ['ok','skipped','error']}
+    print(f"Converted {counts['ok']}, skipped {counts['skipped']}, failed {counts['error']} in {time.perf_counter()-T1:.3f}s")
+    if args.fail_soft:
+        print(f"{sum(len(s['diagnostics']) for s in summaries)} items skipped")
+    if args.report is not None:
+        write_report(args.report,summaries)
+    sys.exit(int(counts['error'] > 0))
@@ -0,0 +1,179 @@
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import subprocess
+from datetime import datetime
+import ini2yaml
+import instrumentation
+
+# Benchmark suite for ini2yaml
+# generate() writes a synthetic TraceAnalysis_ini tree, run() times each phase of the parser on it across sizes
+# python benchmark.py --sizes 100 1000 10000 100000 --out results.json [--compare previous.json]
+
+phases = ['parse_metadata','parse_globals','parse_traces','parse_includes','write']
+
+metadata_by_stage = {
+    'firststage':["Site_name = 'Synthetic site'   % name","SiteID = '{SiteID}'",
+                  "Difference_GMT_to_local_time = 8 % hours","Timezone = -8"],
+    'secondstage':["Site_name = 'Synthetic site'","SiteID = '{SiteID}'","input_path = ''",
+                   "output_path = 'Clean/SecondStage'","high_level_path = '{{}}'","searchPath = 'auto'"],
+}
+
+def firststage_trace(name,rng,global_ref=False,datenum=0.3,matrix=0.1):
+    lines = [f"variableName = '{name}'","title = 'Synthetic trace'","units = 'degC'",
+             f"inputFileName = {{'{name}'}}","measurementType = 'met'","instrumentType = 'HMP155'"]
+    if global_ref:
+        lines.append(f'minMax = globalVars.Trace.{name}.minMax')
+    else:
+        lines.append(f'minMax = [{rng.randint(-100,0)} {rng.randint(1,100)}]')
+    if rng.random() < matrix:
+        lines.append('zeroPt = [1 2 3; 4 5 6]')
+    else:
+        lines.append('zeroPt = [-9999]')
+    if rng.random() < datenum:
+        lines.append('inputFileName_dates = [datenum(2019,1,1) datenum(2999,1,1)]')
+        lines.append("calibrationDates = [datenum('01-Jan-2020 24:00') datenum('2021-06-01')]")
+    lines.append("comment = 'synthetic % not a comment'")
+    return(lines)
+
+def secondstage_trace(name,rng,global_ref=False,evaluate_lines=3):
+    body = ';\n\t            '.join(f'{name} = {name}_{i}' for i in range(evaluate_lines))
+    lines = [f"variableName = '{name}'",f"Evaluate = '{body};'","title = 'Synthetic trace'","units = 'degC'"]
+    if global_ref:
+        lines.append(f'minMax = globalVars.Trace.{name}.minMax')
+    else:
+        lines.append(f'minMax = [{rng.randint(-100,0)} {rng.randint(1,100)}]')
+    return(lines)
+
+def trace_block(lines):
+    return('[Trace]\n'+''.join(f'\t{l}\n' for l in lines)+'[End]\n')
+
+def generate(root,traces,SiteID='SYN',stages=['firststage','secondstage'],includes=2,include_traces=50,
+             global_traces=0.1,evaluate_lines=3,datenum=0.3,matrix=0.1,seed=0):
+    # Write a synthetic site with the given number of traces per stage under root
+    #   * Metadata for the stage, 2-, 3- and 4-part globalVars (a fraction global_traces of traces reference the 4-part ones)
+    #   * includes shared include files (the fan-out) of include_traces traces each
+    #   * multi-line Evaluate blocks (secondstage), datenum values and matrix literals (firststage) in a fraction of traces
+    # The same seed always gives the same tree
+    rng = random.Random(seed)
+    os.makedirs(os.path.join(root,SiteID),exist_ok=True)
+    for stage in stages:
+        lines = [l.format(SiteID=SiteID) for l in metadata_by_stage[stage]]
+        lines += ['globalVars.flag = 1',"globalVars.Instrument.SonicType = 'CSAT3'","globalVars.Instrument.IRGA = 'LI7200'"]
+        names = [f'T_{i}_1_1' for i in range(traces)]
+        referenced = set(rng.sample(names,int(traces*global_traces)))
+        lines += [f'globalVars.Trace.{name}.minMax = [-40 50]' for name in names if name in referenced]
+        include_names = [f'{SiteID}_{stage}_include_{i}.ini' for i in range(includes)]
+        lines += [f'#include {fname}' for fname in include_names]
+        body = ['\n'.join(lines)+'\n']
+        for name in names:
+            if stage == 'firststage':
+                trace = firststage_trace(name,rng,global_ref=name in referenced,datenum=datenum,matrix=matrix)
+            else:
+                trace = secondstage_trace(name,rng,global_ref=name in referenced,evaluate_lines=evaluate_lines)
+            body.append(trace_block(trace))
+        with open(os.path.join(root,SiteID,f'{SiteID}_{stage}.ini'),'w',encoding='utf-8') as f:
+            f.write('\n'.join(body))
+        for i,fname in enumerate(include_names):
+            body = []
+            for j in range(include_traces):
+                name = f'I_{i}_{j}'
+                if stage == 'firststage':
+                    body.append(trace_block(firststage_trace(name,rng,datenum=datenum,matrix=matrix)))
+                else:
+                    body.append(trace_block(secondstage_trace(name,rng,evaluate_lines=evaluate_lines)))
+            with open(os.path.join(root,fname),'w',encoding='utf-8') as f:
+                f.write('\n'.join(body))
+    return(root)
+
+def time_conversion(root,SiteID,stage,output='yaml'):
+    # Returns {phase:seconds}, plus total and other (reading and tokenizing), and the counters of the conversion
+    # Includes are timed within parse_includes
+    instruments = instrumentation.instrumentation(per_trace=False)
+    with contextlib.redirect_stdout(io.StringIO()):
+        T1 = time.perf_counter()
+        ini2yaml.parser(root=root,SiteID=SiteID,stage=stage,fields_on_the_fly=True,verbose=False,instruments=instruments,output=output)
+        total = time.perf_counter()-T1
+    report = instruments.reports[-1]
+    timings = {phase:report['phases'].get(phase,0.0) for phase in phases}
+    timings['other'] = total-sum(timings.values())
+    timings['total'] = total
+    return(timings,instruments.summary()['counters'])
+
+def run(sizes,stages=['firststage','secondstage'],repeats=3,root=None,output='yaml',**kwargs):
+    # Time every phase for each size and stage, keeping the best of the repeats
+    results = []
+    for traces in sizes:
+        tree = tempfile.mkdtemp(prefix=f'ini2yaml_benchmark_{traces}_',dir=root)
+        try:
+            generate(tree,traces,stages=stages,**kwargs)
+            for stage in stages:
+                runs = [time_conversion(tree,'SYN',stage,output) for _ in range(repeats)]
+                best = {phase:min(r[0][phase] for r in runs) for phase in runs[0][0]}
+                results.append({'traces':traces,'stage':stage,'repeats':repeats,'seconds':best,
+                                'us_per_trace':1e6*best['total']/max(traces,1),'counters':runs[0][1]})
+                print(f"{traces:>8} {stage:<12} "+' '.join(f'{phase} {best[phase]:8.3f}s' for phase in phases+['total']))
+        finally:
+            shutil.rmtree(tree,ignore_errors=True)
+    return(results)
+
+def environment():
+    try:
+        commit = subprocess.run(['git','rev-parse','HEAD'],cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True,text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return({'created':datetime.now().isoformat(timespec='seconds'),'commit':commit,
+            'python':platform.python_version(),'platform':platform.platform(),'cpus':os.cpu_count()})
+
+def compare(previous,current,tolerance=0.2,floor=0.005):
+    # Phases which are more than tolerance (fractional) slower than in previous
+    # Phases faster than floor seconds in both runs are ignored, they are mostly noise
+    before = {(r['traces'],r['stage']):r['seconds'] for r in previous['results']}
+    regressions = []
+    for r in current['results']:
+        old = before.get((r['traces'],r['stage']))
+        if old is None:
+            continue
+        for phase,new in r['seconds'].items():
+            if phase in old and max(old[phase],new) >= floor and new > old[phase]*(1+tolerance):
+                regressions.append({'traces':r['traces'],'stage':r['stage'],'phase':phase,
+                                    'before':old[phase],'after':new})
+    return(regressions)
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Time each phase of ini2yaml on synthetic ini files')
+    args.add_argument('--sizes',nargs='*',type=int,default=[100,1000,10000,100000],help='Number of traces per file')
+    args.add_argument('--stages',nargs='*',default=['firststage','secondstage'])
+    args.add_argument('--repeats',type=int,default=3)
+    args.add_argument('--includes',type=int,default=2,help='Number of #include files per site (fan-out)')
+    args.add_argument('--include-traces',type=int,default=50)
+    args.add_argument('--evaluate-lines',type=int,default=3)
+    args.add_argument('--seed',type=int,default=0)
+    args.add_argument('--output',default='yaml',help='Output format (yaml, json or msgpack)')
+    args.add_argument('--out',default=None,help='Save the results as json')
+    args.add_argument('--compare',default=None,help='Results (json) of a previous run, exit 1 on regressions')
+    args.add_argument('--tolerance',type=float,default=0.2)
+    args = args.parse_args()
+    results = {'environment':environment(),
+               'parameters':{'includes':args.includes,'include_traces':args.include_traces,
+                             'evaluate_lines':args.evaluate_lines,'seed':args.seed,'output':args.output},
+               'results':run(args.sizes,stages=args.stages,repeats=args.repeats,output=args.output,includes=args.includes,
+                             include_traces=args.include_traces,evaluate_lines=args.evaluate_lines,seed=args.seed)}
+    if args.out is not None:
+        with open(args.out,'w') as f:
+            json.dump(results,f,indent=1)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f),results,tolerance=args.tolerance)
+        for r in regressions:
+            print(f"Regression: {r['traces']} traces {r['stage']} {r['phase']} {r['before']:.3f}s > {r['after']:.3f}s")
+        sys.exit(int(len(regressions) > 0))
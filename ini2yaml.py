@@ -1,19 +1,67 @@
 import re
+import io
 import os
-import sys
+import pickle
+import hashlib
+import time
 from ruamel.yaml import YAML
 from ruamel.yaml.comments import CommentedSeq
 from ruamel.yaml.scalarstring import PlainScalarString, LiteralScalarString
 from ruamel.yaml.scalarint import ScalarInt
 from ruamel.yaml.scalarfloat import ScalarFloat
 from ruamel.yaml.scalarbool import ScalarBoolean
-from datetime import datetime,timedelta
-from dateutil.parser import parse as dateparse
-from dataclasses import dataclass,field
-from helperFunctions import asdict_repr
+from ruamel.yaml.events import DocumentStartEvent,DocumentEndEvent,MappingStartEvent,MappingEndEvent
+from functools import lru_cache
+from contextlib import nullcontext
+from dataclasses import dataclass,field,MISSING
+import matlabValue
+import instrumentation
+import backends
 
 yaml = YAML()
 
+# Hardcoded custom translations of keys (and the anchors named after them) for now
+# Can give more nuanced approach later if it becomes necessary
+key_translations = {'Difference_GMT_to_local_time':'Diff_GMT_to_local_time'}
+
+# Errors raised for bad input values (matlabValueError is a ValueError), skipped in fail_soft mode
+input_errors = (ValueError,TypeError)
+
+def translate_key(key):
+    for k,v in key_translations.items():
+        key = key.replace(k,v)
+    return(key)
+
+def translate_keys(data):
+    # Translate the keys of (nested) plain dicts
+    if type(data) is dict:
+        return({translate_key(k):translate_keys(v) for k,v in data.items()})
+    return(data)
+
+# Dotted names in a value, which may be references to globalVars or Metadata
+symbol_pattern = re.compile(r'[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*')
+
+# Shortest value (as text) worth replacing by an alias when deduplicating traces (see parser.dedup_traces)
+dedup_min_length = 16
+
+def anchor_of(value):
+    # Anchor name of a ruamel value, None if it has none (or can't have one)
+    return(getattr(getattr(value,'anchor',None),'value',None))
+
+def dedup_key(value):
+    # Values which are written identically have the same key, lists and CommentedSeq are written alike
+    if isinstance(value,list):
+        return(('list',tuple(dedup_key(v) for v in value)))
+    return((type(value).__name__,repr(value)))
+
+def scalar_float(value):
+    # ScalarFloat needs its formatting attributes (width, precision, ...) to be dumped
+    # so let ruamel's round trip loader build it from the shortest repr of the value
+    value = float(value)
+    if value != value or value in (float('inf'),float('-inf')):
+        return(ScalarFloat(value))
+    return(yaml.load(repr(value)))
+
 def ruamel_type_map(vtype):
     if vtype is type(PlainScalarString('')) or vtype is type(type(LiteralScalarString(''))):
         return(str)
@@ -47,10 +95,76 @@ class iniFile:
             with open(self.ini_path) as f:
                 self.ini_string = f.read()
 
+@dataclass(kw_only=True)
+class iniToken:
+    # A typed event produced by a single pass over an ini file
+    # kind is one of: trace, metadata, globalVars, include, comment, other
+    # start/end are character offsets into the source string (full [Trace]...[End] span for trace blocks)
+    # text is the block body for traces, or the raw line otherwise
+    kind: str
+    text: str
+    start: int
+    end: int
+    line: int
+
+trace_block_pattern = re.compile(r"\[Trace\](.*?)\[End\]", flags=re.DOTALL)
+
+def tokenize_ini(ini_string):
+    # Walk the file once, trace blocks are located with a single regex scan
+    # and the text between them is classified line by line
+    pos,line = 0,1
+    for m in trace_block_pattern.finditer(ini_string):
+        yield from tokenize_lines(ini_string,pos,m.start(),line)
+        line += ini_string.count('\n',pos,m.start())
+        yield iniToken(kind='trace',text=m.group(1),start=m.start(),end=m.end(),line=line)
+        line += ini_string.count('\n',m.start(),m.end())
+        pos = m.end()
+    yield from tokenize_lines(ini_string,pos,len(ini_string),line)
+
+def tokenize_lines(ini_string,start,stop,line):
+    # Classify each non-blank line in ini_string[start:stop]
+    i = start
+    while i < stop:
+        j = ini_string.find('\n',i,stop)
+        if j < 0:
+            j = stop
+        l = ini_string[i:j]
+        stripped = l.strip()
+        if stripped:
+            if l.startswith('globalVars'):
+                kind = 'globalVars'
+            elif l.startswith('#include'):
+                kind = 'include'
+            elif stripped.startswith('%') or stripped.startswith(';'):
+                kind = 'comment'
+            elif '=' in l and 'globalVars' not in l:
+                kind = 'metadata'
+            else:
+                kind = 'other'
+            yield iniToken(kind=kind,text=l,start=i,end=j,line=line)
+        i = j+1
+        line += 1
+
+
+# Quoted values may span lines (e.g., Evaluate), their linebreaks are hidden while the block is split into lines
+quoted_pattern = re.compile(r"'(.*?)'",flags=re.DOTALL)
+lb_key = '~linebreak~'
+
+def lb_replacer(match):
+    return(match[0].replace('\n',lb_key))
+
+def trace_fields(ini_string):
+    # Raw text of each key = value pair in the body of a trace block, commented lines are skipped
+    new_string = quoted_pattern.sub(lb_replacer,ini_string)
+    return({l.split('=',1)[0].strip():l.split('=',1)[-1].strip().replace(lb_key,'\n')
+            for l in new_string.split('\n')
+            if '=' in l and not l.strip().startswith('%') and not l.strip().startswith(';')})
+
 
 @dataclass(kw_only=True)
 class Trace:
     # The expected fields and their corresponding types for a trace object
+    # Only a declaration, traces are parsed into traceRecord objects using a traceSchema built from these fields
     # metadata field instructs behavior
     # Standard T/F (True for all parameter defined by default, False for non-standard parameters parsed from ini)
     # Stage controls which parameters are written:
@@ -81,131 +195,531 @@ class Trace:
     comment: list = field(default_factory=list, metadata={'standard':True,'optional':True,'stage':'firststage','literal':True})
     ECCC_station: str = field(default='', metadata={'standard':True,'optional':True,'stage':'firststage','literal':False})
     inputFileName_dates: list = field(default_factory=list, metadata={'standard':True,'optional':True,'stage':'firststage','literal':False})
-    
-    # Hidden (parameters to control behaviour which will not be written)
-    # by default, repr should be true, but when setting globals trace-by-trace, will set to false
-    repr: bool = field(default=True,repr=False,metadata={'standard':True,'optional':False,'stage':None,'literal':False})
-    stage: str = field(default='firststage',repr=False,metadata={'standard':True,'optional':False,'stage':None,'literal':False})
-    fields_on_the_fly: bool = field(default=False,repr=False,metadata={'standard':True,'optional':False,'stage':None,'literal':False})
-    verbose: bool = field(default=False,repr=False,metadata={'standard':True,'optional':False,'stage':None,'literal':False})
-    # If file being parsed is an include,
-    # Use variable substitution for globalVariables instead of anchors (limited to within one-file)
-    include: bool = field(default=False,repr=False,metadata={'standard':True,'optional':False,'stage':None,'literal':False})
 
-    def __post_init__(self):
-        # Set repr to true if current stage or common field
-        # Set to default to false otherwise
-        # If provided, will set repr = True
-        for k,v in self.__dataclass_fields__.items():
-            if v.metadata['stage'] in [self.stage,'common'] and not v.metadata['optional']:
-                self.__dataclass_fields__[k].repr=True
-            else:
-                self.__dataclass_fields__[k].repr=False
-    
-    def new_field(self,name,vtype,literal=None):
-        metadata = {'standard':False,'stage':self.stage,'literal':literal,'optional':True}
+@dataclass(kw_only=True)
+class traceSchema:
+    # Field order, types, literal flags, defaults and default visibility of a trace
+    # Built once per stage from the Trace declaration (see for_stage)
+    # Each parse works on a copy, fields added on the fly extend the copy, never Trace or the per-stage schema
+    stage: str = None
+    order: list = field(default_factory=list)
+    types: dict = field(default_factory=dict)
+    literal: dict = field(default_factory=dict)
+    # Default values, lists are copied when written so traces never share them
+    defaults: dict = field(default_factory=dict)
+    # Fields written by default: current stage or common fields which are not optional
+    shown: frozenset = frozenset()
+    verbose: bool = False
+
+    _by_stage = {}
+
+    @classmethod
+    def for_stage(cls,stage):
+        if stage not in cls._by_stage:
+            schema = cls(stage=stage)
+            for k,v in Trace.__dataclass_fields__.items():
+                schema.order.append(k)
+                schema.types[k] = v.type
+                schema.literal[k] = v.metadata['literal']
+                schema.defaults[k] = v.default_factory() if v.default is MISSING else v.default
+            schema.shown = frozenset(k for k,v in Trace.__dataclass_fields__.items()
+                                     if v.metadata['stage'] in [stage,'common'] and not v.metadata['optional'])
+            cls._by_stage[stage] = schema
+        return(cls._by_stage[stage])
+
+    def copy(self,verbose=False):
+        return(traceSchema(stage=self.stage,order=list(self.order),types=dict(self.types),literal=dict(self.literal),
+                           defaults=dict(self.defaults),shown=self.shown,verbose=verbose))
+
+    def add_field(self,name,vtype,literal=None):
         if 'ruamel' in str(vtype):
             vtype = ruamel_type_map(vtype)
+        self.order.append(name)
+        self.types[name] = vtype
+        self.literal[name] = literal
         if vtype is str:
-            self.__dataclass_fields__[name] = field(default='',metadata=metadata,repr=True)
-            self.__dataclass_fields__[name].name = name
-            self.__dataclass_fields__[name].type = vtype
+            self.defaults[name] = ''
         elif vtype is list or vtype is set:
-            self.__dataclass_fields__[name] = field(default_factory=vtype,metadata=metadata,repr=True)
-            self.__dataclass_fields__[name].name = name
-            self.__dataclass_fields__[name].type = vtype
+            self.defaults[name] = vtype()
         else:
-            self.__dataclass_fields__[name] = field(default=None,metadata=metadata,repr=True)
-            self.__dataclass_fields__[name].name = name
-            self.__dataclass_fields__[name].type = vtype
+            self.defaults[name] = None
+        if self.verbose: print('Added: \n',name,vtype,literal)
+
+class traceRecord:
+    # A trace being parsed: only the values given in the ini are stored, everything else comes from the schema
+    # Visibility is tracked per trace, provided fields are added to the shown set
+    __slots__ = ('schema','values','shown','include','symbols','report')
+
+    def __init__(self,schema,include=False,symbols=None,report=None,**values):
+        self.schema = schema
+        self.values = values
+        self.shown = set(schema.shown)
+        # If file being parsed is an include,
+        # Use variable substitution for globalVariables instead of anchors (limited to within one-file)
+        self.include = include
+        # Symbol table (e.g., parser.symbols, a symbolTable) used to resolve globalVars and Metadata references
+        self.symbols = symbols
+        # instrumentation.fileReport of the file being parsed, if instrumented
+        self.report = report
+
+    def __getitem__(self,key):
+        return(self.values[key])
+
+    def asdict(self):
+        # Dump the shown fields, in schema order
+        values,defaults = self.values,self.schema.defaults
+        out = {}
+        for k in self.schema.order:
+            if k in self.shown:
+                if k in values:
+                    out[k] = values[k]
+                else:
+                    v = defaults[k]
+                    out[k] = list(v) if type(v) is list else v
+        return(out)
+
+    def value_error(self,key,text,e):
+        error = type(e)(e.name) if isinstance(e,matlabValue.undefinedReference) else type(e)()
+        error.args = (f'Error processing {key} = {text.strip()}: {e}',)
+        return(error)
 
-        if self.verbose: print('Added: \n',self.__dataclass_fields__[name])
+    def evaluate(self,key,text,symbols):
+        # Parse a MATLAB value, return the value and whether it is an existing metadata value
+        # Errors are raised as matlabValueError (with the key and text) for the caller to handle
+        if self.report is not None:
+            self.report.count('evaluate')
+        try:
+            return(matlabValue.evaluate(text,symbols=symbols,include=self.include),False)
+        except matlabValue.undefinedReference as e:
+            # A stupid incomplete hack to solve edge cases resulting from poor practice in globals
+            # e.g., a bare reference to a metadata value
+            bare = [(t[0],t[1]) for t in matlabValue.tokenize(text) if t[0] != 'newline' and t[1] != ';'] == [('name',e.name)]
+            if bare and symbols is not None and 'Metadata.'+e.name in symbols:
+                print('Warning, attempting fix for improperly defined global variable\n\nreplacing ',e.name,' with ','Metadata.'+e.name)
+                return(symbols['Metadata.'+e.name],True)
+            if isinstance(symbols,symbolTable):
+                e.args = (f'{e}{symbols.hint(e.name)}',)
+            raise self.value_error(key,text,e)
+        except matlabValue.matlabValueError as e:
+            raise self.value_error(key,text,e)
 
     def add_item(self,key=None,text=None,anchors=None):
-        Inf = float('inf')
-        NaN = float('NaN')
-        nan = float('NaN')
+        # anchors = [anchor name, symbol table] when the value defines a global/metadata anchor
+        # Otherwise references are resolved against the symbol table given by the parser (if any)
+        symbols = anchors[1] if anchors is not None else self.symbols
+        schema = self.schema
+        # Values are parsed at most once, the result is reused after type inference
+        parsed = False
         # if text.startswith("'") and (not text.startswith("'[") or 'Evaluate' in key):
         # Format strings, except in edge cases (e.g., inputFIleName, where they are provided as a list)
-        if key not in self.__dataclass_fields__:
+        if key not in schema.types:
+            if self.report is not None:
+                self.report.count('fields_added')
             if not text.startswith("'") and not text.startswith('"'):
                 text = text.split('%')[0]
             if 'Evaluate' in key:
-                self.new_field(name=key,vtype=str,literal=True)
+                schema.add_field(name=key,vtype=str,literal=True)
             elif text.startswith("'[") or text.startswith("{") or any([d in key.lower() for d in ['date','calibration']]):
-                self.new_field(name=key,vtype=list,literal=False)
+                schema.add_field(name=key,vtype=list,literal=False)
             elif text.startswith("'"):
-                self.new_field(name=key,vtype=str,literal=None)
-            elif type(eval(text)) is int:
-                self.new_field(name=key,vtype=int,literal=False)
-            elif type(eval(text)) is float:
-                self.new_field(name=key,vtype=int,literal=False)
+                schema.add_field(name=key,vtype=str,literal=None)
             else:
-                self.new_field(name=key,vtype=list,literal=False)
-        if (((key in self.__dataclass_fields__ and self.__dataclass_fields__[key].type is str) or text.startswith("'")) and
+                value,existing = self.evaluate(key,text,symbols)
+                parsed = True
+                if type(value) is int or type(value) is ScalarInt:
+                    schema.add_field(name=key,vtype=int,literal=False)
+                elif type(value) is float or type(value) is ScalarFloat:
+                    schema.add_field(name=key,vtype=float,literal=False)
+                else:
+                    schema.add_field(name=key,vtype=list,literal=False)
+        vtype = schema.types[key]
+        if ((vtype is str or text.startswith("'")) and
             (not text.startswith("'[") and not text.startswith("{")) or 'Evaluate' in key):
-            if self.__dataclass_fields__[key].metadata['literal']:
-                text = CleanedText(text=text,forPython=False,Literal=True).text
-                self.__dict__[key] = LiteralScalarString(text)
+            # Same as CleanedText(text=text,forPython=False,Literal=literal), without the object
+            literal = schema.literal[key]
+            if self.report is None:
+                text,_ = clean_text(text,False,literal)
+            else:
+                misses = clean_text.cache_info().misses
+                text,substitutions = clean_text(text,False,literal)
+                cached = clean_text.cache_info().misses == misses
+                self.report.count('CleanedText')
+                self.report.count('CleanedText_cached',int(cached))
+                self.report.count('regex_substitutions',0 if cached else substitutions)
+            if literal:
+                self.values[key] = LiteralScalarString(text)
             else:
-                text = CleanedText(text=text,forPython=False,Literal=self.__dataclass_fields__[key].metadata['literal']).text
-                self.__dict__[key] = PlainScalarString(text)
+                self.values[key] = PlainScalarString(text)
         else:#if not text.startswith("'") or (text.startswith("'[") and not 'Evaluate' in key):
-            text = CleanedText(text=text,forPython=True).text
-            if 'globalVars' in text:
-                refs = re.findall(r'(globalVars(\.\w+)+)',text)
-                for j in range(len(refs)):
-                    if not self.include:
-                        text = text.replace(refs[j][0],f"anchors[1]['{refs[j][0]}']")
-                    else:
-                        text = text.replace(refs[j][0],f"'${refs[j][0]}$'")
-            try:
-                text = eval(text)            
-            except:
-                # A stupid incomplete hack to solve edge cases resulting from poor practice in globals
-                #
-                md = [k for k in anchors[1].keys() if k.startswith('Metadata') and text in k]
-                if not len(md):
-                    print('Error processing ',key,' = ',text)
-                    print('Check global variable definitions')
-                    sys.exit()
-                else:
-                    print('Warning, attempting fix for improperly defined global variable\n\nreplacing ',text,' with ',md[0])
-                    print('\n\nType c to continue or exit() to quit')
-                    text = anchors[1][md[0]]
-                    anchors = None
-                    breakpoint()
-            if key not in self.__dataclass_fields__:
-                self.new_field(key,type(text))
-            
-            if type(text) is list and self.__dataclass_fields__[key].type is str:
-                try:
-                    text = ''.join(text)
-                except:
-                    breakpoint()
+            if not parsed:
+                value,existing = self.evaluate(key,text,symbols)
+            text = value
+            if existing:
+                # Already carries its own anchor
+                anchors = None
+
+            if type(text) is list and vtype is str:
+                if not all(isinstance(t,str) for t in text):
+                    raise matlabValue.matlabValueError(f'Error processing {key}: cannot join {text!r} into a string')
+                text = ''.join(text)
             if 'ruamel.yaml' in str(type(text)):
-                self.__dict__[key] = text
-            elif self.__dataclass_fields__[key].type is list:
+                self.values[key] = text
+            elif vtype is list:
                 if type(text) is not list:
                     text = [text]
-                self.__dict__[key] = CommentedSeq(text)
-            elif self.__dataclass_fields__[key].type is int:
-                self.__dict__[key] = ScalarInt(text)
-            elif self.__dataclass_fields__[key].type is float:
-                self.__dict__[key] = ScalarFloat(text)
-            elif self.__dataclass_fields__[key].type is bool:
-                self.__dict__[key] = ScalarBoolean(text)
-            elif self.__dataclass_fields__[key].type is str:
-                self.__dict__[key] = PlainScalarString(text)
+                self.values[key] = CommentedSeq(text)
+            elif vtype is int:
+                self.values[key] = ScalarInt(text)
+            elif vtype is float:
+                self.values[key] = scalar_float(text)
+            elif vtype is bool:
+                self.values[key] = ScalarBoolean(text)
+            elif vtype is str:
+                self.values[key] = PlainScalarString(text)
             else:
-                breakpoint()
-                sys.exit(f"Add {type(text)} for {key}")
+                raise TypeError(f"Add {type(text)} for {key}")
 
         if anchors is not None:
-            self.__dict__[key].yaml_set_anchor(anchors[0])
+            self.values[key].yaml_set_anchor(anchors[0])
 
-        self.__dataclass_fields__[key].repr = True
+        self.shown.add(key)
     
+class circularReference(matlabValue.matlabValueError):
+    def __init__(self,chain):
+        self.chain = chain
+        super().__init__('Circular reference: '+' -> '.join(chain))
+
+def references(text):
+    # Names referenced by a value, names in strings are not references unless the string is a quoted list (see matlabValue.valueParser.string)
+    try:
+        tokens = matlabValue.tokenize(text)
+    except matlabValue.matlabValueError:
+        # Reported when the value is evaluated
+        return([])
+    names = []
+    for kind,t,args,_ in tokens:
+        if kind == 'name':
+            names.append(t)
+        elif kind == 'call':
+            names += references(args)
+        elif kind == 'string' and t[1:-1].strip().startswith('['):
+            names += references(t[1:-1])
+    return(names)
+
+class symbolTable(dict):
+    # Metadata and globalVars values by name (e.g., Metadata.SiteID, globalVars.Trace.TA_1_1_1.minMax), for O(1) reference lookups
+    # (see matlabValue.valueParser.reference), and as a tree (tree['Metadata'], tree['globalVars']) in the layout they are written in
+    # Names are registered first (define) and evaluated in dependency order (resolve), so a value can reference a name defined later
+    # The last definition of a name is used, a name can't be both a value and a group of values (e.g., globalVars.a and globalVars.a.b)
+    # error(e,parts,text,token) is called for every definition which can't be evaluated, which is then left out (or raises)
+    def __init__(self,error,report=None):
+        super().__init__()
+        self.error = error
+        self.report = report
+        self.tree = {'Metadata':{},'globalVars':{}}
+        # name > (parts,text,token) of the definitions not evaluated yet, in file order
+        self.pending = {}
+        # group (name parts but the last) > traceRecord typing the values of the group
+        self.records = {}
+
+    def define(self,parts,text,token):
+        name = '.'.join(parts)
+        node = self.tree
+        try:
+            for i in range(len(parts)-1):
+                prefix = '.'.join(parts[:i+1])
+                if prefix in self or prefix in self.pending:
+                    raise matlabValue.matlabValueError(f'Can not define {name}, {prefix} is a value')
+                node = node.setdefault(parts[i],{})
+            if type(node.get(parts[-1])) is dict:
+                raise matlabValue.matlabValueError(f'Can not define {name}, it is a group of values')
+        except matlabValue.matlabValueError as e:
+            self.prune(parts)
+            self.error(e,parts,text,token)
+            return
+        # Written in the order first defined
+        node.setdefault(parts[-1],None)
+        self.pop(name,None)
+        self.pending[name] = (parts,text,token)
+
+    def node(self,parts):
+        node = self.tree
+        for part in parts[:-1]:
+            node = node[part]
+        return(node)
+
+    def prune(self,parts):
+        # Remove a value and the groups it leaves empty, the sections are kept
+        nodes = [self.tree]
+        for part in parts[:-1]:
+            if type(nodes[-1].get(part)) is not dict:
+                return
+            nodes.append(nodes[-1][part])
+        if type(nodes[-1].get(parts[-1])) is not dict:
+            nodes[-1].pop(parts[-1],None)
+        for i in range(len(nodes)-1,1,-1):
+            if not nodes[i]:
+                del nodes[i-1][parts[i-1]]
+
+    def dependencies(self,text,pending):
+        # Pending names a value references, a bare name can be a metadata value (see traceRecord.evaluate)
+        deps = []
+        # Most values reference nothing, only tokenize those which may
+        if not any(n in pending or 'Metadata.'+n in pending for n in symbol_pattern.findall(text)):
+            return(deps)
+        for name in references(text):
+            if name in pending:
+                deps.append(name)
+            elif 'Metadata.'+name in pending:
+                deps.append('Metadata.'+name)
+        return(deps)
+
+    def resolve(self):
+        # Evaluate the pending definitions, each after the definitions it references
+        pending,self.pending = self.pending,{}
+        deps = {name:self.dependencies(text,pending) for name,(_,text,_) in pending.items()}
+        order,state,cycles = [],{},{}
+        def visit(name,path):
+            if name in state:
+                if state[name] == 'visiting':
+                    chain = path[path.index(name):]
+                    for i,n in enumerate(chain):
+                        cycles.setdefault(n,chain[i:]+chain[:i+1])
+                return
+            state[name] = 'visiting'
+            for dep in deps[name]:
+                visit(dep,path+[name])
+            state[name] = 'done'
+            order.append(name)
+        for name in pending:
+            visit(name,[])
+        # Circular references first, in file order
+        failed = set(cycles)
+        for name in pending:
+            if name in cycles:
+                parts,text,token = pending[name]
+                self.prune(parts)
+                self.error(circularReference(cycles[name]),parts,text,token)
+        for name in order:
+            if name in cycles:
+                continue
+            parts,text,token = pending[name]
+            try:
+                for dep in deps[name]:
+                    if dep in failed:
+                        raise matlabValue.matlabValueError(f'{dep} is referenced, but could not be evaluated')
+                self.evaluate(name,parts,text)
+            except input_errors as e:
+                failed.add(name)
+                self.prune(parts)
+                self.error(e,parts,text,token)
+
+    def evaluate(self,name,parts,text):
+        group = tuple(parts[:-1])
+        if group not in self.records:
+            self.records[group] = traceRecord(traceSchema.for_stage(None).copy(),report=self.report)
+        record = self.records[group]
+        record.add_item(key=parts[-1],text=text,anchors=[name.replace('.','__'),self])
+        self[name] = self.node(parts)[parts[-1]] = record[parts[-1]]
+
+    def hint(self,name):
+        # The names defined in the deepest group of name which exists, to explain an undefined reference
+        node,parts = self.tree,[]
+        for part in name.split('.')[:-1]:
+            if type(node.get(part)) is not dict:
+                break
+            node = node[part]
+            parts.append(part)
+        if not parts or not node:
+            return('')
+        keys = list(node)
+        return(f" ({'.'.join(parts)} defines {', '.join(keys[:10])}{', ...' if len(keys) > 10 else ''})")
+
+def dump_yaml(data,f):
+    # A dump which fails leaves the YAML instance unusable (its output is never torn down), so carry on with a new one
+    global yaml
+    try:
+        yaml.dump(data,f)
+    except Exception:
+        yaml = YAML()
+        raise
+
+def write_output(path,data):
+    # Output is text (yaml, json) or bytes (msgpack)
+    if type(data) is bytes:
+        with open(path,'wb') as f:
+            f.write(data)
+    else:
+        with open(path,'w+',encoding='utf-8') as f:
+            f.write(data)
+
+@dataclass(kw_only=True)
+class includeCache:
+    # Parsed #include files shared across sites and stages
+    # Entries are keyed by (resolved path, stage, output), the content hash and mtime of the include
+    # and of every file it includes (transitively) are stored in the entry and used to validate it:
+    # mtime/size first, then the content hash for files which were touched
+    # Held in memory for the life of a batch, optionally persisted to a sidecar pickle
+    sidecar: str = None
+    verbose: bool = False
+    hits: int = 0
+    misses: int = 0
+
+    def __post_init__(self):
+        self.entries = {}
+        if self.sidecar is not None and os.path.isfile(self.sidecar):
+            try:
+                with open(self.sidecar,'rb') as f:
+                    self.entries = pickle.load(f)
+            except Exception:
+                print('Ignoring unreadable include cache: ',self.sidecar)
+                self.entries = {}
+        # Parsed traces of each include by (resolved path, content hash), shared by the parses of every stage
+        # {start of the trace block:(values,fields provided,fields added)}, see parser.shared_trace, held in memory only
+        self.shared = {}
+
+    def key(self,fname,stage,output='yaml',dedup=False):
+        # Outputs written with dedup hold anchors and aliases, so they are cached apart from the others
+        return((os.path.realpath(fname),stage,output,dedup))
+
+    def shared_traces(self,fname,ini_string):
+        key = (os.path.realpath(fname),hashlib.sha1(ini_string.encode('utf-8')).hexdigest())
+        return(self.shared.setdefault(key,{}))
+
+    def signature(self,fname):
+        st = os.stat(fname)
+        return(st.st_mtime_ns,st.st_size)
+
+    def content_hash(self,fname):
+        with open(fname,'rb') as f:
+            return(hashlib.sha1(f.read()).hexdigest())
+
+    def is_valid(self,entry):
+        for path,(signature,h) in entry['deps'].items():
+            if not os.path.isfile(path):
+                return(False)
+            current = self.signature(path)
+            if current != signature:
+                # Touched but possibly unchanged, fall back to the content hash
+                if self.content_hash(path) != h:
+                    return(False)
+                entry['deps'][path] = (current,h)
+        return(True)
+
+    def restore(self,entry):
+        # Includes are written to one .yml regardless of stage, restore it if another stage (or user) overwrote it
+        if not os.path.isfile(entry['outpath']) or self.signature(entry['outpath']) != entry['out_signature']:
+            tmppath = f"{entry['outpath']}.{os.getpid()}.tmp"
+            write_output(tmppath,entry['yml'])
+            os.replace(tmppath,entry['outpath'])
+            entry['out_signature'] = self.signature(entry['outpath'])
+
+    def get(self,fname,stage,write=True,output='yaml',dedup=False):
+        # Return the cached entry for an include, or None if it must be (re)parsed
+        # If write, its .yml (and those of the includes it includes) are restored, entries
+        # whose .yml was never written (see parser.skip_writes) can then only be reparsed
+        entry = self.entries.get(self.key(fname,stage,output,dedup))
+        if entry is None or not self.is_valid(entry):
+            self.misses += 1
+            return(None)
+        nested = [self.entries.get(self.key(path,stage,output,dedup)) for path in entry['includes']]
+        nested = [n for n in nested if n is not None]
+        if write and any(e['yml'] is None for e in [entry]+nested):
+            self.misses += 1
+            return(None)
+        self.hits += 1
+        if self.verbose: print('include cache hit ',fname)
+        if write:
+            for e in [entry]+nested:
+                self.restore(e)
+        return(entry)
+
+    def put(self,fname,stage,include_parser):
+        path = os.path.realpath(fname)
+        deps = {}
+        for p in [path]+include_parser.include_paths:
+            if os.path.isfile(p):
+                deps[p] = (self.signature(p),self.content_hash(p))
+        entry = {
+            'deps':deps,
+            'includes':include_parser.include_paths,
+            'traces':include_parser.config.Trace,
+            'outpath':include_parser.outpath,
+            'outputs':[include_parser.outpath]+include_parser.include_outputs,
+            'yml':include_parser.yml_string,
+            'out_signature':None if include_parser.yml_string is None else self.signature(include_parser.outpath),
+        }
+        self.entries[self.key(fname,stage,include_parser.output,include_parser.dedup)] = entry
+        return(entry)
+
+    def save(self):
+        if self.sidecar is not None:
+            with open(self.sidecar,'wb') as f:
+                pickle.dump(self.entries,f)
+
+    def stats(self):
+        return({'hits':self.hits,'misses':self.misses,'entries':len(self.entries)})
+
+class yamlStream:
+    # Write a top level mapping entry by entry through ruamel's serializer, so nothing has to be held until the end
+    # Values anchored in an earlier entry are written as aliases in later ones
+    # The serializer only anchors a value when it sees it twice, which it can't know while streaming,
+    # so values referenced later must be marked with always_dump before their entry is written (see parser.stream_anchors)
+    # Entries opened with open_mapping are forgotten once written (see mark), which bounds memory to the anchored values
+    def __init__(self,f):
+        self.yaml = YAML()
+        self.serializer,self.representer,self.emitter = self.yaml.get_serializer_representer_emitter(f,None)
+        self.serializer.open()
+        self.serializer.emitter.emit(DocumentStartEvent(explicit=self.serializer.use_explicit_start,
+                                                        version=self.serializer.use_version,tags=self.serializer.use_tags))
+        self.start_mapping()
+        self.state = None
+
+    def start_mapping(self):
+        node = self.representer.represent_data({})
+        implicit = node.ctag == self.serializer.resolver.resolve(type(node),node.value,True)
+        self.serializer.emitter.emit(MappingStartEvent(None,node.ctag,implicit,flow_style=False))
+
+    def end_mapping(self):
+        self.serializer.emitter.emit(MappingEndEvent())
+
+    def serialize(self,data,index=None):
+        node = self.representer.represent_data(data)
+        self.serializer.anchor_node(node)
+        self.serializer.serialize_node(node,None,index)
+
+    def entry(self,key,value):
+        self.serialize(key)
+        self.serialize(value,key)
+
+    def open_mapping(self,key):
+        # Start a nested mapping whose entries are written (and forgotten) one at a time
+        self.serialize(key)
+        self.start_mapping()
+        self.mark()
+
+    def mark(self):
+        # Remember what has been written so far, everything written after is forgotten by release
+        self.state = (dict(self.representer.represented_objects),list(self.representer.object_keeper),
+                      dict(self.serializer.serialized_nodes),dict(self.serializer.anchors))
+
+    def release(self):
+        represented_objects,object_keeper,serialized_nodes,anchors = self.state
+        self.representer.represented_objects = dict(represented_objects)
+        self.representer.object_keeper = list(object_keeper)
+        self.serializer.serialized_nodes = dict(serialized_nodes)
+        self.serializer.anchors = dict(anchors)
+
+    def stream_entry(self,key,value):
+        self.entry(key,value)
+        self.release()
+
+    def close(self):
+        self.end_mapping()
+        self.serializer.emitter.emit(DocumentEndEvent(explicit=self.serializer.use_explicit_end))
+        self.serializer.close()
+        self.emitter.dispose()
+
 @dataclass(kw_only=True)
 class parser:
     root: str
@@ -218,157 +732,559 @@ class parser:
         'secondstage':['SiteID','Site_name','input_path','output_path','high_level_path','searchPath']
     })
     fields_on_the_fly: bool = False # If true, will allow non-standard fields which are not declared explicitly in Trace class
+    cache: includeCache = None # Optional, share parsed includes across parsers (e.g., for a batch of sites)
+    stream: bool = False # If true, site files are written while traces are parsed instead of after (see write_stream)
+    instruments: instrumentation.instrumentation = None # Optional, record timings and counters (see instrumentation.py), shared with includes
+    output: str = 'yaml' # yaml, json or msgpack (see backends.py), includes are written to the same format
+    dedup: bool = False # If true, values repeated across traces are written once, as an anchor and aliases (see dedup_traces)
+    skip_writes: set = None # Optional, resolved paths of outputs not to write, e.g., include .yml files a later stage rewrites (see siteParser)
+    fail_soft: bool = False # If true, values, traces and includes which can't be parsed are skipped and recorded in diagnostics
+    diagnostics: list = None # Optional, list to record skipped items in (shared with includes), see diagnose
 
     def __post_init__(self):
+        if self.diagnostics is None:
+            self.diagnostics = []
+        backends.check(self.output)
+        if self.stream and self.output != 'yaml':
+            raise ValueError('stream is only supported for yaml output')
+        if self.stream and self.dedup:
+            raise ValueError('dedup is not supported with stream, repeated values are only known once every trace is parsed')
         self.config = yml_base()
+        # Trace fields for this parse only
+        self.schema = traceSchema.for_stage(self.stage).copy(verbose=self.verbose)
         if self.SiteID is not None:
             fname = os.path.join(self.root,self.SiteID,f'{self.SiteID}_{self.stage}.ini')
         else:
             fname = os.path.join(self.root,self.include)
-        if os.path.isfile(fname):
-            with open(fname,encoding='utf-8') as f:
-                print('reading ',fname)
-                self.ini_string = f.read()
+        self.fname = fname
+        self.outpath = os.path.join(self.root,fname.replace('.ini',backends.extensions[self.output]))
+        if self.instruments is None:
+            self.report = None
+            self.convert()
+            return
+        self.report = self.instruments.open(fname,include=bool(self.include))
+        try:
+            self.convert()
+        except BaseException as e:
+            self.report.error = f'{type(e).__name__}: {e}'
+            raise
+        finally:
+            self.instruments.close(self.report)
+
+    def convert(self):
+        with self.timed('read'):
+            if os.path.isfile(self.fname):
+                with open(self.fname,encoding='utf-8') as f:
+                    if self.verbose: print('reading ',self.fname)
+                    self.ini_string = f.read()
+            else:
+                raise FileNotFoundError(f'Not a file: {self.fname}')
+        self.count('bytes_read',len(self.ini_string.encode('utf-8')))
+        self.shared_traces = None
+        if self.include and self.cache is not None:
+            self.shared_traces = self.cache.shared_traces(self.fname,self.ini_string)
+
+        # Tokenize once, the parse_* stages consume tokens by kind
+        with self.timed('tokenize'):
+            self.tokens = list(tokenize_ini(self.ini_string))
+        # Metadata and globals first, so traces can reference them
+        with self.timed('parse_metadata'):
+            self.parse_metadata()
+        with self.timed('parse_globals'):
+            self.parse_globals()
+        if self.stream and not self.include:
+            # Includes are always built in memory, they are returned to the including file and cached
+            # parse_traces (including writing each trace) and parse_includes are also timed within write_stream
+            with self.timed('write_stream'):
+                self.write_stream(self.outpath)
         else:
-            sys.exit('Not a file: '+fname)
-        
-        self.parse_traces()
-        self.parse_metadata()
-        self.parse_globals()
-        self.parse_includes()
-
-        if not self.include:
-            self.config.Include = list(self.config.Include.keys())
-            
-        outpath = os.path.join(self.root,fname.replace('.ini','.yml'))
-        self.write(outpath)
-      
-    def parse_traces(self):
+            with self.timed('parse_traces'):
+                self.parse_traces()
+            if self.dedup:
+                with self.timed('dedup'):
+                    self.dedup_traces()
+            with self.timed('parse_includes'):
+                self.parse_includes()
+
+            if not self.include:
+                self.config.Include = list(self.config.Include.keys())
+
+            if self.skip_writes and os.path.realpath(self.outpath) in self.skip_writes:
+                self.yml_string = None
+                return
+            with self.timed('write'):
+                self.write(self.outpath)
+        self.count('bytes_written',os.path.getsize(self.outpath))
+
+    def timed(self,phase):
+        # Time a phase, if instrumented
+        if self.report is None:
+            return(nullcontext())
+        return(self.report.phase(phase))
+
+    def count(self,name,n=1):
+        if self.report is not None:
+            self.report.count(name,n)
+
+    def tokens_of(self,kind):
+        return([t for t in self.tokens if t.kind == kind])
+
+    def located(self,e,token):
+        # Add the file and line to an error raised while parsing a token
+        e.args = (f'{self.fname}, line {token.line}: {e}',)
+        return(e)
+
+    def diagnose(self,e,line,trace=None,key=None,text=None,action='skipped value'):
+        # Record an item skipped in fail_soft mode, the conversion carries on without it
+        if self.verbose: print(f'{self.fname}, line {line}: {action}: {e}')
+        self.diagnostics.append({'fname':self.fname,'line':line,'trace':trace,'key':key,'text':text,
+                                 'reason':f'{type(e).__name__}: {e}','action':action})
+        self.count('diagnostics')
+
+    def key_line(self,token,key):
+        # Line of the (last, see trace_fields) assignment of a key in a trace token
+        lines = token.text.split('\n')
+        for i in range(len(lines)-1,-1,-1):
+            if lines[i].split('=',1)[0].strip() == key and '=' in lines[i]:
+                return(token.line+i)
+        return(token.line)
+
+    def parse_traces(self,emit=None):
         # Find trace blocks
-        pattern = r"\[Trace\](.*?)\[End\]"
-        matches = re.findall(pattern, self.ini_string, flags=re.DOTALL)
-        self.trace_blocks = []
-        for match in matches:
-            if self.include is None: overwrite = 0
-            else: overwrite = 1   
-            trace = Trace(Overwrite=overwrite,stage=self.stage,fields_on_the_fly=self.fields_on_the_fly,verbose=self.verbose,include=bool(overwrite))             
-            trace = self.from_trace_block(match,trace=trace)
-            
-            if trace.variableName != '':
-                # Custom function to dump dataclass to dict conditional upon each field.repr parameter
-                self.config.Trace[trace.variableName] = asdict_repr.asdict_repr(trace)
-            self.ini_string = self.ini_string.replace(f'[Trace]{match}[End]','')
-        self.ini_string = self.ini_string.strip()
-
-    def from_trace_block(self,ini_string,trace):
+        # If given, emit(variableName,trace) is called for each trace instead of storing it in self.config
+        for token in self.tokens_of('trace'):
+            trace = self.parse_trace(token)
+            if trace.values.get('variableName','') != '':
+                # Dump to dict conditional upon the fields shown for this trace
+                if emit is None:
+                    self.config.Trace[trace['variableName']] = trace.asdict()
+                else:
+                    emit(trace['variableName'],trace.asdict())
+
+    def parse_trace(self,token):
+        # Parse a single trace token into a traceRecord, metadata and globals must be parsed first
+        if self.include is None: overwrite = 0
+        else: overwrite = 1
+        trace = traceRecord(self.schema,include=bool(overwrite),symbols=self.symbols,report=self.report,Overwrite=overwrite)
+        per_trace = self.report is not None and self.instruments.per_trace
+        if per_trace:
+            before,T1 = dict(self.report.counters),time.perf_counter()
+        try:
+            if self.shared_traces is None:
+                trace = self.from_trace_block(token.text,trace=trace,token=token)
+            else:
+                trace = self.shared_trace(token,trace)
+        except input_errors as e:
+            raise self.located(e,token)
+        if per_trace:
+            self.report.add_trace(trace.values.get('variableName',''),token.line,time.perf_counter()-T1,before)
+        self.count('traces')
+        return(trace)
+
+    def shared_trace(self,token,trace):
+        # Include traces are parsed once per cache, parses of the same include for other stages reuse
+        # the values, the fields provided and the fields added on the fly (only the fields shown by default depend on the stage)
+        shared = self.shared_traces.get(token.start)
+        if shared is None:
+            n,diagnosed = len(self.schema.order),len(self.diagnostics)
+            trace.shown = set()
+            trace = self.from_trace_block(token.text,trace=trace,token=token)
+            added = [(k,self.schema.types[k],self.schema.literal[k]) for k in self.schema.order[n:]]
+            shared = (dict(trace.values),frozenset(trace.shown),added)
+            # Traces with skipped values are parsed again by every stage, so each reports its diagnostics
+            if len(self.diagnostics) == diagnosed:
+                self.shared_traces[token.start] = shared
+        else:
+            self.count('shared_traces')
+            for name,vtype,literal in shared[2]:
+                if name not in self.schema.types:
+                    self.schema.add_field(name=name,vtype=vtype,literal=literal)
+            trace.values = dict(shared[0])
+        trace.shown = set(self.schema.shown).union(shared[1])
+        return(trace)
+
+    def from_trace_block(self,ini_string,trace,token=None):
         # parse the trace from an ini file
-        # Define python versions of matlab keywords
-        lb_key = '~linebreak~'
-        new_string = ''
-        pattern = r"'(.*?)'"
-        def lb_replacer(match):
-            return(match[0].replace('\n',lb_key))
-        new_string = re.sub(pattern,lb_replacer,ini_string, flags=re.DOTALL)
-        key_val_pairs = {l.split('=',1)[0].strip():l.split('=',1)[-1].strip().replace(lb_key,'\n')
-                        for l in new_string.split('\n') 
-                        if '=' in l and not l.strip().startswith('%') and not l.strip().startswith(';')}
-        
+        key_val_pairs = trace_fields(ini_string)
+        if trace.report is not None:
+            trace.report.count('regex_substitutions')
         # Autodetect type, if it starts with single quote its a string literal, except when list (followed by a bracket) not starting evaluate
         for key,text in key_val_pairs.items():
-            trace.add_item(key=key,text=text)
+            try:
+                trace.add_item(key=key,text=text)
+            except input_errors as e:
+                if not self.fail_soft:
+                    raise
+                # A trace without a variableName is skipped by parse_traces
+                self.diagnose(e,self.key_line(token,key) if token is not None else None,
+                              trace=key_val_pairs.get('variableName','').strip('\'"'),key=key,text=text,
+                              action='skipped trace' if key == 'variableName' else 'skipped value')
         return(trace)
     
+    def dedup_traces(self):
+        # Anchor the first occurrence of each value repeated across traces (Trace__{variableName}__{key})
+        # and replace the others by that value, so they are written as aliases
+        # The traces of an include are also written under Include in the files including it, so their anchors
+        # are named by that path instead (Include__{include}__{variableName}__{key}) to stay unique in those files
+        # Anchor names only depend on the order of the traces, so unchanged files are written identically
+        # Scalars other than strings, values already anchored (globalVars, Metadata) and short values are left as they are
+        section = 'Trace' if not self.include else f"Include__{self.include.split('.')[0]}"
+        first = {}
+        for name,trace in self.config.Trace.items():
+            for key,value in trace.items():
+                if not isinstance(value,(str,list)) or len(str(value)) < dedup_min_length or anchor_of(value) is not None:
+                    continue
+                k = dedup_key(value)
+                if k not in first:
+                    first[k] = (name,trace,key)
+                    continue
+                first_name,first_trace,first_key = first[k]
+                shared = first_trace[first_key]
+                if anchor_of(shared) is None:
+                    # Anchor a copy, values may be shared with the parses of other stages (see shared_trace)
+                    # Plain lists and strings can't hold an anchor
+                    if isinstance(shared,list):
+                        shared = CommentedSeq(shared)
+                    elif type(shared) is str:
+                        shared = PlainScalarString(shared)
+                    else:
+                        shared = type(shared)(shared)
+                    shared.yaml_set_anchor(re.sub(r'\W','_',f'{section}__{first_name}__{first_key}'))
+                    first_trace[first_key] = shared
+                trace[key] = shared
+                self.count('deduplicated')
+
     def parse_metadata(self):
-        self.configAnchors = {}
-        mdLines = [l for l in self.ini_string.split('\n') 
-                    if '=' in l and len(l.strip()) and
-                    not l.strip().startswith('%') and
-                    not l.strip().startswith(';') and
-                    'globalVars' not in l]
-        metadata = {}
-        for l in mdLines:
-            metadata[l.split('=',1)[0].strip()] = l.split('=',1)[-1].strip() 
-            self.ini_string = self.ini_string.replace(l,'')
-        temp = Trace(stage=None,fields_on_the_fly=True)
-        for key,text in metadata.items():
-            text = text.split('%')[0].strip()
-            temp.add_item(key=key,text=text,anchors=[('Metadata.'+key).replace('.','__'),self.configAnchors])
-            self.configAnchors['Metadata.'+key] = temp.__dict__[key]
-            self.config.Metadata[key] = temp.__dict__[key]
+        # Metadata and globalVars share one symbol table, traces resolve their references against it
+        self.symbols = symbolTable(self.symbol_error,report=self.report)
+        for token in self.tokens_of('metadata'):
+            key,text = token.text.split('=',1)
+            self.symbols.define(['Metadata',key.strip()],text.strip().split('%')[0].strip(),token)
+        self.symbols.resolve()
+        self.config.Metadata = self.symbols.tree['Metadata']
+
+    def symbol_error(self,e,parts,text,token):
+        # A Metadata or globalVars definition which can't be evaluated (see symbolTable)
+        if not self.fail_soft:
+            raise self.located(e,token)
+        if parts[0] == 'Metadata':
+            self.diagnose(e,token.line,key=parts[-1],text=text,action='skipped metadata')
+        else:
+            self.diagnose(e,token.line,key='.'.join(parts),text=text,action='skipped global')
 
     def parse_includes(self):
         # Call self recursively to parse each include file
-        if '#include' in self.ini_string:
-            includes = [line for line in self.ini_string.splitlines() if line.startswith('#include')]
-            for include in includes:
-                fname = include.split('#include')[-1].strip()
-                self.config.Include[fname.split('.')[0]] = parser(root=self.root,include=fname,stage=self.stage,verbose=self.verbose).config.Trace
-                # Remove lines which have been processed
-                self.ini_string = self.ini_string.replace(include,' ')
+        # Resolved paths of every file included (directly or transitively) and the .yml written for each
+        self.include_paths = []
+        self.include_outputs = []
+        for token in self.tokens_of('include'):
+            fname = token.text.split('#include')[-1].strip()
+            try:
+                self.config.Include[fname.split('.')[0]] = self.parse_include(fname)
+            except (OSError,)+input_errors as e:
+                # Errors within an include are skipped by its own (fail_soft) parser, so this is a missing or unwritable file
+                if not self.fail_soft:
+                    raise
+                self.diagnose(e,token.line,key=fname,text=token.text,action='skipped include')
+
+    def parse_include(self,fname):
+        path = os.path.join(self.root,fname)
+        entry = None
+        if self.cache is not None and os.path.isfile(path):
+            outpath = os.path.realpath(os.path.join(self.root,path.replace('.ini',backends.extensions[self.output])))
+            entry = self.cache.get(path,self.stage,write=not self.skip_writes or outpath not in self.skip_writes,output=self.output,dedup=self.dedup)
+            self.count('include_cache_hits' if entry is not None else 'include_cache_misses')
+        if entry is None:
+            diagnosed = len(self.diagnostics)
+            include_parser = parser(root=self.root,include=fname,stage=self.stage,verbose=self.verbose,cache=self.cache,
+                                    instruments=self.instruments,output=self.output,dedup=self.dedup,skip_writes=self.skip_writes,
+                                    fail_soft=self.fail_soft,diagnostics=self.diagnostics)
+            self.include_paths += [os.path.realpath(path)]+include_parser.include_paths
+            self.include_outputs += [include_parser.outpath]+include_parser.include_outputs
+            # Includes with skipped items are not cached, so every parse using them reports their diagnostics
+            if self.cache is None or len(self.diagnostics) > diagnosed:
+                return(include_parser.config.Trace)
+            entry = self.cache.put(path,self.stage,include_parser)
+        else:
+            self.include_paths += [os.path.realpath(path)]+entry['includes']
+            self.include_outputs += entry['outputs']
+        return(entry['traces'])
 
     def parse_globals(self):
-        # extract globalVars
-        globalTemp = [l for l in self.ini_string.split('\n') if l.startswith('globalVars')]
-        # For tracking Trace objects
-        globalVars = {}
-        # For writing to self.config
-        globalDump = {}
-        name = None
-        for gVar in globalTemp:
-            self.ini_string = self.ini_string.replace(gVar,'')
-            gVar = [g.strip() for g in gVar.split('=',1)]
-            key = gVar[0].split('.')
-            text = gVar[-1]
-            if len(key) == 4:
-                if key[1] not in globalVars:
-                    globalVars[key[1]] = {}
-                    globalDump[key[1]] = {}
-                if key[2] not in globalVars[key[1]]:
-                    globalVars[key[1]][key[2]] = Trace(variableName=key[2],Overwrite=1,stage=None,fields_on_the_fly=True,repr=False)
-                    globalDump[key[1]][key[2]] = {}
-                globalVars[key[1]][key[2]].add_item(
-                    key=key[3],text=text,
-                    anchors=[gVar[0].replace('.','__'),self.configAnchors])
-                self.configAnchors[gVar[0]] = globalVars[key[1]][key[2]].__dict__[key[3]]
-                globalDump[key[1]][key[2]][key[3]] = globalVars[key[1]][key[2]].__dict__[key[3]]
-            elif len(key) == 3:
-                if key[1] not in globalVars:
-                    globalVars[key[1]] = Trace(variableName=key[1],Overwrite=1,stage=None,fields_on_the_fly=True,repr=False)
-                    globalDump[key[1]] = {}
-                globalVars[key[1]].add_item(
-                    key=key[2],text=text,
-                    anchors=[gVar[0].replace('.','__'),self.configAnchors])
-                self.configAnchors[gVar[0]] = globalVars[key[1]].__dict__[key[2]]
-                globalDump[key[1]][key[2]] = globalVars[key[1]].__dict__[key[2]]
-            elif len(key) == 2:
-                if key[1] not in globalVars:
-                    globalVars[key[1]] = Trace(variableName=key[1],Overwrite=1,stage=None,fields_on_the_fly=True,repr=False)
-                    globalVars[key[1]].add_item(
-                        key=key[1],text=text,
-                        anchors=[gVar[0].replace('.','__'),self.configAnchors])
-                    self.configAnchors[gVar[0]] = globalVars[key[1]].__dict__[key[1]]
-                    globalDump[key[1]] = globalVars[key[1]].__dict__[key[1]]
-        self.config.globalVars = globalDump
+        # globalVars.a, globalVars.a.b and globalVars.a.b.c (typically globalVars.Trace.variableName.field)
+        for token in self.tokens_of('globalVars'):
+            key,text = [g.strip() for g in token.text.split('=',1)] if '=' in token.text else (token.text.strip(),'')
+            parts = key.split('.')
+            if parts[0] == 'globalVars' and 2 <= len(parts) <= 4:
+                self.symbols.define(parts,text,token)
+        self.symbols.resolve()
+        self.config.globalVars = self.symbols.tree['globalVars']
 
     def write(self,outpath):
-        print('Writing ',outpath)
-        with open(outpath,'w+',encoding="utf-8") as f:
+        try:
+            self.write_file(outpath)
+        except Exception:
+            if not self.fail_soft or not self.drop_unwritable():
+                raise
+            self.write_file(outpath)
+
+    def drop_unwritable(self):
+        # Skip the traces which can't be written, return whether any were
+        lines = None
+        dropped = False
+        for name,trace in list(self.config.Trace.items()):
             try:
-                yaml.dump(self.config.__dict__,f)
-            except:
-                breakpoint()
-        self.cleanKeys(outpath)
+                if self.output == 'yaml':
+                    dump_yaml({name:trace},io.StringIO())
+                else:
+                    backends.dumps({name:trace},self.output)
+            except Exception as e:
+                if lines is None:
+                    lines = {trace_fields(t.text).get('variableName','').strip('\'"'):t.line for t in self.tokens_of('trace')}
+                self.diagnose(e,lines.get(name),trace=name,action='skipped trace')
+                del self.config.Trace[name]
+                dropped = True
+        return(dropped)
+
+    def write_file(self,outpath):
+        if self.verbose: print('Writing ',outpath)
+        # Write to a process-specific temporary file and move it into place
+        # so parallel conversions sharing an include never see a partial file
+        tmppath = f'{outpath}.{os.getpid()}.tmp'
+        if self.output != 'yaml':
+            # yml_string holds the output written, whatever the format, so includeCache can restore it
+            self.yml_string = backends.dumps(translate_keys(self.config.__dict__),self.output)
+            write_output(tmppath,self.yml_string)
+            os.replace(tmppath,outpath)
+            return
+        try:
+            with open(tmppath,'w+',encoding="utf-8") as f:
+                dump_yaml(self.config.__dict__,f)
+        except Exception:
+            # Never leave a partial file behind
+            os.remove(tmppath)
+            raise
+        self.yml_string = self.cleanKeys(tmppath)
+        os.replace(tmppath,outpath)
     
+    def stream_anchors(self):
+        # Anchors must be written with the first occurrence of a value when streaming
+        # so always dump the anchors of values which are referenced by any value in the file
+        # (names matching a metadata key are included for bare metadata references, see traceRecord.evaluate)
+        names = set()
+        for token in self.tokens:
+            if token.kind in ('trace','globalVars','metadata'):
+                for l in token.text.split('\n'):
+                    if '=' in l:
+                        names.update(symbol_pattern.findall(l.split('=',1)[-1]))
+        for name,value in self.symbols.items():
+            anchor = anchor_of(value)
+            if anchor is not None:
+                referenced = name in names or (name.startswith('Metadata.') and name.split('.',1)[-1] in names)
+                value.yaml_set_anchor(translate_key(anchor),always_dump=referenced)
+
+    def write_stream(self,outpath):
+        if self.verbose: print('Writing ',outpath)
+        # Traces are parsed and written one at a time, keys are translated before they are written
+        # so the file is written once and the parsed traces are never held together in memory
+        self.stream_anchors()
+        tmppath = f'{outpath}.{os.getpid()}.tmp'
+        try:
+            with open(tmppath,'w+',encoding="utf-8") as f:
+                writer = yamlStream(f)
+                writer.entry('Metadata',translate_keys(self.config.Metadata))
+                writer.entry('globalVars',translate_keys(self.config.globalVars))
+                writer.open_mapping('Trace')
+                with self.timed('parse_traces'):
+                    self.parse_traces(emit=lambda name,trace:writer.stream_entry(name,translate_keys(trace)))
+                writer.end_mapping()
+                with self.timed('parse_includes'):
+                    self.parse_includes()
+                self.config.Include = list(self.config.Include.keys())
+                writer.entry('Include',self.config.Include)
+                writer.close()
+        except BaseException:
+            # Never leave a partial file behind
+            if os.path.isfile(tmppath):
+                os.remove(tmppath)
+            raise
+        self.yml_string = None
+        os.replace(tmppath,outpath)
+
     def cleanKeys(self,outpath):
-        # Hardcoded custom translations for now
-        # Can give more nuanced approach later if it becomes necessary
-        patterns = {'Difference_GMT_to_local_time':'Diff_GMT_to_local_time'}
         with open(outpath) as f:
             ymlstring = f.read()
-        for k,v in patterns.items():
+        for k,v in key_translations.items():
             ymlstring = ymlstring.replace(k,v)
         with open(outpath,'w+') as f:
             f.write(ymlstring)
+        return(ymlstring)
+
+def include_outputs(root,rel,output='yaml'):
+    # Resolved paths of the output written for every file an ini (relative to root) includes, directly or transitively
+    outputs,pending,seen = set(),[rel],set()
+    while pending:
+        rel = pending.pop()
+        path = os.path.join(root,rel)
+        if rel in seen or not os.path.isfile(path):
+            continue
+        seen.add(rel)
+        with open(path,encoding='utf-8') as f:
+            includes = [t.text.split('#include')[-1].strip() for t in tokenize_ini(f.read()) if t.kind == 'include']
+        for fname in includes:
+            outpath = os.path.join(root,fname).replace('.ini',backends.extensions[output])
+            outputs.add(os.path.realpath(os.path.join(root,outpath)))
+        pending += includes
+    return(outputs)
+
+@dataclass(kw_only=True)
+class siteParser:
+    # Convert every stage of a site in one session, one .yml per stage
+    # The stages share one include cache, so an include used by several stages has its traces parsed once
+    # (see parser.shared_trace) and the per-stage schemas are built once per process (traceSchema.for_stage)
+    # An include's .yml is only written by the last stage using it, as every stage writes the same file
+    # Metadata and globalVars are not shared, each stage's ini defines its own
+    root: str
+    SiteID: str
+    stages: list = field(default_factory=lambda:['firststage','secondstage'])
+    verbose: bool = True
+    fields_on_the_fly: bool = False
+    cache: includeCache = None # Optional, e.g., to also share includes across sites
+    stream: bool = False
+    instruments: instrumentation.instrumentation = None
+    output: str = 'yaml'
+    fail_soft: bool = False # Items skipped by every stage are recorded in diagnostics
+
+    def __post_init__(self):
+        self.diagnostics = []
+        if self.cache is None:
+            self.cache = includeCache(verbose=self.verbose)
+        stages = []
+        for stage in self.stages:
+            if os.path.isfile(os.path.join(self.root,self.SiteID,f'{self.SiteID}_{stage}.ini')):
+                stages.append(stage)
+            elif self.verbose:
+                print(f'No {stage} ini for {self.SiteID}')
+        outputs = [self.include_outputs(stage) for stage in stages]
+        # stage > parser, in the order converted
+        self.parsers = {}
+        for i,stage in enumerate(stages):
+            self.parsers[stage] = parser(root=self.root,SiteID=self.SiteID,stage=stage,verbose=self.verbose,
+                                         fields_on_the_fly=self.fields_on_the_fly,cache=self.cache,
+                                         stream=self.stream,instruments=self.instruments,output=self.output,
+                                         skip_writes=set().union(*outputs[i+1:]),fail_soft=self.fail_soft,
+                                         diagnostics=self.diagnostics)
+
+    def include_outputs(self,stage):
+        return(include_outputs(self.root,os.path.join(self.SiteID,f'{self.SiteID}_{stage}.ini'),self.output))
+
+    def outpaths(self):
+        return({stage:p.outpath for stage,p in self.parsers.items()})
+
+# Precompiled patterns and replacers for CleanedText
+# Exclude comments, but preserve percent signs within strings
+comment_pattern = re.compile(r"(\"[^\"]*\"|'[^']*')|%(.*)")
+num2str_pattern = re.compile(r'\s*num2str\((.*?)\)\s*')
+datenum_pattern = re.compile(r'datenum\((.*?)\)')
+list_pattern = re.compile(r"\[(.*?)\]")
+ampersand_pattern = re.compile(r"'\s*&\s*'*")
+list_space_pattern = re.compile(r'(?<=[^,;])\s+(?=[^,])')
+quoted_list_patterns = [re.compile(r"'\[(.*?)\]'"),re.compile(r"'\[(.*?)\];'")]
+# Single pass character translations
+cell_to_list = str.maketrans('{}','[]')
+python_spacing = str.maketrans({'=':' = ','[':' [ ',']':' ] '})
+drop_quotes_and_tabs = str.maketrans('','',"'\t")
+drop_breaks_and_spaces = str.maketrans('','','\n ')
+
+def keep_quoted(match):
+    # Keep quoted strings, drop bare % comments
+    return(match.group(1) or '')
+
+def num2str_replacer(match):
+    return(f" str({match.group(1)}) ")
+
+def datenum_replacer(match):
+    # Replace all depreciated datenum objects with datetime object which is valid in both python and matlab
+    return(f'"{matlabValue.datenum_to_iso(match.group(1))}"')
+
+def list_replacer(match):
+    # matlab allows list to be delimited by spaces, python requires commas
+    # matlab dimensions are denoted by semicolons, python uses nested brackets
+    inner = ampersand_pattern.sub("'&'",match.group(1).strip())
+    inner = list_space_pattern.sub(' , ',inner).replace("'&'","' & '")
+    if inner.count(';'):
+        inner = [inn for inn in inner.split(';') if len(inn.strip())>0]
+        if len(inner)==1:
+            inner = inner[0]
+        else:
+            inner ='['+('],['.join(inner))+']'
+    return(f'[{inner}]')
+
+def unquote_list(match):
+    return(f'[{match.group(1)}]')
+
+def clean_for_string_formatting(text,Literal):
+    # Returns the cleaned text and the number of regex substitutions made
+    substitutions = 0
+    if not Literal:
+        if text != '%':
+            text = comment_pattern.sub(keep_quoted,text)
+            substitutions += 1
+        if Literal is not None and text != '':
+            # Literal defaults to None (for non-specified parameters)
+            # If Literal is None, spaces are preserve but comments are removed
+            text = text.translate(drop_breaks_and_spaces)
+    text = text.strip()
+    if text != "''":
+        text = text.replace("''",'"')
+    return(text.translate(drop_quotes_and_tabs),substitutions)
+
+def clean_for_python_parsing(text):
+    # Returns the cleaned text and the number of regex substitutions made
+    # Steps which can't change the text are skipped
+    text = comment_pattern.sub(keep_quoted,text)
+    substitutions = 1
+    if '\n' in text:
+        raise ValueError(f'Unexpected line break in value: {text!r}')
+    # Delete blank lines
+    text = text.strip()
+    if text.startswith(';'):
+        text = ''
+    # Convert cell array notation to list notation and ensure all lists are 1D
+    text = text.replace('{[','[').replace(']}',']').translate(cell_to_list)
+    # Replace functions names which are directly translatable to python
+    if 'num2str(' in text:
+        text = num2str_pattern.sub(num2str_replacer,text)
+        substitutions += 1
+    # Convert to standard pythonic dates
+    if 'datenum(' in text:
+        text = datenum_pattern.sub(datenum_replacer,text)
+        substitutions += 1
+    # Add commas to space delimited lists
+    if '[' in text:
+        text = list_pattern.sub(list_replacer,text)
+        substitutions += 1
+        # Get rid of quoted lists if they exist
+        if "'[" in text:
+            for pattern in quoted_list_patterns:
+                text = pattern.sub(unquote_list,text)
+                substitutions += 1
+    # Ensure all equal signs have space on each side
+    # Add spaces before/after brackets to make parsing simpler
+    text = text.translate(python_spacing)
+    # Except for start/end blocks
+    if 'End' in text or 'Trace' in text:
+        text = text.replace(' [ End ] ','[End]').replace(' [ Trace ] ','[Trace]')
+    # Strip extra spaces
+    return(text.strip(),substitutions)
+
+@lru_cache(maxsize=8192)
+def clean_text(text,forPython,Literal):
+    # The same values (e.g., [-9999], common minMax pairs or inputFileNames) repeat across traces, sites and stages
+    # so cleaned values are cached for the life of the process (e.g., a batch worker)
+    if forPython:
+        return(clean_for_python_parsing(text))
+    return(clean_for_string_formatting(text,Literal))
 
 @dataclass(kw_only=True)
 class CleanedText:
@@ -376,126 +1292,14 @@ class CleanedText:
     forPython: bool
     Literal: bool = False
     bp: bool = False
-    
+    # Number of regex substitutions made, 0 if the value was cached (for instrumentation)
+    substitutions: int = field(default=0,init=False,repr=False)
+    cached: bool = field(default=False,init=False,repr=False)
+
     def __post_init__(self):
-        if not self.forPython:
-            self.clean_for_string_formatting()
-        else:
-            self.clean_for_python_parsing()
-    
-    def clean_for_string_formatting(self):
-        if not self.Literal:
-            # Exclude comments, but preserve percent signs within strings
-            pattern = r"(\"[^\"]*\"|'[^']*')|%(.*)"
-            def replacer(match):
-                if match.group(1):  # quoted string
-                    return match.group(1)
-                else:               # bare %
-                    return ''
-            if self.text != '%':
-                self.text = re.sub(pattern, replacer, self.text)
-            if self.Literal is not None and self.text != '':
-                # Literal defaults to None (for non-specified parameters)
-                # If Literal is None, spaces are preserve but comments are removed
-                self.text = self.text.replace('\n','').replace(' ','')
-        
-        self.text = self.text.strip()
-        if self.text != "''":
-            self.text = self.text.replace("''",'"')
-        self.text = self.text.replace("'",'')
-        self.text = self.text.replace('\t','')
-
-
-    def clean_for_python_parsing(self):
         if self.bp: breakpoint()
-        # Exclude comments, but preserve percent signs within strings
-        pattern = r"(\"[^\"]*\"|'[^']*')|%(.*)"
-        def replacer(match):
-            if match.group(1):  # quoted string
-                return match.group(1)
-            else:               # bare %
-                return ''
-        self.text = re.sub(pattern, replacer, self.text)
-        # Delete blank lines
-        if '\n' in self.text:
-            breakpoint()
-        self.text = '\n'.join([l.strip() for l in self.text.split('\n') if len(l.strip()) and not l.strip().startswith(';')])
-        # Convert cell array notation to list notation and ensure all lists are 1D
-        self.text = self.text.replace('{[','[').replace(']}',']').replace('{','[').replace('}',']')
-        # Replace functions names which are directly translatable to python
-        self.text = self.replace_num2str(text=self.text)
-        # Convert to standard pythonic dates
-        self.text = self.replace_datenum(text=self.text) 
-        # Add commas to space delimited lists 
-        self.text = self.format_lists(text=self.text)    
-        # Ensure all equal signs have space on each side
-        self.text = self.text.replace('=',' = ')
-        # Add spaces before/after brackets to make parsing simpler
-        self.text = self.text.replace('[',' [ ').replace(']',' ] ')
-        # Except for start/end blocks
-        self.text = self.text.replace(' [ End ] ','[End]').replace(' [ Trace ] ','[Trace]')
-        # Strip extra spaces
-        self.text = self.text.strip()    
-
-    def replace_num2str(self,text):
-        # Exclude comments, but preserve percent signs within strings
-        pattern = r'\s*num2str\((.*?)\)\s*'
-        def replacer(match):
-            inner = match.group(1) 
-            return (f" str({inner}) ")
-        return(re.sub(pattern, replacer, text))
-
-    def replace_datenum(self,text):
-        # Replace all depreciated datenum objects with datetime object which is valid in both python and matlab
-        # write a wrapper to go from datetime to depreciated datenum in matlab
-        pattern = r'datenum\((.*?)\)'  # capture inside quotes
-        def get_date(m):
-            inner = m.group(1)
-            if 'now' in inner:
-                # Use of now is bad form, set to distant future
-                d = datetime(2100,12,31,23,59) 
-            elif inner.startswith('"') or inner.startswith("'"):
-                inner = inner.strip('"').strip("'")
-                if '24:00' in inner:
-                    inner = inner.replace('24:00','23:59')
-                    d = dateparse(inner)+timedelta(minutes=1)
-                else:
-                    d = dateparse(inner)
-            else:
-                inner = ','.join(str(int(i)) for i in inner.split(','))
-                d = eval('datetime('+inner+')')
-            # format datestring, ~_~ is a stand in for a space to be replaced after list formatting
-            d = d.strftime("%Y-%m-%dT%H:%M:%S")
-            return(f'"{d}"')
-        return(re.sub(pattern,get_date,text))
-        
-    def format_lists(self,text):
-        # need to format correctly for parsing to python
-        # matlab allows list to be delimited by spaces, python requires commas
-        # matlab dimensions are denoted by semicolons, python uses nested brackets
-        pattern = r"\[(.*?)\]"
-        def replace_spaces_and_semicolons(m):
-            inner = m.group(1)
-            inner = re.sub(r"'\s*&\s*'*","'&'",inner.strip())
-            inner = re.sub(r'(?<=[^,;])\s+(?=[^,])',' , ',inner).replace("'&'","' & '")
-            if inner.count(';'):
-                inner = [inn for inn in inner.split(';') if len(inn.strip())>0]
-                if len(inner)==1:
-                    inner = inner[0]
-                else:
-                    inner ='['+('],['.join(inner))+']'
-            return (f'[{inner}]')
-        fmtd = re.sub(pattern,replace_spaces_and_semicolons,text)
-        # Get rid of quoted lists if they exist
-        def replace_quotes(m):
-            return(f'[{m.group(1)}]')
-        pattern = r"'\[(.*?)\]'"
-        fmtd = re.sub(pattern,replace_quotes,fmtd)
-        pattern = r"'\[(.*?)\];'"
-        fmtd = re.sub(pattern,replace_quotes,fmtd)
-        # convert {[..]} to [..]
-        pattern = r"{\[(.*?)\]}"
-        def clip_brackets(m):
-            return('['+m.group(1)+']')
-        fmtd = re.sub(pattern,clip_brackets,fmtd)
-        return(fmtd)
+        misses = clean_text.cache_info().misses
+        self.text,substitutions = clean_text(self.text,self.forPython,self.Literal)
+        self.cached = clean_text.cache_info().misses == misses
+        if not self.cached:
+            self.substitutions = substitutions
@@ -0,0 +1,147 @@
+import io
+import json
+import time
+import pstats
+import logging
+import cProfile
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import dataclass,field,asdict
+
+# Optional instrumentation of ini2yaml conversions, e.g., parser(...,instruments=instrumentation(sinks=[jsonSink(path='report.json')]))
+# Each file converted (includes included) gets a fileReport with:
+#   * phases: wall time of each phase (read, tokenize, parse_metadata, parse_globals, parse_traces, parse_includes, write or write_stream)
+#   * counters: e.g., CleanedText calls, value evaluations, fields added on the fly, regex substitutions, bytes read/written
+#   * traces: time and counters of each trace (if per_trace)
+# When a file is done, its report (as a dict) is passed to every sink, any callable taking the dict can be a sink
+# A parser without instrumentation only pays for checking its report is None
+
+@dataclass(kw_only=True)
+class fileReport:
+    fname: str
+    include: bool = False
+    phases: dict = field(default_factory=dict)
+    counters: dict = field(default_factory=dict)
+    traces: list = field(default_factory=list)
+    seconds: float = None
+    error: str = None
+    # Captured around top level conversions only, if requested
+    profile: str = None
+    memory: dict = None
+
+    def count(self,name,n=1):
+        self.counters[name] = self.counters.get(name,0)+n
+
+    @contextmanager
+    def phase(self,name):
+        T1 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name,0.0)+time.perf_counter()-T1
+
+    def add_trace(self,variableName,line,seconds,before):
+        # before is a copy of the counters taken when the trace was started
+        counters = {k:v-before.get(k,0) for k,v in self.counters.items() if v != before.get(k,0)}
+        self.traces.append({'variableName':variableName,'line':line,'seconds':seconds,'counters':counters})
+
+@dataclass(kw_only=True)
+class instrumentation:
+    sinks: list = field(default_factory=list)
+    per_trace: bool = True
+    # None, 'cprofile' or 'tracemalloc'
+    profile: str = None
+    # Number of functions (cprofile) or lines (tracemalloc) kept in the report
+    profile_limit: int = 25
+
+    def __post_init__(self):
+        if self.profile not in [None,'cprofile','tracemalloc']:
+            raise ValueError(f'Unknown profile: {self.profile}')
+        self.reports = []
+        # Nesting of open reports, includes are opened while their parent is
+        self.depth = 0
+
+    def open(self,fname,include=False):
+        report = fileReport(fname=fname,include=include)
+        if self.depth == 0:
+            self.start_profile()
+        self.depth += 1
+        report.T1 = time.perf_counter()
+        return(report)
+
+    def close(self,report):
+        report.seconds = time.perf_counter()-report.T1
+        self.depth -= 1
+        if self.depth == 0:
+            self.stop_profile(report)
+        report = asdict(report)
+        self.reports.append(report)
+        for sink in self.sinks:
+            sink(report)
+        return(report)
+
+    def start_profile(self):
+        if self.profile == 'cprofile':
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+        elif self.profile == 'tracemalloc':
+            self.started_tracemalloc = not tracemalloc.is_tracing()
+            if self.started_tracemalloc:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+    def stop_profile(self,report):
+        if self.profile == 'cprofile':
+            self.profiler.disable()
+            out = io.StringIO()
+            pstats.Stats(self.profiler,stream=out).sort_stats('cumulative').print_stats(self.profile_limit)
+            report.profile = out.getvalue()
+            self.profiler = None
+        elif self.profile == 'tracemalloc':
+            current,peak = tracemalloc.get_traced_memory()
+            top = tracemalloc.take_snapshot().statistics('lineno')[:self.profile_limit]
+            report.memory = {'current':current,'peak':peak,'top':[str(s) for s in top]}
+            if self.started_tracemalloc:
+                tracemalloc.stop()
+
+    def summary(self):
+        # Phase times of top level files and counters of every file, summed
+        # (includes are timed within the parse_includes phase of the file including them)
+        phases,counters = {},{}
+        for report in self.reports:
+            for k,v in report['phases'].items():
+                if not report['include']:
+                    phases[k] = phases.get(k,0.0)+v
+            for k,v in report['counters'].items():
+                counters[k] = counters.get(k,0)+v
+        return({'files':len(self.reports),'phases':phases,'counters':counters})
+
+@dataclass(kw_only=True)
+class jsonSink:
+    # Write every report received so far to path, as a json list
+    path: str
+    indent: int = 1
+
+    def __post_init__(self):
+        self.reports = []
+
+    def __call__(self,report):
+        self.reports.append(report)
+        with open(self.path,'w') as f:
+            json.dump(self.reports,f,indent=self.indent)
+
+@dataclass(kw_only=True)
+class loggerSink:
+    # Log a one line summary of each report
+    logger: logging.Logger = None
+    level: int = logging.INFO
+
+    def __post_init__(self):
+        if self.logger is None:
+            self.logger = logging.getLogger('ini2yaml')
+
+    def __call__(self,report):
+        phases = ' '.join(f'{k} {v:.3f}s' for k,v in report['phases'].items())
+        counters = ' '.join(f'{k} {v}' for k,v in report['counters'].items())
+        status = f" error: {report['error']}" if report['error'] else ''
+        self.logger.log(self.level,f"{report['fname']} {report['seconds']:.3f}s | {phases} | {counters}{status}")
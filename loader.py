@@ -0,0 +1,138 @@
+import os
+import pickle
+import keyword
+import hashlib
+from dataclasses import dataclass,field,make_dataclass
+import backends
+
+# Fast loading of generated site files (.yml, .json or .msgpack), e.g., site = siteFile(path=path_to_yml)
+#   * site.Metadata, site.globalVars and site.Include as when loading the file
+#   * site[variableName] is a typed trace object (site.trace_class, a dataclass with a field for every key used by the traces)
+#     site.values(variableName) the same trace as a dict
+# The first load compiles the file into a sidecar pickle next to it (.{name}.cache.pkl), used until the file's content hash changes
+# Each trace is stored separately in the sidecar and only built when it is first accessed
+
+cache_version = 1
+
+def sidecar_path(path):
+    head,tail = os.path.split(path)
+    return(os.path.join(head,f'.{tail}.cache.pkl'))
+
+def content_hash(path):
+    with open(path,'rb') as f:
+        return(hashlib.sha1(f.read()).hexdigest())
+
+def is_field(key):
+    return(key.isidentifier() and not keyword.iskeyword(key))
+
+def compile_site(path,h):
+    # Load the file once and split it into what is needed up front and one pickle per trace
+    data = backends.load(path)
+    traces = data.get('Trace') or {}
+    # Traces are pickled on their own, values shared with other parts of the file (aliases) are stored as references
+    plain = backends.plain(data)
+    types = {}
+    for trace in traces.values():
+        for k,v in trace.items():
+            if v is not None:
+                types[k] = object if types.get(k,type(v)) is not type(v) else type(v)
+    return({
+        'version':cache_version,
+        'hash':h,
+        'header':pickle.dumps({'Metadata':data.get('Metadata'),'globalVars':data.get('globalVars')},protocol=pickle.HIGHEST_PROTOCOL),
+        'Include':plain.get('Include'),
+        'fields':[(k,types.get(k,object)) for k in dict.fromkeys(k for trace in traces.values() for k in trace)],
+        'traces':{name:pickle.dumps(plain['Trace'][name],protocol=pickle.HIGHEST_PROTOCOL) for name in traces},
+    })
+
+@dataclass(kw_only=True)
+class siteFile:
+    path: str
+    sidecar: str = None # Default: next to path
+    cache: bool = True # Read and write the sidecar
+
+    def __post_init__(self):
+        if self.sidecar is None:
+            self.sidecar = sidecar_path(self.path)
+        h = content_hash(self.path)
+        compiled = self.load_sidecar(h) if self.cache else None
+        if compiled is None:
+            compiled = compile_site(self.path,h)
+            if self.cache:
+                self.save_sidecar(compiled)
+        self.compiled = compiled
+        header = pickle.loads(compiled['header'])
+        self.Metadata = header['Metadata']
+        self.globalVars = header['globalVars']
+        # Built on first access
+        self._Include = None
+        self._values = {}
+        self._traces = {}
+        # Keys which are not valid field names are only in values()
+        self.trace_class = make_dataclass('siteTrace',[(k,t,field(default=None)) for k,t in compiled['fields'] if is_field(k)],
+                                          kw_only=True)
+
+    def load_sidecar(self,h):
+        if not os.path.isfile(self.sidecar):
+            return(None)
+        try:
+            with open(self.sidecar,'rb') as f:
+                compiled = pickle.load(f)
+        except Exception:
+            return(None)
+        if type(compiled) is not dict or compiled.get('version') != cache_version or compiled.get('hash') != h:
+            return(None)
+        return(compiled)
+
+    def save_sidecar(self,compiled):
+        tmppath = f'{self.sidecar}.{os.getpid()}.tmp'
+        try:
+            with open(tmppath,'wb') as f:
+                pickle.dump(compiled,f,protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmppath,self.sidecar)
+        except OSError:
+            # e.g., a read-only tree, the compiled file is still used for this session
+            pass
+
+    def lookup(self,path):
+        # Value of a reference, traces are built if needed
+        parts = path.split('/')
+        if parts[1] == 'Trace':
+            return(backends.pointer(self.values(backends.unescape(parts[2])),'/'+'/'.join(parts[3:]) if len(parts) > 3 else ''))
+        return(backends.pointer({'Metadata':self.Metadata,'globalVars':self.globalVars},path))
+
+    @property
+    def Include(self):
+        if self._Include is None and self.compiled['Include'] is not None:
+            self._Include = backends.resolve(self.compiled['Include'],self.lookup)
+        return(self._Include)
+
+    def names(self):
+        return(list(self.compiled['traces']))
+
+    def __contains__(self,variableName):
+        return(variableName in self.compiled['traces'])
+
+    def __len__(self):
+        return(len(self.compiled['traces']))
+
+    def __iter__(self):
+        return(iter(self.compiled['traces']))
+
+    def values(self,variableName):
+        # A trace as a dict, the same as in the Trace section of the loaded file
+        if variableName not in self._values:
+            self._values[variableName] = backends.resolve(pickle.loads(self.compiled['traces'][variableName]),self.lookup)
+        return(self._values[variableName])
+
+    def trace(self,variableName):
+        if variableName not in self._traces:
+            values = self.values(variableName)
+            self._traces[variableName] = self.trace_class(**{k:v for k,v in values.items() if is_field(k)})
+        return(self._traces[variableName])
+
+    def __getitem__(self,variableName):
+        return(self.trace(variableName))
+
+    def traces(self):
+        return({name:self.trace(name) for name in self})
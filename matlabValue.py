@@ -0,0 +1,398 @@
+import re
+import sys
+from functools import lru_cache
+from datetime import datetime,timedelta
+from dateutil.parser import parse as dateparse
+
+# A parser for the subset of MATLAB used for values in Biomet.Net ini files
+#   * numbers, Inf and NaN, with numeric arithmetic (+ - * /) and ranges (a:b, a:step:b)
+#   * quoted strings ('single' with '' escapes, or "double")
+#   * vectors delimited by spaces or commas, matrices with rows delimited by semicolons or newlines
+#     inside brackets, MATLAB's whitespace rule applies: [1 -2] is two elements, [1 - 2] is one
+#   * cell arrays (parsed as lists, {[...]} is treated as [...])
+#   * datenum(...) and num2str(...)
+#   * globalVars.* and Metadata references, resolved through a symbol table
+# Anything else (function calls, indexing, logical operators, ...) raises a matlabValueError
+# Each value is parsed once into python types, nothing is passed to eval()
+
+class matlabValueError(ValueError):
+    pass
+
+class undefinedReference(matlabValueError):
+    def __init__(self,name):
+        self.name = name
+        super().__init__(f'Undefined reference: {name}')
+
+token_pattern = re.compile(r"""
+     (?P<ws>[ \t\r]+)
+    |(?P<newline>\n)
+    |(?P<comment>%[^\n]*)
+    |(?P<number>(?:\d+\.?\d*|\.\d+)(?:[eE][+-]?\d+)?)
+    |(?P<string>'(?:[^']|'')*'|"[^"]*")
+    |(?P<call>(?:datenum|num2str)\s*\()
+    |(?P<name>[A-Za-z_]\w*(?:\.[A-Za-z_]\w*)*)
+    |(?P<op>[\[\]{}(),;:+\-*/])
+    """,re.VERBOSE)
+
+constants = {'Inf':float('inf'),'inf':float('inf'),'NaN':float('NaN'),'nan':float('NaN')}
+
+def tokenize(text):
+    # Tokens are (kind, text, call arguments, preceded by whitespace)
+    tokens = []
+    pos = 0
+    space = False
+    while pos < len(text):
+        m = token_pattern.match(text,pos)
+        if m is None:
+            raise matlabValueError(f'Unexpected character {text[pos]!r} in {text!r}')
+        kind = m.lastgroup
+        if kind == 'call':
+            # Arguments are taken verbatim up to the first closing parenthesis
+            end = text.find(')',m.end())
+            if end < 0:
+                raise matlabValueError(f'Unclosed parenthesis in {text!r}')
+            tokens.append((kind,m.group(kind).rstrip('( \t'),text[m.end():end],space))
+            pos = end+1
+            space = False
+            continue
+        if kind in ('ws','comment'):
+            space = True
+        else:
+            tokens.append((kind,m.group(kind),None,space))
+            space = False
+        pos = m.end()
+    return(tokens)
+
+class rangeList(list):
+    # The result of a:b, spliced into the enclosing vector
+    pass
+
+def is_number(value):
+    return(isinstance(value,(int,float)) and not isinstance(value,bool))
+
+# Explicit parsers for the date formats found in ini files, (pattern, order of year/month/day groups)
+# Each is followed by an optional time (HH:MM or HH:MM:SS), anything else is parsed by dateutil
+time_suffix = r'(?:[ T](\d{1,2}):(\d{2})(?::(\d{2}(?:\.\d*)?))?)?$'
+date_formats = [
+    (re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})'+time_suffix),'ymd'),   # 2021-06-01 (ISO)
+    (re.compile(r'(\d{4})/(\d{1,2})/(\d{1,2})'+time_suffix),'ymd'),   # 2021/06/01
+    (re.compile(r'(\d{1,2})-([A-Za-z]{3})-(\d{4})'+time_suffix),'dmy'), # 01-Jun-2021 (MATLAB's datestr default)
+    (re.compile(r'(\d{1,2})/(\d{1,2})/(\d{4})'+time_suffix),'mdy'),   # 06/01/2021 (month first, as dateutil)
+]
+months = {m:i+1 for i,m in enumerate(['jan','feb','mar','apr','may','jun','jul','aug','sep','oct','nov','dec'])}
+
+# Dates which needed the dateutil fallback, by format (digits as 9, words as a)
+# > {'count':distinct values,'example':value}, see slow_date_formats
+date_fallbacks = {}
+
+def date_shape(text):
+    return(re.sub(r'[A-Za-z]+','a',re.sub(r'\d','9',text)))
+
+def parse_date_fast(text):
+    # Returns a datetime, or None if text isn't in one of date_formats
+    for pattern,order in date_formats:
+        m = pattern.match(text)
+        if m is None:
+            continue
+        a,b,c,H,M,S = m.groups()
+        if order == 'ymd':
+            y,mo,d = int(a),int(b),int(c)
+        elif order == 'dmy':
+            if b.lower() not in months:
+                return(None)
+            y,mo,d = int(c),months[b.lower()],int(a)
+        else:
+            y,mo,d = int(c),int(a),int(b)
+        H,M,S = int(H or 0),int(M or 0),int(float(S or 0))
+        try:
+            if H == 24 and M == 0 and S == 0:
+                # 24:00 is midnight of the next day
+                return(datetime(y,mo,d)+timedelta(days=1))
+            return(datetime(y,mo,d,H,M,S))
+        except ValueError:
+            # e.g., day first 13/01/2021, leave it to dateutil
+            return(None)
+    return(None)
+
+# An hour of 24:00, not minutes and seconds (e.g., 12:24:00)
+midnight_pattern = re.compile(r'(?<![\d:])24:00')
+
+def parse_date_slow(text):
+    # dateutil for any other format, with 24:00 as midnight of the next day
+    if midnight_pattern.search(text):
+        return(dateparse(midnight_pattern.sub('23:59',text))+timedelta(minutes=1))
+    return(dateparse(text))
+
+def numeric_datenum(args):
+    # datenum(Y,M,D,h,m,s) with MATLAB's carry over (e.g., day 0 is the last day of the previous month)
+    # or datenum(n), a serial day number (day 1 is 1-Jan-0000)
+    values = [float(v) for v in args.split(',')]
+    if len(values) == 1:
+        n = values[0]
+        return(datetime.fromordinal(int(n)-366)+timedelta(days=n-int(n)))
+    if len(values) < 3 or len(values) > 6 or any(v != int(v) for v in values[:2]):
+        raise ValueError(f'Unsupported datenum arguments: {args}')
+    y,mo = int(values[0]),int(values[1])
+    d,H,M,S = (values[2:]+[0,0,0])[:4]
+    return(datetime(y+(mo-1)//12,(mo-1)%12+1,1)+timedelta(days=d-1,hours=H,minutes=M,seconds=S))
+
+@lru_cache(maxsize=4096)
+def datenum_to_iso(inner):
+    # Convert the arguments of a (deprecated) datenum call to an ISO formatted date string
+    # which is valid in both python and matlab
+    # Results are cached, dates repeat across traces (e.g., calibration and inputFileName dates)
+    inner = inner.strip()
+    if 'now' in inner:
+        # Use of now is bad form, set to distant future
+        d = datetime(2100,12,31,23,59)
+    elif inner.startswith('"') or inner.startswith("'"):
+        inner = inner.strip('"').strip("'").strip()
+        d = parse_date_fast(inner)
+        if d is None:
+            d = parse_date_slow(inner)
+            shape = date_shape(inner)
+            if shape not in date_fallbacks:
+                date_fallbacks[shape] = {'count':0,'example':inner}
+            date_fallbacks[shape]['count'] += 1
+    else:
+        d = numeric_datenum(inner)
+    return(d.strftime("%Y-%m-%dT%H:%M:%S"))
+
+def slow_date_formats():
+    # Formats which needed the (slow) dateutil fallback in this process, most frequent first
+    # Counts are of distinct values (results are cached), normalizing these formats in the ini files avoids the fallback
+    return(dict(sorted(date_fallbacks.items(),key=lambda kv:-kv[1]['count'])))
+
+class valueParser:
+    # Recursive descent over the token list of a single value
+    def __init__(self,text,symbols=None,include=False):
+        self.text = text
+        self.tokens = tokenize(text)
+        self.i = 0
+        self.symbols = symbols if symbols is not None else {}
+        self.include = include
+        # > 0 while inside [] or {}, where whitespace separates elements
+        self.depth = 0
+
+    def peek(self,offset=0):
+        if self.i+offset < len(self.tokens):
+            return(self.tokens[self.i+offset])
+        return((None,None,None,False))
+
+    def next(self):
+        token = self.peek()
+        self.i += 1
+        return(token)
+
+    def skip_newlines(self):
+        while self.peek()[0] == 'newline':
+            self.i += 1
+
+    def error(self,message):
+        return(matlabValueError(f'{message} in {self.text!r}'))
+
+    def parse(self):
+        self.skip_newlines()
+        value = self.expression()
+        # Allow a trailing statement terminator
+        while self.peek()[0] == 'newline' or self.peek()[1] == ';':
+            self.i += 1
+        if self.peek()[0] is not None:
+            raise self.error(f'Unexpected {self.peek()[1]!r}')
+        if type(value) is rangeList:
+            value = list(value)
+        return(value)
+
+    def expression(self):
+        # range := additive [':' additive [':' additive]]
+        start = self.additive()
+        if self.peek()[1] != ':':
+            return(start)
+        self.i += 1
+        stop = self.additive()
+        step = 1
+        if self.peek()[1] == ':':
+            self.i += 1
+            step,stop = stop,self.additive()
+        if not all(is_number(v) for v in (start,step,stop)) or step == 0:
+            raise self.error('Invalid range')
+        values,n = rangeList(),0
+        # Small tolerance so float steps include the end point, as in MATLAB
+        while (step > 0 and start+n*step <= stop+abs(step)*1e-10) or (step < 0 and start+n*step >= stop-abs(step)*1e-10):
+            values.append(start+n*step)
+            n += 1
+        return(values)
+
+    def binary_follows(self,ops):
+        kind,value,_,space = self.peek()
+        if kind != 'op' or value not in ops:
+            return(False)
+        if self.depth and value in '+-' and space and not self.peek(1)[3]:
+            # MATLAB: inside brackets "a -b" starts a new element, "a - b" and "a-b" are subtraction
+            return(False)
+        return(True)
+
+    def additive(self):
+        value = self.term()
+        while self.binary_follows('+-'):
+            op = self.next()[1]
+            value = self.arithmetic(op,value,self.term())
+        return(value)
+
+    def term(self):
+        value = self.unary()
+        while self.binary_follows('*/'):
+            op = self.next()[1]
+            value = self.arithmetic(op,value,self.unary())
+        return(value)
+
+    def arithmetic(self,op,a,b):
+        if not is_number(a) or not is_number(b):
+            raise self.error(f'Cannot apply {op} to {a!r} and {b!r}')
+        if op == '+': return(a+b)
+        if op == '-': return(a-b)
+        if op == '*': return(a*b)
+        if b == 0:
+            # MATLAB division by zero gives Inf or NaN rather than an error
+            return(float('NaN') if a == 0 else float('inf') if a > 0 else float('-inf'))
+        return(a/b)
+
+    def unary(self):
+        kind,value,_,_ = self.peek()
+        if kind == 'op' and value in '+-':
+            self.i += 1
+            operand = self.unary()
+            if not is_number(operand):
+                raise self.error(f'Cannot apply {value} to {operand!r}')
+            return(-operand if value == '-' else +operand)
+        return(self.primary())
+
+    def primary(self):
+        kind,value,args,_ = self.next()
+        if kind is None:
+            raise self.error('Incomplete value')
+        if kind == 'number':
+            if any(c in value for c in '.eE'):
+                return(float(value))
+            return(int(value))
+        if kind == 'string':
+            return(self.string(value))
+        if kind == 'name':
+            return(self.reference(value))
+        if kind == 'call':
+            if value == 'datenum':
+                try:
+                    return(datenum_to_iso(args))
+                except (ValueError,TypeError,OverflowError) as e:
+                    raise self.error(f'Invalid date datenum({args}): {e}')
+            return(str(valueParser(args,symbols=self.symbols,include=self.include).parse()))
+        if kind == 'op' and value == '(':
+            depth,self.depth = self.depth,0
+            inner = self.expression()
+            self.depth = depth
+            if self.next()[1] != ')':
+                raise self.error('Expected )')
+            return(inner)
+        if kind == 'op' and value in '[{':
+            self.depth += 1
+            values = self.array(close=']' if value == '[' else '}')
+            self.depth -= 1
+            return(values)
+        raise self.error(f'Unexpected {value!r}')
+
+    def array(self,close):
+        # Elements are separated by commas or whitespace, rows by semicolons or newlines
+        # A single row is returned as a flat list, multiple rows as a list of lists
+        rows,row = [],[]
+        while True:
+            kind,value,_,_ = self.peek()
+            if kind is None:
+                raise self.error(f'Expected {close}')
+            if kind == 'op' and value == close:
+                self.i += 1
+                break
+            if kind == 'newline' or value == ';':
+                self.i += 1
+                if row: rows.append(row)
+                row = []
+            elif value == ',':
+                self.i += 1
+            else:
+                value = self.expression()
+                if type(value) is rangeList:
+                    row += value
+                else:
+                    row.append(value)
+        if row: rows.append(row)
+        if not rows:
+            return([])
+        if len(rows) == 1:
+            row = rows[0]
+            # {[...]} is the same as [...]
+            if close == '}' and len(row) == 1 and type(row[0]) is list:
+                return(row[0])
+            return(row)
+        return(rows)
+
+    def string(self,token):
+        if token.startswith("'"):
+            s = token[1:-1].replace("''","'")
+        else:
+            s = token[1:-1]
+        # Lists are sometimes provided as quoted strings, e.g., '[a b]' or '[a b];'
+        stripped = s.strip()
+        if stripped.startswith('[') and (stripped.endswith(']') or stripped.endswith('];')):
+            try:
+                return(valueParser(stripped,symbols=self.symbols,include=self.include).parse())
+            except matlabValueError:
+                pass
+        return(s)
+
+    def reference(self,name):
+        if name in constants:
+            return(constants[name])
+        if self.include and name.startswith('globalVars.'):
+            # Includes can't reference anchors in another file, keep a placeholder for substitution
+            return(f'${name}$')
+        if name in self.symbols:
+            # Return the stored object itself, so it is written as a yaml alias of the anchor
+            return(self.symbols[name])
+        raise undefinedReference(name)
+
+def evaluate(text,symbols=None,include=False):
+    # Parse a single MATLAB value into python types
+    # symbols maps fully qualified names (e.g., globalVars.Trace.TA.minMax, Metadata.SiteID) to values
+    return(valueParser(text,symbols=symbols,include=include).parse())
+
+if __name__ == '__main__':
+    # Benchmark against the legacy CleanedText + eval path for every value of an ini file
+    # python matlabValue.py path_to_ini [repeats]
+    import time
+    import ini2yaml
+    fname = sys.argv[1]
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with open(fname,encoding='utf-8') as f:
+        tokens = list(ini2yaml.tokenize_ini(f.read()))
+    values = []
+    for token in tokens:
+        if token.kind == 'trace':
+            values += [l.split('=',1)[-1].strip() for l in token.text.split('\n')
+                       if '=' in l and not l.strip().startswith('%') and not l.strip().startswith(';')]
+    values = [v for v in values if not v.startswith("'") or v.startswith("'[")]
+    names = dict(constants)
+    def legacy(text):
+        return(eval(ini2yaml.CleanedText(text=text,forPython=True).text,{},names))
+    for label,fn in [('CleanedText + eval',legacy),('matlabValue.evaluate',evaluate)]:
+        ok = 0
+        T1 = time.perf_counter()
+        for _ in range(repeats):
+            for v in values:
+                try:
+                    fn(v)
+                    ok += 1
+                except Exception:
+                    pass
+        dt = time.perf_counter()-T1
+        print(f'{label:<22} {len(values)*repeats:>8} values {dt:8.3f}s {1e6*dt/max(len(values)*repeats,1):8.2f}us/value ({ok} parsed)')
+    for shape,fallback in slow_date_formats().items():
+        print(f"Slow date format {shape} ({fallback['count']} values, e.g. {fallback['example']!r})")
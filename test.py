@@ -9,7 +9,11 @@ root = r'C:\Users\jskeeter\gsc-permafrost'
 # root = 'E:\\'
 old_ini_path = os.path.join(root,r'Database\Calculation_Procedures\TraceAnalysis_ini')
 siteList = ['HOGG']#['BB','BB2','BBS','DSM','RBM','HOGG','OHM','YOUNG']
+# Shared across sites and stages so each #include is only parsed once per change
+cache = ini2yaml.includeCache(sidecar=os.path.join(old_ini_path,'.include_cache.pkl'))
 for SiteID in siteList:
-    for stage in ['firststage','secondstage']:
-        print(f'Site: {SiteID}, stage: {stage}')
-        i2y = ini2yaml.parser(root=old_ini_path,SiteID=SiteID,stage=stage,fields_on_the_fly=True,verbose=False)
\ No newline at end of file
+    print(f'Site: {SiteID}')
+    # Both stages in one session, includes used by both are parsed and written once
+    site = ini2yaml.siteParser(root=old_ini_path,SiteID=SiteID,stages=['firststage','secondstage'],fields_on_the_fly=True,verbose=False,cache=cache)
+cache.save()
+print('Include cache: ',cache.stats())
@@ -0,0 +1,17 @@
+import os
+import sys
+import textwrap
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+@pytest.fixture
+def ini_tree(tmp_path):
+    # Write {relative path: ini text} under a temporary TraceAnalysis_ini root
+    def write(files):
+        for rel,text in files.items():
+            path = tmp_path/rel
+            path.parent.mkdir(parents=True,exist_ok=True)
+            path.write_text(textwrap.dedent(text).lstrip('\n'),encoding='utf-8')
+        return(str(tmp_path))
+    return(write)
@@ -0,0 +1,92 @@
+import os
+import json
+import math
+import pytest
+
+import ini2yaml
+import backends
+
+site_ini = '''
+Site_name = 'Burns Bog'
+SiteID = 'BB'
+Difference_GMT_to_local_time = 8 % hours
+globalVars.Trace.TA_1_1_1.minMax = [-40 50]
+globalVars.flag = 1
+#include inc.ini
+
+[Trace]
+    variableName = 'TA_1_1_1'
+    units = 'degC'
+    minMax = globalVars.Trace.TA_1_1_1.minMax
+    zeroPt = globalVars.Trace.TA_1_1_1.minMax
+    customFloat = 2.5
+[End]
+'''
+
+inc_ini = '''
+[Trace]
+    variableName = 'B'
+    units = 'one'
+[End]
+'''
+
+outputs = ['yaml','json',pytest.param('msgpack',marks=pytest.mark.skipif(backends.msgpack is None,reason='msgpack is not installed'))]
+
+def convert(root,output,cache=None):
+    return(ini2yaml.parser(root=root,SiteID='BB',stage='firststage',fields_on_the_fly=True,verbose=False,output=output,cache=cache))
+
+@pytest.mark.parametrize('output',outputs)
+def test_backends_load_the_same_structure(ini_tree,output):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+    expected = backends.load(convert(root,'yaml').outpath)
+    i2y = convert(root,output)
+    assert i2y.outpath.endswith(backends.extensions[output])
+    assert os.path.isfile(os.path.join(root,'inc'+backends.extensions[output]))
+    out = backends.load(i2y.outpath)
+    assert out == expected
+    assert out['Metadata']['Diff_GMT_to_local_time'] == 8
+    # Aliases are resolved to the same object, as when loading the yaml
+    trace = out['Trace']['TA_1_1_1']
+    assert trace['minMax'] is out['globalVars']['Trace']['TA_1_1_1']['minMax'] is trace['zeroPt']
+
+def test_json_references(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+    with open(convert(root,'json').outpath) as f:
+        out = json.load(f)
+    assert out['Trace']['TA_1_1_1']['minMax'] == {'$ref':'/globalVars/Trace/TA_1_1_1/minMax'}
+    assert out['Include'] == ['inc']
+
+@pytest.mark.parametrize('output',outputs)
+def test_non_finite_floats(ini_tree,output):
+    site = site_ini.replace('[-40 50]','[-Inf Inf]').replace('customFloat = 2.5','customFloat = NaN')
+    root = ini_tree({'BB/BB_firststage.ini':site,'inc.ini':inc_ini})
+    out = backends.load(convert(root,output).outpath)
+    trace = out['Trace']['TA_1_1_1']
+    assert trace['minMax'] == [-math.inf,math.inf] and trace['minMax'] is trace['zeroPt']
+    assert math.isnan(trace['customFloat'])
+    if output == 'json':
+        # Valid json, which has no Infinity or NaN
+        def invalid(constant):
+            raise ValueError(constant)
+        with open(os.path.join(root,'BB','BB_firststage.json')) as f:
+            written = json.load(f,parse_constant=invalid)
+        assert written['Trace']['TA_1_1_1']['customFloat'] == {'$float':'nan'}
+
+def test_cached_includes_are_restored_per_output(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+    cache = ini2yaml.includeCache()
+    convert(root,'yaml',cache)
+    convert(root,'json',cache)
+    # Each output has its own entries
+    assert (cache.hits,cache.misses) == (0,2)
+    os.remove(os.path.join(root,'inc.json'))
+    convert(root,'json',cache)
+    assert cache.hits == 1
+    assert backends.load(os.path.join(root,'inc.json')) == backends.load(os.path.join(root,'inc.yml'))
+
+def test_unknown_output(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+    with pytest.raises(ValueError):
+        convert(root,'xml')
+    with pytest.raises(ValueError):
+        ini2yaml.parser(root=root,SiteID='BB',stage='firststage',verbose=False,output='json',stream=True)
@@ -0,0 +1,144 @@
+import os
+import sys
+import batch
+
+good = "SiteID = '{0}'\n[Trace]\n    variableName = 'TA'\n    minMax = [-40 50]\n[End]\n"
+
+def test_discover(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':good.format('BB'),'BB/BB_secondstage.ini':good.format('BB'),
+                     'BB2/BB2_firststage.ini':good.format('BB2'),'notes/readme.txt':''})
+    assert batch.discover(root) == [('BB','firststage'),('BB2','firststage'),('BB','secondstage')]
+    assert batch.discover(root,siteList=['BB2']) == [('BB2','firststage')]
+
+def test_errors_are_reported_not_raised(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':good.format('BB'),
+                     'BAD/BAD_firststage.ini':"[Trace]\n    variableName = 'TA'\n    minMax = [1 2\n[End]\n"})
+    environ = dict(os.environ)
+    summaries = {s['SiteID']:s for s in batch.convert_batch(root,stageList=['firststage'],workers=2)}
+    assert summaries['BB']['status'] == 'ok'
+    assert summaries['BAD']['status'] == 'error'
+    assert 'BAD_firststage.ini' in summaries['BAD']['error']
+    assert not os.path.isfile(os.path.join(root,'BAD','BAD_firststage.yml'))
+    # Running a conversion in this process does not touch its environment
+    batch.convert(root,'BAD','firststage')
+    assert dict(os.environ) == environ
+
+included = "SiteID = '{0}'\n#include common.ini\n"
+common = "[Trace]\n    variableName = 'TA'\n    units = '{0}'\n[End]\n"
+
+def statuses(root,**kwargs):
+    return({s['SiteID']:s['status'] for s in batch.convert_batch(root,stageList=['firststage'],workers=2,incremental=True,**kwargs)})
+
+def test_manifest_skips_unchanged(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':included.format('BB'),'BB2/BB2_firststage.ini':good.format('BB2'),
+                     'common.ini':common.format('C')})
+    assert statuses(root) == {'BB':'ok','BB2':'ok'}
+    assert statuses(root) == {'BB':'skipped','BB2':'skipped'}
+    manifest = batch.conversionManifest(root=root)
+    assert sorted(manifest.files['BB/BB_firststage.ini']['outputs']) == ['BB/BB_firststage.yml','common.yml']
+
+def test_manifest_converter(ini_tree,monkeypatch,tmp_path):
+    root = ini_tree({'BB/BB_firststage.ini':included.format('BB'),'common.ini':common.format('C')})
+    statuses(root)
+    # A change to any module which shapes the output invalidates every entry
+    for module in ['ini2yaml','matlabValue','backends']:
+        assert statuses(root) == {'BB':'skipped'}
+        changed = tmp_path/f'{module}.py'
+        changed.write_text(open(getattr(batch,module).__file__).read()+'\n# changed\n')
+        with monkeypatch.context() as m:
+            m.setattr(getattr(batch,module),'__file__',str(changed))
+            assert batch.conversionManifest(root=root).files == {}
+
+def test_manifest_output_format(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':included.format('BB'),'common.ini':common.format('C')})
+    assert statuses(root) == {'BB':'ok'}
+    # Another format is converted, then skipped
+    assert statuses(root,output='json') == {'BB':'ok'}
+    assert statuses(root,output='json') == {'BB':'skipped'}
+    assert os.path.isfile(os.path.join(root,'common.json'))
+
+def test_manifest_invalidation(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':included.format('BB'),'BB2/BB2_firststage.ini':good.format('BB2'),
+                     'common.ini':common.format('C')})
+    statuses(root)
+    # Editing an include only reconverts the files which use it
+    ini_tree({'common.ini':common.format('K')})
+    assert statuses(root) == {'BB':'ok','BB2':'skipped'}
+    with open(os.path.join(root,'common.yml')) as f:
+        assert 'K' in f.read()
+    # A deleted include output is regenerated
+    os.remove(os.path.join(root,'common.yml'))
+    assert statuses(root) == {'BB':'ok','BB2':'skipped'}
+    assert os.path.isfile(os.path.join(root,'common.yml'))
+    # As is a deleted site output
+    os.remove(os.path.join(root,'BB2','BB2_firststage.yml'))
+    assert statuses(root) == {'BB':'skipped','BB2':'ok'}
+
+def test_shared_include_across_stages(ini_tree):
+    # Both stages of both sites write common.yml, each stage with its own content
+    root = ini_tree({**{f'{SiteID}/{SiteID}_{stage}.ini':included.format(SiteID) for SiteID in ['BB','BB2'] for stage in batch.stages},
+                     'common.ini':common.format('C')})
+    def run(**kwargs):
+        return({(s['SiteID'],s['stage']):s['status'] for s in batch.convert_batch(root,workers=2,incremental=True,**kwargs)})
+    def common_yml():
+        with open(os.path.join(root,'common.yml')) as f:
+            return(f.read())
+    run()
+    full = common_yml()
+    # firststage rewrites common.yml, so the secondstage files sharing it are converted again
+    ini_tree({'BB/BB_firststage.ini':included.format('BB')+'% edited\n'})
+    statuses = run()
+    assert statuses[('BB','firststage')] == 'ok'
+    assert statuses[('BB','secondstage')] == statuses[('BB2','secondstage')] == 'ok'
+    assert common_yml() == full
+    assert set(run().values()) == {'skipped'}
+    # Running firststage alone doesn't mark the secondstage files current
+    ini_tree({'BB/BB_firststage.ini':included.format('BB')})
+    assert run(stageList=['firststage'])[('BB','firststage')] == 'ok'
+    assert common_yml() != full
+    statuses = run()
+    assert statuses[('BB','secondstage')] == statuses[('BB2','secondstage')] == 'ok'
+    assert common_yml() == full
+    assert set(run().values()) == {'skipped'}
+
+def test_skipped_summary(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':included.format('BB'),'common.ini':common.format('C')})
+    converted, = batch.convert_batch(root,stageList=['firststage'],incremental=True)
+    skipped, = batch.convert_batch(root,stageList=['firststage'],incremental=True)
+    assert skipped['status'] == 'skipped'
+    assert skipped.keys() == converted.keys()
+    assert (skipped['outpath'],skipped['include_outputs']) == (converted['outpath'],converted['include_outputs'])
+    assert (skipped['include_hits'],skipped['include_misses']) == (0,0)
+
+def test_exit_code(ini_tree):
+    import subprocess
+    root = ini_tree({'BB/BB_firststage.ini':good.format('BB')})
+    cmd = [sys.executable,batch.__file__,root,'--stages','firststage','--incremental']
+    for expected in ['Converted 1, skipped 0, failed 0','Converted 0, skipped 1, failed 0']:
+        run = subprocess.run(cmd,capture_output=True,text=True)
+        assert run.returncode == 0
+        assert expected in run.stdout
+    ini_tree({'BAD/BAD_firststage.ini':"[Trace]\n    minMax = [1 2\n[End]\n"})
+    run = subprocess.run(cmd,capture_output=True,text=True)
+    assert run.returncode == 1
+    assert 'Converted 0, skipped 1, failed 1' in run.stdout
+
+def test_fail_soft_report(ini_tree):
+    import json
+    bad = "SiteID = 'BAD'\n#include common.ini\n[Trace]\n    variableName = 'TA'\n    minMax = [1 2\n[End]\n"
+    root = ini_tree({'BB/BB_firststage.ini':included.format('BB'),'BAD/BAD_firststage.ini':bad,
+                     'common.ini':common.format('C')+"[Trace]\n    variableName = 'RH'\n    minMax = [0\n[End]\n"})
+    assert statuses(root) == {'BAD':'error','BB':'error'}
+    summaries = {s['SiteID']:s for s in batch.convert_batch(root,stageList=['firststage'],workers=1,incremental=True,fail_soft=True)}
+    assert {SiteID:s['status'] for SiteID,s in summaries.items()} == {'BAD':'ok','BB':'ok'}
+    # Includes with skipped items are not cached, every file using them reports them
+    assert [(d['trace'],d['key']) for d in summaries['BB']['diagnostics']] == [('RH','minMax')]
+    assert [(d['trace'],d['key']) for d in summaries['BAD']['diagnostics']] == [('TA','minMax'),('RH','minMax')]
+    # Files with diagnostics are converted again
+    assert statuses(root,fail_soft=True) == {'BAD':'ok','BB':'ok'}
+    path = os.path.join(root,'report.json')
+    report = batch.write_report(path,list(summaries.values()))
+    with open(path) as f:
+        assert json.load(f) == report
+    assert report['errors'] == [] and len(report['diagnostics']) == 3
+    assert report['diagnostics'][0]['SiteID'] == 'BAD' and report['diagnostics'][0]['line'] == 5
@@ -0,0 +1,35 @@
+import os
+from ruamel.yaml import YAML
+
+import benchmark
+
+def test_generated_tree_converts(tmp_path):
+    root = benchmark.generate(str(tmp_path),20,includes=3,include_traces=4,global_traces=0.5,datenum=1,matrix=1)
+    with open(os.path.join(root,'SYN','SYN_firststage.ini')) as f:
+        text = f.read()
+    assert 'globalVars.flag = ' in text and 'globalVars.Instrument.IRGA' in text and 'globalVars.Trace.' in text
+    assert text.count('#include') == 3
+    for stage in ['firststage','secondstage']:
+        timings,counters = benchmark.time_conversion(root,'SYN',stage)
+        assert set(timings) == set(benchmark.phases+['other','total'])
+        assert counters['traces'] == 20+3*4
+        with open(os.path.join(root,'SYN',f'SYN_{stage}.yml')) as f:
+            out = YAML(typ='safe').load(f)
+        assert len(out['Trace']) == 20
+        assert out['Include'] == [f'SYN_{stage}_include_{i}' for i in range(3)]
+    assert '\n' in out['Trace']['T_0_1_1']['Evaluate']
+
+def test_generate_is_deterministic(tmp_path):
+    a = benchmark.generate(str(tmp_path/'a'),10)
+    b = benchmark.generate(str(tmp_path/'b'),10)
+    for rel in ['SYN/SYN_firststage.ini','SYN/SYN_secondstage.ini','SYN_firststage_include_0.ini']:
+        with open(os.path.join(a,rel)) as f, open(os.path.join(b,rel)) as g:
+            assert f.read() == g.read()
+
+def test_run_and_compare(tmp_path):
+    results = {'results':benchmark.run([5],stages=['firststage'],repeats=1,root=str(tmp_path),includes=1,include_traces=2)}
+    assert os.listdir(tmp_path) == []
+    assert results['results'][0]['traces'] == 5
+    assert benchmark.compare(results,results) == []
+    slower = {'results':[dict(r,seconds={k:v*2+0.01 for k,v in r['seconds'].items()}) for r in results['results']]}
+    assert {r['phase'] for r in benchmark.compare(results,slower)} == set(benchmark.phases+['other','total'])
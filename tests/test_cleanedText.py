@@ -0,0 +1,41 @@
+import pytest
+
+import ini2yaml
+from ini2yaml import CleanedText
+
+@pytest.mark.parametrize('text,Literal,expected',[
+    ("'Air temperature' % comment",None,'Air temperature'),
+    ("'some comment % with pct'",False,'somecomment%withpct'),
+    ("'HMP 155'",False,'HMP155'),
+    ("'it''s'",None,'it"s'),
+    ("''",None,''),
+    ("'TA = TA_1_1_1;\n  TA(TA>50) = NaN; % not a comment'",True,'TA = TA_1_1_1;\n  TA(TA>50) = NaN; % not a comment'),
+])
+def test_string_formatting(text,Literal,expected):
+    assert CleanedText(text=text,forPython=False,Literal=Literal).text == expected
+
+@pytest.mark.parametrize('text,expected',[
+    ('[-40 50]','[ -40 , 50 ]'),
+    ('[1 2 3; 4 5 6] % matrix','[  [ 1 , 2 , 3 ] , [  4 , 5 , 6 ]  ]'),
+    ("{'a' 'b'}","[ 'a' , 'b' ]"),
+    ("'[a b];'",'[ a , b ]'),
+    ('num2str(5)','str(5)'),
+    ('[datenum(2019,1,1)]','[ "2019-01-01T00:00:00" ]'),
+    ('; x',''),
+])
+def test_python_parsing(text,expected):
+    assert CleanedText(text=text,forPython=True).text == expected
+
+def test_line_breaks_are_rejected():
+    with pytest.raises(ValueError):
+        CleanedText(text='[1\n2]',forPython=True)
+
+def test_repeated_values_are_cached():
+    ini2yaml.clean_text.cache_clear()
+    first = CleanedText(text="'degC' % units",forPython=False,Literal=None)
+    second = CleanedText(text="'degC' % units",forPython=False,Literal=None)
+    assert (first.cached,first.substitutions) == (False,1)
+    assert (second.cached,second.substitutions) == (True,0)
+    # The mode and Literal are part of the key
+    assert not CleanedText(text="'degC' % units",forPython=False,Literal=False).cached
+    assert ini2yaml.clean_text.cache_info().currsize == 2
@@ -0,0 +1,119 @@
+import os
+import pytest
+
+import ini2yaml
+import instrumentation
+
+def site(name):
+    return(f"""
+    SiteID = '{name}'
+    #include inc1.ini
+    """)
+
+inc1 = """
+#include inc2.ini
+[Trace]
+    variableName = 'A'
+    units = 'one'
+[End]
+"""
+
+inc2 = """
+[Trace]
+    variableName = 'B'
+    units = 'two'
+[End]
+"""
+
+def convert(root,SiteID,cache,stage='firststage'):
+    return(ini2yaml.parser(root=root,SiteID=SiteID,stage=stage,fields_on_the_fly=True,verbose=False,cache=cache))
+
+@pytest.fixture
+def tree(ini_tree):
+    return(ini_tree({'S1/S1_firststage.ini':site('S1'),'S2/S2_firststage.ini':site('S2'),'inc1.ini':inc1,'inc2.ini':inc2}))
+
+def test_hits_and_misses(tree):
+    cache = ini2yaml.includeCache()
+    convert(tree,'S1',cache)
+    # inc1 and inc2 are both parsed once
+    assert (cache.hits,cache.misses) == (0,2)
+    convert(tree,'S2',cache)
+    assert (cache.hits,cache.misses) == (1,2)
+    # Other stages are cached separately
+    os.rename(os.path.join(tree,'S1','S1_firststage.ini'),os.path.join(tree,'S1','S1_secondstage.ini'))
+    convert(tree,'S1',cache,stage='secondstage')
+    assert cache.misses == 4
+
+def test_transitive_change_invalidates(tree):
+    cache = ini2yaml.includeCache()
+    convert(tree,'S1',cache)
+    with open(os.path.join(tree,'inc2.ini'),'a') as f:
+        f.write("[Trace]\n    variableName = 'C'\n[End]\n")
+    convert(tree,'S2',cache)
+    assert cache.hits == 0
+    with open(os.path.join(tree,'inc2.yml')) as f:
+        assert 'variableName: C' in f.read()
+
+def test_touched_but_unchanged_is_a_hit(tree):
+    cache = ini2yaml.includeCache()
+    convert(tree,'S1',cache)
+    path = os.path.join(tree,'inc2.ini')
+    st = os.stat(path)
+    os.utime(path,ns=(st.st_atime_ns,st.st_mtime_ns+10**9))
+    convert(tree,'S2',cache)
+    assert cache.hits == 1
+
+def test_sidecar_and_restored_outputs(tree):
+    sidecar = os.path.join(tree,'.include_cache.pkl')
+    cache = ini2yaml.includeCache(sidecar=sidecar)
+    convert(tree,'S1',cache)
+    cache.save()
+    os.remove(os.path.join(tree,'inc1.yml'))
+    os.remove(os.path.join(tree,'inc2.yml'))
+    cache = ini2yaml.includeCache(sidecar=sidecar)
+    convert(tree,'S2',cache)
+    assert cache.stats() == {'hits':1,'misses':0,'entries':2}
+    assert os.path.isfile(os.path.join(tree,'inc1.yml'))
+    assert os.path.isfile(os.path.join(tree,'inc2.yml'))
+
+def read(root,rel):
+    with open(os.path.join(root,rel),encoding='utf-8') as f:
+        return(f.read())
+
+def test_site_session_matches_separate_parses(ini_tree):
+    files = {'S1/S1_firststage.ini':site('S1'),'S1/S1_secondstage.ini':site('S1'),
+             'S2/S2_firststage.ini':site('S2'),'inc1.ini':inc1+"[Trace]\n    variableName = 'D'\n    extra = 5\n[End]\n",'inc2.ini':inc2}
+    outputs = ['S1/S1_firststage.yml','S1/S1_secondstage.yml','S2/S2_firststage.yml','inc1.yml','inc2.yml']
+    root = ini_tree(files)
+    expected = {}
+    for SiteID,stage in [('S1','firststage'),('S1','secondstage'),('S2','firststage')]:
+        convert(root,SiteID,None,stage=stage)
+        if SiteID == 'S1':
+            expected[stage] = read(root,'inc1.yml')
+    expected.update({rel:read(root,rel) for rel in outputs})
+    for rel in outputs:
+        os.remove(os.path.join(root,rel))
+    cache = ini2yaml.includeCache()
+    instruments = instrumentation.instrumentation(per_trace=False)
+    ini2yaml.siteParser(root=root,SiteID='S1',fields_on_the_fly=True,verbose=False,cache=cache,instruments=instruments)
+    # Include traces are parsed once, and the include .yml is only written by the last stage
+    assert instruments.summary()['counters']['shared_traces'] == 3
+    assert read(root,'inc1.yml') == expected['secondstage'] != expected['firststage']
+    # S2 has no second stage, the firststage include .yml is written again
+    ini2yaml.siteParser(root=root,SiteID='S2',fields_on_the_fly=True,verbose=False,cache=cache)
+    assert {rel:read(root,rel) for rel in outputs} == {rel:expected[rel] for rel in outputs}
+
+def test_dedup_is_cached_apart(ini_tree):
+    evaluate = "'A = B + C + D + E;'"
+    trace = "[Trace]\n    variableName = '{0}'\n    Evaluate = {1}\n[End]\n"
+    root = ini_tree({'S1/S1_secondstage.ini':site('S1'),'S2/S2_secondstage.ini':site('S2'),
+                     'inc1.ini':"#include inc2.ini\n"+trace.format('A',evaluate)+trace.format('X',evaluate),'inc2.ini':inc2})
+    convert(root,'S2',None,stage='secondstage')
+    expected = {rel:read(root,rel) for rel in ['S2/S2_secondstage.yml','inc1.yml']}
+    cache = ini2yaml.includeCache()
+    ini2yaml.parser(root=root,SiteID='S1',stage='secondstage',fields_on_the_fly=True,verbose=False,cache=cache,dedup=True)
+    assert '*Include__inc1__A__Evaluate' in read(root,'inc1.yml')
+    # A conversion without dedup neither reuses nor restores the aliased include
+    convert(root,'S2',cache,stage='secondstage')
+    assert {rel:read(root,rel) for rel in expected} == expected
+    assert cache.stats()['entries'] == 4
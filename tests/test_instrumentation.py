@@ -0,0 +1,90 @@
+import json
+import logging
+import pytest
+
+import ini2yaml
+import matlabValue
+from instrumentation import instrumentation,jsonSink,loggerSink
+
+site = """
+SiteID = 'BB'
+globalVars.Trace.A.minMax = [-40 50]
+#include inc.ini
+[Trace]
+    variableName = 'A'
+    title = 'Air temperature'
+    minMax = globalVars.Trace.A.minMax
+    extra = 5
+[End]
+[Trace]
+    variableName = 'B'
+[End]
+"""
+
+def convert(root,instruments,**kwargs):
+    return(ini2yaml.parser(root=root,SiteID='BB',stage='firststage',fields_on_the_fly=True,verbose=False,instruments=instruments,**kwargs))
+
+@pytest.fixture
+def tree(ini_tree):
+    return(ini_tree({'BB/BB_firststage.ini':site,'inc.ini':"[Trace]\n    variableName = 'I'\n[End]\n"}))
+
+def test_reports(tree):
+    seen = []
+    instruments = instrumentation(sinks=[seen.append])
+    i2y = convert(tree,instruments)
+    # The include is reported (and closed) first
+    inc,top = instruments.reports
+    assert seen == instruments.reports
+    assert (inc['include'],top['include']) == (True,False)
+    assert set(top['phases']) == {'read','tokenize','parse_metadata','parse_globals','parse_traces','parse_includes','write'}
+    counters = top['counters']
+    assert counters['traces'] == 2
+    assert counters['fields_added'] >= 1
+    assert counters['evaluate'] >= 3
+    assert counters['CleanedText'] >= 2
+    assert counters['regex_substitutions'] >= 2
+    with open(i2y.fname,'rb') as f:
+        assert counters['bytes_read'] == len(f.read())
+    with open(i2y.outpath,'rb') as f:
+        assert counters['bytes_written'] == len(f.read())
+    assert [(t['variableName'],t['line']) for t in top['traces']] == [('A',4),('B',10)]
+    assert top['traces'][0]['counters']['fields_added'] == 1
+    summary = instruments.summary()
+    assert summary['files'] == 2 and summary['counters']['traces'] == 3
+
+def test_stream_phases(tree):
+    instruments = instrumentation(per_trace=False)
+    convert(tree,instruments,stream=True)
+    top = instruments.reports[-1]
+    assert {'write_stream','parse_traces','parse_includes'} <= set(top['phases'])
+    assert top['traces'] == []
+
+def test_sinks(tree,tmp_path,caplog):
+    path = str(tmp_path/'report.json')
+    with caplog.at_level(logging.INFO,logger='ini2yaml'):
+        convert(tree,instrumentation(sinks=[jsonSink(path=path),loggerSink()]))
+    with open(path) as f:
+        assert [r['include'] for r in json.load(f)] == [True,False]
+    assert 'BB_firststage.ini' in caplog.text
+
+def test_errors_are_reported(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':"[Trace]\n    variableName = 'A'\n    minMax = [1 2\n[End]\n"})
+    instruments = instrumentation()
+    with pytest.raises(matlabValue.matlabValueError):
+        convert(root,instruments)
+    assert 'Expected ]' in instruments.reports[0]['error']
+    assert instruments.depth == 0
+
+@pytest.mark.parametrize('profile,key',[('cprofile','profile'),('tracemalloc','memory')])
+def test_profiles(tree,profile,key):
+    instruments = instrumentation(profile=profile)
+    convert(tree,instruments)
+    inc,top = instruments.reports
+    # Only captured around the top level conversion
+    assert inc[key] is None and top[key]
+    if profile == 'tracemalloc':
+        assert top['memory']['peak'] > 0
+
+def test_disabled(tree):
+    i2y = convert(tree,None)
+    assert i2y.report is None
@@ -0,0 +1,68 @@
+import os
+import pytest
+
+import ini2yaml
+import backends
+import loader
+
+site_ini = '''
+SiteID = 'BB'
+globalVars.Trace.TA_1_1_1.minMax = [-40 50]
+#include inc.ini
+
+[Trace]
+    variableName = 'TA_1_1_1'
+    units = 'degC'
+    minMax = globalVars.Trace.TA_1_1_1.minMax
+    customInt = 60*24
+[End]
+[Trace]
+    variableName = 'RH_1_1_1'
+    minMax = [0 100]
+[End]
+'''
+
+inc_ini = "[Trace]\n    variableName = 'B'\n[End]\n"
+
+@pytest.fixture
+def site(ini_tree):
+    def convert(output='yaml'):
+        root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+        return(ini2yaml.parser(root=root,SiteID='BB',stage='firststage',fields_on_the_fly=True,verbose=False,output=output).outpath)
+    return(convert)
+
+@pytest.mark.parametrize('output',['yaml','json'])
+def test_matches_load(site,output):
+    path = site(output)
+    expected = backends.load(path)
+    for _ in range(2):
+        # Compiled, then from the sidecar
+        s = loader.siteFile(path=path)
+        assert os.path.isfile(loader.sidecar_path(path))
+        assert (s.Metadata,s.globalVars,s.Include) == (expected['Metadata'],expected['globalVars'],expected['Include'])
+        assert {name:s.values(name) for name in s} == expected['Trace']
+        assert s['TA_1_1_1'].minMax is s.globalVars['Trace']['TA_1_1_1']['minMax']
+
+def test_traces_are_typed_and_lazy(site):
+    s = loader.siteFile(path=site())
+    trace = s['RH_1_1_1']
+    assert list(s._values) == ['RH_1_1_1']
+    assert trace.minMax == [0,100]
+    # Fields used by any trace are declared, with the type of their values
+    assert trace.customInt is None
+    assert s.trace_class.__dataclass_fields__['customInt'].type is int
+    assert s.names() == ['TA_1_1_1','RH_1_1_1'] and 'B' not in s
+
+def test_sidecar_is_invalidated_by_content(site):
+    path = site()
+    loader.siteFile(path=path)
+    with open(path,encoding='utf-8') as f:
+        text = f.read()
+    with open(path,'w',encoding='utf-8') as f:
+        f.write(text.replace('degC','K'))
+    assert loader.siteFile(path=path)['TA_1_1_1'].units == 'K'
+
+def test_without_cache(site):
+    path = site()
+    assert len(loader.siteFile(path=path,cache=False)) == 2
+    assert not os.path.isfile(loader.sidecar_path(path))
@@ -0,0 +1,109 @@
+import math
+import pytest
+import matlabValue
+from matlabValue import evaluate,matlabValueError,undefinedReference
+
+@pytest.mark.parametrize('text,expected',[
+    ('5',5),
+    ('-8',-8),
+    ('3.5',3.5),
+    ('1e3',1000.0),
+    ('[-40 50]',[-40,50]),
+    ('[-40,50]',[-40,50]),
+    ('[90;110]',[[90],[110]]),
+    ('[1 2 3; 4 5 6]',[[1,2,3],[4,5,6]]),
+    ('[1 2;]',[1,2]),
+    ('[]',[]),
+    ("{'TA_1_1_1'}",['TA_1_1_1']),
+    ("{'PA_1_1_1' 'PA_2'}",['PA_1_1_1','PA_2']),
+    ("{'Air temp'}",['Air temp']),
+    ('{[1 2]}',[1,2]),
+    ("'it''s'","it's"),
+    ('5;',5),
+    ('[1 2] % comment',[1,2]),
+    ("['TA_' num2str(1)]",['TA_','1']),
+])
+def test_values(text,expected):
+    assert evaluate(text) == expected
+
+def test_constants():
+    assert evaluate('Inf') == math.inf
+    values = evaluate('[NaN -Inf]')
+    assert math.isnan(values[0]) and values[1] == -math.inf
+
+@pytest.mark.parametrize('text,expected',[
+    ('60*24',1440),
+    ('[1/2 3]',[0.5,3]),
+    ('(1+2)*3',9),
+    ('[1 -2]',[1,-2]),
+    ('[1 - 2]',[-1]),
+    ('[1-2]',[-1]),
+    ('[1 -2 + 3]',[1,1]),
+    ('1:3',[1,2,3]),
+    ('[0:2:6 9]',[0,2,4,6,9]),
+    ('[1/0 -1/0]',[math.inf,-math.inf]),
+])
+def test_arithmetic(text,expected):
+    assert evaluate(text) == expected
+
+def test_quoted_lists():
+    assert evaluate("'[1 2]'") == [1,2]
+    assert evaluate("'[1 2];'") == [1,2]
+    # Not a valid value, kept as a string
+    assert evaluate("'[W/m2]'") == '[W/m2]'
+
+def test_datenum():
+    assert evaluate('[datenum(2019,1,1) datenum(2999,1,1)]') == ['2019-01-01T00:00:00','2999-01-01T00:00:00']
+    assert evaluate("datenum('01-Jan-2020 24:00')") == '2020-01-02T00:00:00'
+    assert evaluate('datenum(now)') == '2100-12-31T23:59:00'
+
+@pytest.mark.parametrize('text,expected',[
+    ('2021-06-01','2021-06-01T00:00:00'),
+    ('2021-6-1 13:30','2021-06-01T13:30:00'),
+    ('2021/06/01 13:30:15','2021-06-01T13:30:15'),
+    ('01-JUN-2021 24:00','2021-06-02T00:00:00'),
+    ('06/01/2021','2021-06-01T00:00:00'),
+    # 24 minutes, not 24:00
+    ('2021-06-01 12:24:00','2021-06-01T12:24:00'),
+])
+def test_fast_dates_match_dateutil(text,expected):
+    assert matlabValue.parse_date_fast(text).strftime('%Y-%m-%dT%H:%M:%S') == expected
+    assert matlabValue.parse_date_slow(text).strftime('%Y-%m-%dT%H:%M:%S') == expected
+
+def test_numeric_datenum():
+    # MATLAB carries over out of range months and days
+    assert evaluate('datenum(2020,1,0)') == '2019-12-31T00:00:00'
+    assert evaluate('datenum(2020,13,1,24,0,0)') == '2021-01-02T00:00:00'
+    assert evaluate('datenum(2020,1,1.5)') == '2020-01-01T12:00:00'
+    # Serial day number
+    assert evaluate('datenum(737791)') == '2020-01-01T00:00:00'
+    with pytest.raises(matlabValueError):
+        evaluate('datenum(2020,1.5,1)')
+
+def test_slow_dates_are_reported():
+    matlabValue.date_fallbacks.clear()
+    matlabValue.datenum_to_iso.cache_clear()
+    assert evaluate("datenum('June 1, 2021')") == '2021-06-01T00:00:00'
+    assert evaluate("[datenum('June 1, 2021') datenum('May 2, 2020') datenum('2021-06-01')]")[1] == '2020-05-02T00:00:00'
+    # Counted once per distinct value
+    assert matlabValue.slow_date_formats() == {'a 9, 9999':{'count':2,'example':'June 1, 2021'}}
+
+def test_symbols():
+    symbols = {'globalVars.Trace.TA.minMax':[-40,50],'Metadata.SiteID':'BB'}
+    # The stored object is returned (so it is dumped as an alias)
+    assert evaluate('globalVars.Trace.TA.minMax',symbols=symbols) is symbols['globalVars.Trace.TA.minMax']
+    assert evaluate('[globalVars.Trace.TA.minMax 1]',symbols=symbols)[0] is symbols['globalVars.Trace.TA.minMax']
+    # Includes keep placeholders instead
+    assert evaluate('globalVars.Trace.TA.minMax',include=True) == '$globalVars.Trace.TA.minMax$'
+    with pytest.raises(undefinedReference) as e:
+        evaluate('globalVars.missing',symbols=symbols)
+    assert e.value.name == 'globalVars.missing'
+
+@pytest.mark.parametrize('text',["'a' + 1",'[1 2','foo(1)','1 2','x > 1','1:'])
+def test_errors(text):
+    with pytest.raises(matlabValueError):
+        evaluate(text)
+
+def test_tokenize_whitespace_flag():
+    tokens = matlabValue.tokenize('[1 -2]')
+    assert [(t[1],t[3]) for t in tokens] == [('[',False),('1',False),('-',True),('2',False),(']',False)]
@@ -0,0 +1,234 @@
+import os
+import pytest
+import warnings
+from ruamel.yaml import YAML
+from ruamel.yaml.error import ReusedAnchorWarning
+
+import ini2yaml
+import matlabValue
+
+site_ini = '''
+Site_name = 'Burns Bog'
+SiteID = 'BB'
+Difference_GMT_to_local_time = 8 % hours
+globalVars.Trace.TA_1_1_1.minMax = [-40 50]
+globalVars.other.x = 5
+
+[Trace]
+    variableName = 'TA_1_1_1'
+    title = 'Air temperature'
+    units = 'degC'
+    minMax = globalVars.Trace.TA_1_1_1.minMax
+    customFloat = 2.5
+    customInt = 60*24
+[End]
+'''
+
+def convert(root,SiteID='BB',stage='firststage',**kwargs):
+    i2y = ini2yaml.parser(root=root,SiteID=SiteID,stage=stage,fields_on_the_fly=True,verbose=False,**kwargs)
+    with open(i2y.outpath,encoding='utf-8') as f:
+        text = f.read()
+    return(i2y,text,YAML(typ='safe').load(text))
+
+def test_float_fields_are_written(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini})
+    _,_,out = convert(root)
+    assert out['Trace']['TA_1_1_1']['customFloat'] == 2.5
+    assert out['Trace']['TA_1_1_1']['customInt'] == 1440
+
+def test_global_references_are_aliases(ini_tree):
+    # Metadata and globalVars are parsed before traces, so references resolve to yaml aliases
+    root = ini_tree({'BB/BB_firststage.ini':site_ini})
+    _,text,out = convert(root)
+    assert 'minMax: &globalVars__Trace__TA_1_1_1__minMax' in text
+    assert 'minMax: *globalVars__Trace__TA_1_1_1__minMax' in text
+    assert out['Trace']['TA_1_1_1']['minMax'] == [-40,50]
+    assert out['Metadata']['Diff_GMT_to_local_time'] == 8
+
+def test_value_errors_report_file_and_line(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini.replace('customInt = 60*24','customInt = globalVars.missing')})
+    with pytest.raises(matlabValue.matlabValueError) as e:
+        convert(root)
+    message = str(e.value)
+    assert 'BB_firststage.ini, line 7' in message
+    assert 'customInt = globalVars.missing' in message
+
+def test_parses_do_not_share_fields(ini_tree):
+    root = ini_tree({
+        'BB/BB_firststage.ini':"[Trace]\n    variableName = 'A'\n    extra = 5\n[End]\n",
+        'BB2/BB2_firststage.ini':"[Trace]\n    variableName = 'B'\n    extra = [1 2]\n[End]\n[Trace]\n    variableName = 'C'\n[End]\n",
+    })
+    fields = dict(ini2yaml.Trace.__dataclass_fields__)
+    _,_,bb = convert(root,'BB')
+    _,_,bb2 = convert(root,'BB2')
+    # Class level fields are never modified
+    assert ini2yaml.Trace.__dataclass_fields__ == fields
+    assert bb['Trace']['A']['extra'] == 5
+    # Type inferred for extra in BB does not leak into BB2
+    assert bb2['Trace']['B']['extra'] == [1,2]
+    # On the fly fields are only written for traces which provide them
+    assert 'extra' not in bb2['Trace']['C']
+
+def test_stage_visibility(ini_tree):
+    trace = "[Trace]\n    variableName = 'A'\n    Evaluate = 'A = B;'\n    dependent = {'B'}\n[End]\n"
+    root = ini_tree({'BB/BB_firststage.ini':trace,'BB/BB_secondstage.ini':trace})
+    _,_,first = convert(root,'BB','firststage')
+    _,_,second = convert(root,'BB','secondstage')
+    assert list(first['Trace']['A']) == ['variableName','title','units','inputFileName','instrumentType',
+                                          'measurementType','minMax','zeroPt','Evaluate','Overwrite','dependent']
+    assert list(second['Trace']['A']) == ['variableName','title','units','Evaluate','dependent']
+
+def test_schema_is_built_once_per_stage():
+    schema = ini2yaml.traceSchema.for_stage('secondstage')
+    assert ini2yaml.traceSchema.for_stage('secondstage') is schema
+    assert schema.shown == {'variableName','title','units','Evaluate'}
+    assert schema.literal['Evaluate'] is True
+    # Parses extend a copy
+    copy = schema.copy()
+    copy.add_field('extra',int)
+    assert 'extra' in copy.types and 'extra' not in schema.types
+
+def test_records_only_store_provided_values():
+    schema = ini2yaml.traceSchema.for_stage('firststage').copy()
+    a = ini2yaml.traceRecord(schema)
+    a.add_item(key='variableName',text="'A'")
+    b = ini2yaml.traceRecord(schema)
+    assert list(a.values) == ['variableName']
+    # Defaults are not shared between traces
+    a.asdict()['zeroPt'].append(0)
+    assert b.asdict()['zeroPt'] == [-9999]
+    assert not hasattr(a,'__dict__')
+
+def test_stream_matches_default(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini+"#include inc.ini\n",
+                     'BB2/BB2_firststage.ini':"SiteID = 'BB2'\n",
+                     'inc.ini':"[Trace]\n    variableName = 'B'\n[End]\n"})
+    for SiteID in ['BB','BB2']:
+        _,text,_ = convert(root,SiteID)
+        i2y,streamed,_ = convert(root,SiteID,stream=True)
+        assert streamed == text
+        # Traces are written as they are parsed, not kept
+        assert i2y.config.Trace == {}
+
+def test_stream_error_leaves_no_file(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini.replace('customInt = 60*24','customInt = globalVars.missing')})
+    with pytest.raises(matlabValue.matlabValueError):
+        convert(root,stream=True)
+    assert os.listdir(os.path.join(root,'BB')) == ['BB_firststage.ini']
+
+def test_dedup(ini_tree):
+    evaluate = "'A = B + C + D + E;\n                A = A * 2;'"
+    trace = "[Trace]\n    variableName = '{0}'\n    Evaluate = {1}\n    dependent = {{'B','C','D','E'}}\n    minMax = [0 10]\n[End]\n"
+    root = ini_tree({'BB/BB_secondstage.ini':trace.format('A',evaluate)+trace.format('X',evaluate)+trace.format('Y',"'Y = 1;'")})
+    _,text,out = convert(root,stage='secondstage')
+    i2y,deduped,out_deduped = convert(root,stage='secondstage',dedup=True)
+    assert out_deduped == out
+    assert 'Evaluate: &Trace__A__Evaluate |-' in deduped
+    assert 'Evaluate: *Trace__A__Evaluate' in deduped
+    assert 'dependent: *Trace__A__dependent' in deduped
+    # Short values are left as they are
+    assert '*Trace__A__minMax' not in deduped
+    assert i2y.config.Trace['X']['Evaluate'] is i2y.config.Trace['A']['Evaluate']
+    # Deterministic
+    assert convert(root,stage='secondstage',dedup=True)[1] == deduped
+    with pytest.raises(ValueError):
+        convert(root,stage='secondstage',dedup=True,stream=True)
+
+def test_dedup_anchors_are_unique(ini_tree):
+    evaluate = "'A = B + C + D + E;'"
+    trace = "[Trace]\n    variableName = '{0}'\n    Evaluate = {1}\n[End]\n"
+    traces = trace.format('A',evaluate)+trace.format('X',evaluate)
+    # inc.yml holds its own traces and, under Include, those of sub/inc2.ini
+    site = "#include inc.ini\n"+traces
+    root = ini_tree({'BB/BB_firststage.ini':site,'BB/BB_secondstage.ini':site,'inc.ini':"#include sub/inc2.ini\n"+traces,'sub/inc2.ini':traces})
+    def read_inc():
+        with open(os.path.join(root,'inc.yml'),encoding='utf-8') as f:
+            return(f.read())
+    convert(root,stage='secondstage')
+    out = YAML(typ='safe').load(read_inc())
+    cache = ini2yaml.includeCache()
+    convert(root,dedup=True,cache=cache)
+    # Parses of the include for other stages reuse its values, which are anchored as copies
+    _,deduped,_ = convert(root,stage='secondstage',dedup=True,cache=cache)
+    inc = read_inc()
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always',ReusedAnchorWarning)
+        YAML().load(inc)
+    assert [w for w in caught if issubclass(w.category,ReusedAnchorWarning)] == []
+    assert YAML(typ='safe').load(inc) == out
+    # Anchors are named by where the traces are written in the files including them
+    assert deduped.count('&Trace__A__Evaluate ') == 1
+    for anchor in ['Include__inc__A__Evaluate','Include__sub_inc2__A__Evaluate']:
+        assert inc.count(f'&{anchor} ') == 1 and inc.count(f'*{anchor}\n') == 1
+
+def test_fail_soft(ini_tree):
+    bad = site_ini.replace('customInt = 60*24','customInt = globalVars.missing\n    units2 = [1 2')
+    bad = bad.replace('globalVars.other.x = 5','globalVars.other.x = [5')
+    bad += "Timezone = [1\n#include missing.ini\n#include inc.ini\n[Trace]\n    variableName = {1 2}\n[End]\n"
+    root = ini_tree({'BB/BB_firststage.ini':bad,'inc.ini':"[Trace]\n    variableName = 'B'\n    x = [1\n[End]\n"})
+    with pytest.raises(matlabValue.matlabValueError):
+        convert(root)
+    i2y,_,out = convert(root,fail_soft=True)
+    # Everything else is converted
+    assert list(out['Trace']) == ['TA_1_1_1']
+    assert out['Trace']['TA_1_1_1']['customFloat'] == 2.5
+    assert 'customInt' not in out['Trace']['TA_1_1_1']
+    assert out['globalVars'] == {'Trace':{'TA_1_1_1':{'minMax':[-40,50]}}}
+    assert out['Include'] == ['inc']
+    assert 'Timezone' not in out['Metadata']
+    found = [(os.path.basename(d['fname']),d['line'],d['trace'],d['key'],d['action']) for d in i2y.diagnostics]
+    assert found == [
+        ('BB_firststage.ini',16,None,'Timezone','skipped metadata'),
+        ('BB_firststage.ini',5,None,'globalVars.other.x','skipped global'),
+        ('BB_firststage.ini',13,'TA_1_1_1','customInt','skipped value'),
+        ('BB_firststage.ini',14,'TA_1_1_1','units2','skipped value'),
+        ('BB_firststage.ini',20,'{1 2}','variableName','skipped trace'),
+        ('BB_firststage.ini',17,None,'missing.ini','skipped include'),
+        ('inc.ini',3,'B','x','skipped value'),
+    ]
+    assert i2y.diagnostics[2]['text'] == 'globalVars.missing'
+    assert 'missing' in i2y.diagnostics[2]['reason']
+
+def test_fail_soft_unwritable_trace(ini_tree,monkeypatch):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini+"[Trace]\n    variableName = 'RH'\n    customList = [1 2]\n[End]\n"})
+    evaluate = matlabValue.evaluate
+    monkeypatch.setattr(matlabValue,'evaluate',lambda text,**kwargs:object() if text == '[1 2]' else evaluate(text,**kwargs))
+    with pytest.raises(Exception):
+        convert(root)
+    assert not os.path.isfile(os.path.join(root,'BB','BB_firststage.yml'))
+    i2y,_,out = convert(root,fail_soft=True)
+    assert list(out['Trace']) == ['TA_1_1_1']
+    assert [(d['trace'],d['line'],d['action']) for d in i2y.diagnostics] == [('RH',15,'skipped trace')]
+
+def test_symbols_resolve_in_dependency_order(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':"globalVars.Trace.TA.zeroPt = globalVars.Trace.TA.minMax\n"+site_ini.replace(
+        'globalVars.other.x = 5','globalVars.other.x = globalVars.Trace.TA_1_1_1.minMax\nglobalVars.Trace.TA.minMax = [1 2]')})
+    i2y,text,out = convert(root)
+    assert out['globalVars']['Trace']['TA'] == {'zeroPt':[1,2],'minMax':[1,2]}
+    assert i2y.symbols['globalVars.Trace.TA.zeroPt'] is i2y.symbols['globalVars.Trace.TA.minMax']
+    assert i2y.symbols.tree['globalVars']['other']['x'] is i2y.config.Trace['TA_1_1_1']['minMax']
+    # Written in file order, anchored at the first occurrence
+    assert list(out['globalVars']['Trace']) == ['TA','TA_1_1_1']
+    assert 'zeroPt: &' in text and 'minMax: *' in text
+
+def test_symbol_errors(ini_tree):
+    cycle = "globalVars.a = globalVars.b\nglobalVars.b = [1 globalVars.c]\nglobalVars.c = globalVars.a\nglobalVars.d = globalVars.c\n"
+    root = ini_tree({'BB/BB_firststage.ini':cycle})
+    with pytest.raises(ini2yaml.circularReference) as e:
+        convert(root)
+    assert str(e.value) == (os.path.join(root,'BB','BB_firststage.ini')+
+                            ', line 1: Circular reference: globalVars.a -> globalVars.b -> globalVars.c -> globalVars.a')
+    i2y,_,out = convert(root,fail_soft=True)
+    assert out['globalVars'] == {}
+    assert [(d['key'],d['reason'].split(':')[0]) for d in i2y.diagnostics] == [
+        ('globalVars.a','circularReference'),('globalVars.b','circularReference'),
+        ('globalVars.c','circularReference'),('globalVars.d','matlabValueError')]
+    # Undefined names list what the group they are looked up in defines
+    root = ini_tree({'BB/BB_firststage.ini':site_ini.replace('customInt = 60*24','customInt = globalVars.Trace.TA_1_1_1.minmax')})
+    with pytest.raises(matlabValue.undefinedReference,match=r'minmax \(globalVars.Trace.TA_1_1_1 defines minMax\)'):
+        convert(root)
+    # A name can't be a value and a group
+    root = ini_tree({'BB/BB_firststage.ini':"globalVars.a = 1\nglobalVars.a.b = 2\nglobalVars.c = 3\n"})
+    with pytest.raises(matlabValue.matlabValueError,match='line 2: Can not define globalVars.a.b, globalVars.a is a value'):
+        convert(root)
+    assert convert(root,fail_soft=True)[2]['globalVars'] == {'a':1,'c':3}
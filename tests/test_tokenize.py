@@ -0,0 +1,39 @@
+
+import ini2yaml
+
+ini = (
+    "Site_name = 'Burns Bog'\n"
+    "globalVars.other.x = 5\n"
+    "  globalVars.indented = 1\n"
+    "#include Common.ini\n"
+    "% a comment\n"
+    "\n"
+    "[Trace]\n"
+    "    variableName = 'TA'\n"
+    "[End]\n"
+    "; another comment\n"
+    "[Trace]\n"
+    "    variableName = 'PA'\n"
+    "[End] trailing = 1"
+)
+
+def test_kinds_in_order():
+    tokens = list(ini2yaml.tokenize_ini(ini))
+    assert [t.kind for t in tokens] == ['metadata','globalVars','other','include','comment','trace','comment','trace','metadata']
+
+def test_offsets_and_lines():
+    tokens = list(ini2yaml.tokenize_ini(ini))
+    for t in tokens:
+        if t.kind == 'trace':
+            assert ini[t.start:t.end] == f'[Trace]{t.text}[End]'
+        else:
+            assert ini[t.start:t.end] == t.text
+        # Line numbers are 1-based and match the offset
+        assert t.line == ini.count('\n',0,t.start)+1
+    traces = [t for t in tokens if t.kind == 'trace']
+    assert [t.line for t in traces] == [7,11]
+    assert "variableName = 'PA'" in traces[1].text
+
+def test_no_traces():
+    tokens = list(ini2yaml.tokenize_ini("SiteID = 'BB'"))
+    assert [(t.kind,t.start,t.end,t.line) for t in tokens] == [('metadata',0,13,1)]
@@ -0,0 +1,74 @@
+import os
+
+import ini2yaml
+import traceIndex
+
+site_ini = '''
+SiteID = 'BB'
+globalVars.Trace.TA_1_1_1.minMax = [-40 50]
+#include inc.ini
+
+[Trace]
+    variableName = 'TA_1_1_1'
+    title = 'Air temperature'
+    minMax = globalVars.Trace.TA_1_1_1.minMax
+    Evaluate = 'TA_1_1_1 = TA;
+                TA_1_1_1 = TA_1_1_1+1;'
+[End]
+[Trace]
+    % variableName = 'commented'
+    variableName = 'RH_1_1_1'
+    minMax = [0 100]
+[End]
+'''
+
+inc_ini = '''
+[Trace]
+    variableName = 'TA_1_1_1'
+    units = 'degC'
+[End]
+'''
+
+def index_of(root,**kwargs):
+    return(traceIndex.traceIndex(root=root,**kwargs))
+
+def test_traces_match_parser(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+    i2y = ini2yaml.parser(root=root,SiteID='BB',stage='firststage',fields_on_the_fly=True,verbose=False)
+    index = index_of(root,SiteID='BB',stage='firststage')
+    assert index.names() == ['TA_1_1_1','RH_1_1_1']
+    assert index.includes() == ['inc.ini']
+    assert index.line('RH_1_1_1') == 12
+    assert index.fields('TA_1_1_1')['minMax'] == 'globalVars.Trace.TA_1_1_1.minMax'
+    assert index.traces() == i2y.config.Trace
+    include = index_of(root,include='inc.ini',stage='firststage')
+    inc = ini2yaml.parser(root=root,include='inc.ini',stage='firststage',fields_on_the_fly=True,verbose=False)
+    assert include.traces() == inc.config.Trace
+
+def test_index_is_saved_and_invalidated(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini})
+    fname = os.path.join(root,'BB','BB_firststage.ini')
+    index_of(root,SiteID='BB',stage='firststage')
+    assert os.path.isfile(os.path.join(root,'BB','.BB_firststage.ini.index.json'))
+    # Touched but unchanged, the saved index is kept
+    os.utime(fname,ns=(0,0))
+    assert index_of(root,SiteID='BB',stage='firststage').names() == ['TA_1_1_1','RH_1_1_1']
+    with open(fname,'a') as f:
+        f.write("[Trace]\n    variableName = 'PA_1_1_1'\n[End]\n")
+    index = index_of(root,SiteID='BB',stage='firststage')
+    assert 'PA_1_1_1' in index and len(index) == 3
+
+def test_empty_file(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':''})
+    index = index_of(root,SiteID='BB',stage='firststage',persist=False)
+    assert index.names() == []
+    assert not os.path.isfile(os.path.join(root,'BB','.BB_firststage.ini.index.json'))
+
+def test_search_follows_includes(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'BB/BB_secondstage.ini':site_ini,
+                     'BB2/BB2_firststage.ini':"#include inc.ini\n",'inc.ini':inc_ini})
+    hits = traceIndex.search(root,'TA_1_1_1',stageList=['firststage'],field='units')
+    assert [(h['SiteID'],h['fname'],h['value']) for h in hits] == [
+        ('BB',os.path.join('BB','BB_firststage.ini'),None),('BB','inc.ini',"'degC'"),('BB2','inc.ini',"'degC'")]
+    hits = traceIndex.search(root,'TA_1_1_1',siteList=['BB'],stageList=['secondstage'],field='Evaluate',parse=True)
+    assert hits[0]['value'].split('\n')[0] == 'TA_1_1_1 = TA;'
@@ -0,0 +1,88 @@
+import os
+
+import ini2yaml
+import verify
+
+site_ini = '''
+SiteID = 'BB'
+globalVars.Trace.TA_1_1_1.minMax = [-40 50]
+#include inc.ini
+
+[Trace]
+    variableName = 'TA_1_1_1'
+    units = 'degC'
+    minMax = globalVars.Trace.TA_1_1_1.minMax
+[End]
+[Trace]
+    variableName = 'RH_1_1_1'
+    minMax = [0 100]
+[End]
+'''
+
+inc_ini = "[Trace]\n    variableName = 'B'\n[End]\n"
+
+def convert(root,**kwargs):
+    return(ini2yaml.parser(root=root,SiteID='BB',stage='firststage',fields_on_the_fly=True,verbose=False,**kwargs).outpath)
+
+def found(summary):
+    return([(d['section'],d['name'],d['key'],d['change']) for d in summary['differences']])
+
+def test_same_content_is_identical(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+    yml = convert(root)
+    # Anchors, key order and formats don't matter
+    assert verify.verify_files(yml,convert(root,output='json'))['status'] == 'identical'
+    assert verify.verify_files(yml,convert(root,dedup=True))['status'] == 'identical'
+    assert os.path.isfile(verify.digest_path(yml))
+
+def test_differences(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+    a = convert(root,output='json')
+    changed = (site_ini.replace("units = 'degC'","units = 'K'").replace('[-40 50]','[-40 60]').replace("SiteID = 'BB'","SiteID = 'BB'\nSite_name = 'x'")
+               +"[Trace]\n    variableName = 'NEW'\n[End]\n").replace("    variableName = 'RH_1_1_1'\n    minMax = [0 100]\n","    variableName = 'RH'\n")
+    ini_tree({'BB/BB_firststage.ini':changed})
+    summary = verify.verify_files(a,convert(root),values=True)
+    assert summary['status'] == 'different'
+    assert found(summary) == [
+        ('Metadata','Site_name',None,'added'),
+        ('globalVars','Trace.TA_1_1_1.minMax',None,'changed'),
+        ('Trace','TA_1_1_1','units','changed'),
+        ('Trace','TA_1_1_1','minMax','changed'),
+        ('Trace','RH_1_1_1',None,'removed'),
+        ('Trace','RH',None,'added'),
+        ('Trace','NEW',None,'added'),
+    ]
+    assert (summary['differences'][2]['a'],summary['differences'][2]['b']) == ('degC','K')
+
+def test_ini_against_its_output(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+    yml = convert(root)
+    files = sorted(os.listdir(root))
+    assert verify.verify_ini(root,'BB','firststage')['status'] == 'identical'
+    ini_tree({'BB/BB_firststage.ini':site_ini.replace("units = 'degC'","units = 'K'"),'inc.ini':"[Trace]\n    variableName = 'C'\n[End]\n"})
+    assert found(verify.verify_ini(root,'BB','firststage')) == [('Trace','TA_1_1_1','units','changed')]
+    # Nothing is written, but the digest of the output
+    assert sorted(os.listdir(root)) == files
+    assert 'degC' in open(yml).read() and os.path.isfile(os.path.join(root,'inc.yml'))
+    assert verify.verify_ini(root,'BB2','firststage')['status'] == 'removed'
+
+def test_digests_are_invalidated_by_content(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site_ini,'inc.ini':inc_ini})
+    yml = convert(root)
+    d = verify.file_digest(yml)
+    assert verify.file_digest(yml) == d
+    with open(yml) as f:
+        text = f.read()
+    with open(yml,'w') as f:
+        f.write(text.replace('degC','K'))
+    assert verify.file_digest(yml)['traces']['TA_1_1_1'] != d['traces']['TA_1_1_1']
+
+def test_trees(ini_tree):
+    tree = ini_tree({'a/BB/BB_firststage.ini':site_ini,'a/inc.ini':inc_ini,
+                     'b/BB/BB_firststage.ini':site_ini.replace("units = 'degC'","units = 'K'"),'b/inc.ini':inc_ini})
+    a,b = os.path.join(tree,'a'),os.path.join(tree,'b')
+    convert(a)
+    convert(b)
+    os.remove(os.path.join(b,'inc.yml'))
+    summaries = {os.path.relpath(s['a'],a):s for s in verify.verify_trees(a,b,workers=2)}
+    assert {rel:s['status'] for rel,s in summaries.items()} == {os.path.join('BB','BB_firststage.yml'):'different','inc.yml':'removed'}
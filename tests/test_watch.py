@@ -0,0 +1,64 @@
+import os
+import time
+import watch
+
+site = "SiteID = '{0}'\n#include common.ini\n[Trace]\n    variableName = 'TA'\n    units = '{1}'\n[End]\n"
+common = "[Trace]\n    variableName = 'RH'\n    units = '{0}'\n[End]\n"
+
+def converted(w):
+    return(sorted((s['SiteID'],s['stage'],s['status']) for s in w.poll()))
+
+def read(root,rel):
+    with open(os.path.join(root,rel)) as f:
+        return(f.read())
+
+def test_only_changed_files_are_converted(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site.format('BB','C'),'BB/BB_secondstage.ini':site.format('BB','C'),
+                     'BB2/BB2_firststage.ini':"SiteID = 'BB2'\n",'common.ini':common.format('%')})
+    w = watch.watcher(root=root)
+    assert converted(w) == [('BB','firststage','ok'),('BB','secondstage','ok'),('BB2','firststage','ok')]
+    assert converted(w) == []
+    # A site file, the secondstage file is converted again since firststage rewrote their shared common.yml
+    ini_tree({'BB/BB_firststage.ini':site.format('BB','degC')})
+    assert converted(w) == [('BB','firststage','ok'),('BB','secondstage','ok')]
+    assert 'degC' in read(root,'BB/BB_firststage.yml')
+    # An include, every file using it is converted
+    ini_tree({'common.ini':common.format('percent')})
+    assert converted(w) == [('BB','firststage','ok'),('BB','secondstage','ok')]
+    assert 'percent' in read(root,'common.yml')
+    # A new site, and a touched file whose content is the same
+    ini_tree({'BB3/BB3_firststage.ini':"SiteID = 'BB3'\n"})
+    os.utime(os.path.join(root,'BB2','BB2_firststage.ini'))
+    assert converted(w) == [('BB3','firststage','ok')]
+    # A deleted output
+    os.remove(os.path.join(root,'BB2','BB2_firststage.yml'))
+    assert converted(w) == [('BB2','firststage','ok')]
+
+def test_shared_include_across_stages(ini_tree):
+    root = ini_tree({**{f'{SiteID}/{SiteID}_{stage}.ini':site.format(SiteID,'C') for SiteID in ['BB','BB2'] for stage in ['firststage','secondstage']},
+                     'common.ini':common.format('%')})
+    w = watch.watcher(root=root)
+    w.poll()
+    full = read(root,'common.yml')
+    # firststage rewrites common.yml after it was checked for BB, the secondstage files sharing it are converted again
+    ini_tree({'BB2/BB2_firststage.ini':site.format('BB2','degC')})
+    assert converted(w) == [('BB','secondstage','ok'),('BB2','firststage','ok')]
+    assert read(root,'common.yml') == full
+    assert converted(w) == []
+    assert watch.watcher(root=root).poll() == []
+
+def test_errors_are_retried_once_edited(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':"[Trace]\n    variableName = 'TA'\n    minMax = [1 2\n[End]\n"})
+    w = watch.watcher(root=root)
+    assert converted(w) == [('BB','firststage','error')]
+    assert converted(w) == []
+    ini_tree({'BB/BB_firststage.ini':"[Trace]\n    variableName = 'TA'\n    minMax = [1 2]\n[End]\n"})
+    assert converted(w) == [('BB','firststage','ok')]
+
+def test_run(ini_tree):
+    root = ini_tree({'BB/BB_firststage.ini':site.format('BB','C'),'common.ini':common.format('%')})
+    polls = []
+    T1 = time.perf_counter()
+    watch.watcher(root=root,interval=0.01).run(polls=3,callback=polls.append)
+    assert time.perf_counter()-T1 < 1
+    assert [[s['SiteID'] for s in p] for p in polls] == [['BB']]
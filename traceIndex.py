@@ -0,0 +1,234 @@
+import os
+import re
+import json
+import mmap
+import hashlib
+import argparse
+from dataclasses import dataclass
+import ini2yaml
+import batch
+
+# Read-only, indexed access to the traces of ini files without converting them
+# A file is scanned once (memory-mapped where possible) for the byte range of each [Trace]...[End] block, by variableName
+# The index is saved next to the file (.{name}.ini.index.json) and reused until the file changes
+# e.g., traceIndex(root=root,SiteID='BB',stage='secondstage').fields('TA_1_1_1')['Evaluate']
+# or search(root,'TA_1_1_1',field='Evaluate') across a whole TraceAnalysis_ini tree
+
+index_version = 1
+
+trace_pattern = re.compile(rb"\[Trace\](.*?)\[End\]",flags=re.DOTALL)
+name_pattern = re.compile(rb"^[ \t]*variableName[ \t]*=[ \t]*(['\"])(.*?)\1",flags=re.MULTILINE)
+include_pattern = re.compile(rb"^#include(.*)$",flags=re.MULTILINE)
+
+def index_path(fname):
+    head,tail = os.path.split(fname)
+    return(os.path.join(head,f'.{tail}.index.json'))
+
+def signature(fname):
+    st = os.stat(fname)
+    return([st.st_mtime_ns,st.st_size])
+
+def content_hash(fname):
+    with open(fname,'rb') as f:
+        return(hashlib.sha1(f.read()).hexdigest())
+
+def scan(fname):
+    # Build the index of one file
+    with open(fname,'rb') as f:
+        try:
+            buf = mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ)
+        except (ValueError,OSError):
+            # Empty files (and some file systems) can't be mapped
+            buf = f.read()
+        try:
+            return(scan_buffer(buf))
+        finally:
+            if type(buf) is mmap.mmap:
+                buf.close()
+
+def scan_buffer(buf):
+    # traces: variableName > [start,end,line] of the block body (bytes) and the line of its [Trace]
+    # context: [start,end,line] of the text between blocks (metadata, globalVars, #include, ...)
+    # A later block with the same variableName replaces the earlier one, as it does when converting
+    traces,context,includes = {},[],[]
+    pos,line = 0,1
+    def add_context(start,stop,line):
+        context.append([start,stop,line])
+        for m in include_pattern.finditer(buf,start,stop):
+            includes.append(m.group(1).decode('utf-8').strip())
+    for m in trace_pattern.finditer(buf):
+        add_context(pos,m.start(),line)
+        line += buf[pos:m.start()].count(b'\n')
+        name = name_pattern.search(buf,m.start(1),m.end(1))
+        if name is not None and name.group(2):
+            traces[name.group(2).decode('utf-8')] = [m.start(1),m.end(1),line]
+        line += buf[m.start():m.end()].count(b'\n')
+        pos = m.end()
+    add_context(pos,len(buf),line)
+    return({'version':index_version,'hash':hashlib.sha1(buf).hexdigest(),
+            'traces':traces,'context':context,'includes':includes})
+
+@dataclass(kw_only=True)
+class traceQuery(ini2yaml.parser):
+    # A parser which only parses the metadata and globalVars of a file, from the tokens given
+    # Traces are then parsed on demand with parse_trace
+    context: list = None
+
+    def convert(self):
+        self.tokens = self.context
+        self.shared_traces = None
+        self.parse_metadata()
+        self.parse_globals()
+
+@dataclass(kw_only=True)
+class traceIndex:
+    # Index of a site file (SiteID and stage) or of an include (include relative to root, as in parser)
+    root: str
+    SiteID: str = None
+    stage: str = None
+    include: str = None
+    verbose: bool = False
+    persist: bool = True # Save the index next to the file
+    rebuild: bool = False # Ignore a saved index
+
+    def __post_init__(self):
+        if self.SiteID is not None:
+            self.fname = os.path.join(self.root,self.SiteID,f'{self.SiteID}_{self.stage}.ini')
+        else:
+            self.fname = os.path.join(self.root,self.include)
+        self.path = index_path(self.fname)
+        # Parsed metadata and globalVars, only when a trace is first parsed
+        self.query = None
+        self.index = None if self.rebuild else self.load()
+        if self.index is None:
+            if self.verbose: print('indexing ',self.fname)
+            self.index = scan(self.fname)
+            self.index['signature'] = signature(self.fname)
+            self.save()
+
+    def load(self):
+        # The saved index, if it is still valid: mtime/size first, then the content hash for files which were touched
+        if not os.path.isfile(self.path):
+            return(None)
+        try:
+            with open(self.path) as f:
+                index = json.load(f)
+        except (OSError,ValueError):
+            return(None)
+        if index.get('version') != index_version:
+            return(None)
+        current = signature(self.fname)
+        if index['signature'] != current:
+            if content_hash(self.fname) != index['hash']:
+                return(None)
+            index['signature'] = current
+            self.index = index
+            self.save()
+        return(index)
+
+    def save(self):
+        if not self.persist:
+            return
+        tmppath = f'{self.path}.{os.getpid()}.tmp'
+        try:
+            with open(tmppath,'w') as f:
+                json.dump(self.index,f)
+            os.replace(tmppath,self.path)
+        except OSError:
+            # e.g., a read-only tree, the index is still used for this session
+            if self.verbose: print('Could not save index: ',self.path)
+
+    def names(self):
+        return(list(self.index['traces']))
+
+    def includes(self):
+        return(list(self.index['includes']))
+
+    def __contains__(self,variableName):
+        return(variableName in self.index['traces'])
+
+    def __len__(self):
+        return(len(self.index['traces']))
+
+    def read(self,start,end):
+        with open(self.fname,'rb') as f:
+            f.seek(start)
+            return(f.read(end-start).decode('utf-8'))
+
+    def line(self,variableName):
+        # Line of the [Trace] of a trace
+        return(self.index['traces'][variableName][2])
+
+    def text(self,variableName):
+        # Body of the [Trace]...[End] block of a trace
+        start,end,_ = self.index['traces'][variableName]
+        return(self.read(start,end))
+
+    def fields(self,variableName):
+        # Raw text of each field of a trace, nothing is evaluated
+        return(ini2yaml.trace_fields(self.text(variableName)))
+
+    def context_tokens(self):
+        tokens = []
+        for start,end,line in self.index['context']:
+            text = self.read(start,end)
+            tokens += ini2yaml.tokenize_lines(text,0,len(text),line)
+        return(tokens)
+
+    def trace(self,variableName):
+        # A trace parsed as parser would, i.e., the same dict as in the Trace (or Include) section of the .yml
+        if self.query is None:
+            self.query = traceQuery(root=self.root,SiteID=self.SiteID,stage=self.stage,include=self.include,
+                                    verbose=self.verbose,fields_on_the_fly=True,context=self.context_tokens())
+        start,end,line = self.index['traces'][variableName]
+        token = ini2yaml.iniToken(kind='trace',text=self.read(start,end),start=start,end=end,line=line)
+        return(self.query.parse_trace(token).asdict())
+
+    def traces(self,variableNames=None):
+        # Parse several (by default all) traces
+        if variableNames is None:
+            variableNames = self.names()
+        return({name:self.trace(name) for name in variableNames})
+
+def search(root,variableName,siteList=None,stageList=batch.stages,field=None,parse=False,persist=True):
+    # Find a trace in every site/stage (and the files they #include) under root
+    # Returns a list of {'SiteID','stage','fname','line','value'}, where value is the raw fields of the trace
+    # or the parsed trace if parse, or only the given field of either
+    # Each include is indexed once per stage, however many sites share it
+    hits,indexes = [],{}
+    def visit(SiteID,stage,include,seen):
+        key = (include,stage) if include is not None else (SiteID,stage)
+        if key in seen:
+            return
+        seen.add(key)
+        if key not in indexes:
+            if include is not None and not os.path.isfile(os.path.join(root,include)):
+                indexes[key] = None
+            else:
+                indexes[key] = traceIndex(root=root,SiteID=None if include else SiteID,stage=stage,include=include,persist=persist)
+        index = indexes[key]
+        if index is None:
+            return
+        if variableName in index:
+            value = index.trace(variableName) if parse else index.fields(variableName)
+            if field is not None:
+                value = value.get(field)
+            hits.append({'SiteID':SiteID,'stage':stage,'fname':os.path.relpath(index.fname,root),
+                         'line':index.line(variableName),'value':value})
+        for include in index.includes():
+            visit(SiteID,stage,include,seen)
+    for SiteID,stage in batch.discover(root,siteList=siteList,stageList=stageList):
+        visit(SiteID,stage,None,set())
+    return(hits)
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Find a trace in every site of a TraceAnalysis_ini folder without converting them')
+    args.add_argument('root',help='Path to the TraceAnalysis_ini folder')
+    args.add_argument('variableName')
+    args.add_argument('--field',default=None,help='Only show this field, e.g., Evaluate')
+    args.add_argument('--sites',nargs='*',default=None,help='SiteIDs to search (default: all sub-folders of root)')
+    args.add_argument('--stages',nargs='*',default=batch.stages)
+    args.add_argument('--parse',action='store_true',help='Parse the values (as when converting) instead of showing their text')
+    args = args.parse_args()
+    for hit in search(args.root,args.variableName,siteList=args.sites,stageList=args.stages,field=args.field,parse=args.parse):
+        print(f"{hit['SiteID']:>8} {hit['stage']:<12} {hit['fname']}, line {hit['line']}: {hit['value']}")
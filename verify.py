@@ -0,0 +1,238 @@
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+import ini2yaml
+import backends
+import batch
+
+# Compare generated outputs by content, e.g., the outputs of two converter versions, or an ini and its .yml
+# Each file is reduced to a digest: a hash of every Metadata value, globalVars value (by path, e.g., Trace.TA_1_1_1.minMax)
+# and trace key, computed on the loaded values so anchor names, aliases, key order and formatting don't matter
+# Traces whose hashes match are skipped, only the traces, keys and globalVars which differ are reported
+# Digests of output files are saved next to them (.{name}.digest.json) and reused until the file's content changes,
+# and identical files are never loaded at all
+# e.g., python verify.py old_TraceAnalysis_ini new_TraceAnalysis_ini, or python verify.py TraceAnalysis_ini --ini
+
+digest_version = 1
+
+def digest_path(path):
+    head,tail = os.path.split(path)
+    return(os.path.join(head,f'.{tail}.digest.json'))
+
+def content_hash(path):
+    with open(path,'rb') as f:
+        return(hashlib.sha1(f.read()).hexdigest())
+
+def value_hash(value):
+    # Dates (loaded from yaml) hash as the strings other formats hold
+    text = json.dumps(value,sort_keys=True,default=str,separators=(',',':'))
+    return(hashlib.blake2b(text.encode('utf-8'),digest_size=8).hexdigest())
+
+def flatten(data,prefix=''):
+    # globalVars as path > value
+    flat = {}
+    for k,v in (data or {}).items():
+        if type(v) is dict:
+            flat.update(flatten(v,f'{prefix}{k}.'))
+        else:
+            flat[f'{prefix}{k}'] = v
+    return(flat)
+
+def digest(data):
+    # Hashes of a loaded output (see backends.load)
+    traces = {name:{k:value_hash(v) for k,v in trace.items()} for name,trace in (data.get('Trace') or {}).items()}
+    return({
+        'version':digest_version,
+        'Metadata':{k:value_hash(v) for k,v in (data.get('Metadata') or {}).items()},
+        'globalVars':{k:value_hash(v) for k,v in flatten(data.get('globalVars')).items()},
+        'Trace':traces,
+        # One hash per trace so identical traces are skipped without comparing their keys
+        'traces':{name:value_hash(sorted(keys.items())) for name,keys in traces.items()},
+        'Include':value_hash(data.get('Include')),
+    })
+
+def file_digest(path,persist=True):
+    # Digest of an output file, from its saved digest if the file is unchanged
+    h = content_hash(path)
+    saved = digest_path(path)
+    if persist and os.path.isfile(saved):
+        try:
+            with open(saved) as f:
+                d = json.load(f)
+            if d.get('version') == digest_version and d.get('hash') == h:
+                return(d)
+        except (OSError,ValueError):
+            pass
+    d = digest(backends.load(path))
+    d['hash'] = h
+    if persist:
+        tmppath = f'{saved}.{os.getpid()}.tmp'
+        try:
+            with open(tmppath,'w') as f:
+                json.dump(d,f)
+            os.replace(tmppath,saved)
+        except OSError:
+            # e.g., a read-only tree
+            pass
+    return(d)
+
+def ini_data(root,SiteID,stage,output='yaml',fields_on_the_fly=True):
+    # Convert an ini in memory, nothing is written, returns the parser and the content its output would have
+    if batch.worker_cache is None:
+        batch.init_worker()
+    rel = os.path.join(SiteID,f'{SiteID}_{stage}.ini')
+    outpath = os.path.join(root,rel).replace('.ini',backends.extensions[output])
+    skip = ini2yaml.include_outputs(root,rel,output) | {os.path.realpath(outpath)}
+    i2y = ini2yaml.parser(root=root,SiteID=SiteID,stage=stage,fields_on_the_fly=fields_on_the_fly,verbose=False,
+                          cache=batch.worker_cache,output=output,skip_writes=skip)
+    return(i2y,backends.resolve(backends.plain(ini2yaml.translate_keys(i2y.config.__dict__))))
+
+def compare(a,b):
+    # Differences between two digests, [{'section','name','key','change'}], change is one of changed, added (only in b) or removed
+    differences = []
+    def keys(section,x,y,trace=None):
+        for k in dict.fromkeys(list(x)+list(y)):
+            if x.get(k) != y.get(k):
+                change = 'added' if k not in x else 'removed' if k not in y else 'changed'
+                if trace is None:
+                    differences.append({'section':section,'name':k,'key':None,'change':change})
+                else:
+                    differences.append({'section':section,'name':trace,'key':k,'change':change})
+    keys('Metadata',a['Metadata'],b['Metadata'])
+    keys('globalVars',a['globalVars'],b['globalVars'])
+    for name in dict.fromkeys(list(a['traces'])+list(b['traces'])):
+        if a['traces'].get(name) == b['traces'].get(name):
+            continue
+        if name not in a['traces'] or name not in b['traces']:
+            differences.append({'section':'Trace','name':name,'key':None,'change':'added' if name not in a['traces'] else 'removed'})
+        else:
+            keys('Trace',a['Trace'][name],b['Trace'][name],trace=name)
+    if a['Include'] != b['Include']:
+        differences.append({'section':'Include','name':None,'key':None,'change':'changed'})
+    return(differences)
+
+def lookup(data,difference):
+    # The value a difference is about, None if it isn't there
+    section = data.get(difference['section']) or {}
+    if difference['section'] == 'Include':
+        return(data.get('Include'))
+    elif difference['section'] == 'globalVars':
+        return(flatten(section).get(difference['name']))
+    value = section.get(difference['name'])
+    if difference['key'] is not None:
+        value = (value or {}).get(difference['key'])
+    return(value)
+
+def add_values(differences,a,b):
+    for d in differences:
+        d['a'],d['b'] = lookup(a,d),lookup(b,d)
+
+def new_summary(a,b):
+    return({'a':a,'b':b,'status':'identical','differences':[],'error':None,'seconds':0.0})
+
+def verify_files(a,b,values=False,persist=True):
+    # Compare two output files (of any format), return a summary rather than raising
+    summary = new_summary(a,b)
+    T1 = time.perf_counter()
+    try:
+        if not os.path.isfile(a) or not os.path.isfile(b):
+            summary['status'] = 'added' if not os.path.isfile(a) else 'removed'
+        elif backends.output_of(a) != backends.output_of(b) or content_hash(a) != content_hash(b):
+            summary['differences'] = compare(file_digest(a,persist),file_digest(b,persist))
+            if summary['differences'] and values:
+                add_values(summary['differences'],backends.load(a),backends.load(b))
+    except Exception as e:
+        summary['status'] = 'error'
+        summary['error'] = f'{type(e).__name__}: {e}'
+    if summary['differences']:
+        summary['status'] = 'different'
+    summary['seconds'] = time.perf_counter()-T1
+    return(summary)
+
+def verify_ini(root,SiteID,stage,output='yaml',values=False,persist=True,fields_on_the_fly=True):
+    # Compare an ini, converted in memory, to its output
+    rel = os.path.join(SiteID,f'{SiteID}_{stage}.ini')
+    outpath = os.path.join(root,rel).replace('.ini',backends.extensions[output])
+    summary = new_summary(os.path.join(root,rel),outpath)
+    T1 = time.perf_counter()
+    try:
+        if not os.path.isfile(outpath):
+            summary['status'] = 'removed'
+        else:
+            _,data = ini_data(root,SiteID,stage,output,fields_on_the_fly)
+            summary['differences'] = compare(digest(data),file_digest(outpath,persist))
+            if summary['differences'] and values:
+                add_values(summary['differences'],data,backends.load(outpath))
+    except Exception as e:
+        summary['status'] = 'error'
+        summary['error'] = f'{type(e).__name__}: {e}'
+    if summary['differences']:
+        summary['status'] = 'different'
+    summary['seconds'] = time.perf_counter()-T1
+    return(summary)
+
+def outputs_of(root,output='yaml'):
+    # Relative paths of the output files under root, saved digests and other hidden files are left out
+    extension = backends.extensions[output]
+    found = []
+    for folder,dirs,files in os.walk(root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+        found += [os.path.relpath(os.path.join(folder,f),root) for f in sorted(files) if f.endswith(extension) and not f.startswith('.')]
+    return(found)
+
+def verify_trees(a_root,b_root,output='yaml',workers=None,values=False,persist=True):
+    # Compare every output under a_root to the output with the same relative path under b_root, in parallel
+    rels = list(dict.fromkeys(outputs_of(a_root,output)+outputs_of(b_root,output)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(verify_files,os.path.join(a_root,rel),os.path.join(b_root,rel),values,persist) for rel in rels]
+        return([f.result() for f in futures])
+
+def verify_inis(root,siteList=None,stageList=batch.stages,output='yaml',workers=None,values=False,persist=True):
+    # Compare every ini under root to its output, in parallel
+    jobs = batch.discover(root,siteList=siteList,stageList=stageList)
+    with ProcessPoolExecutor(max_workers=workers,initializer=batch.init_worker) as pool:
+        futures = [pool.submit(verify_ini,root,SiteID,stage,output,values,persist) for SiteID,stage in jobs]
+        return([f.result() for f in futures])
+
+def show(summary,root=None):
+    name = os.path.relpath(summary['a'],root) if root is not None else summary['a']
+    if summary['status'] == 'error':
+        print(f"{name}: error {summary['error']}")
+    elif summary['status'] in ('added','removed'):
+        print(f"{name}: {summary['status']}")
+    for d in summary['differences']:
+        where = '.'.join(str(p) for p in [d['section'],d['name'],d['key']] if p is not None)
+        print(f"{name}: {where} {d['change']}"+(f": {d['a']!r} != {d['b']!r}" if 'a' in d else ''))
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Compare converted outputs by content, trace by trace')
+    args.add_argument('a',help='An output file, or a folder of outputs (e.g., a TraceAnalysis_ini folder)')
+    args.add_argument('b',nargs='?',default=None,help='The output file or folder to compare a to (not needed with --ini)')
+    args.add_argument('--ini',action='store_true',help='Compare every ini under a to its output, converting them in memory')
+    args.add_argument('--sites',nargs='*',default=None,help='SiteIDs to compare with --ini (default: all sub-folders)')
+    args.add_argument('--stages',nargs='*',default=batch.stages)
+    args.add_argument('--output',default='yaml',choices=list(backends.extensions),help='Output format of the files compared in folders')
+    args.add_argument('--workers',type=int,default=None)
+    args.add_argument('--values',action='store_true',help='Show the values which differ')
+    args.add_argument('--no-save',action='store_true',help="Don't save digests next to the outputs")
+    args = args.parse_args()
+    T1 = time.perf_counter()
+    root = args.a if os.path.isdir(args.a) else None
+    if args.ini:
+        summaries = verify_inis(args.a,siteList=args.sites,stageList=args.stages,output=args.output,workers=args.workers,
+                                values=args.values,persist=not args.no_save)
+    elif args.b is None:
+        sys.exit('b is needed, unless --ini')
+    elif root is not None:
+        summaries = verify_trees(args.a,args.b,output=args.output,workers=args.workers,values=args.values,persist=not args.no_save)
+    else:
+        summaries = [verify_files(args.a,args.b,values=args.values,persist=not args.no_save)]
+    for s in summaries:
+        show(s,root)
+    counts = {status:sum(s['status'] == status for s in summaries) for status in ['identical','different','added','removed','error']}
+    print(', '.join(f'{n} {status}' for status,n in counts.items())+f' in {time.perf_counter()-T1:.3f}s')
+    sys.exit(int(counts['identical'] < len(summaries)))
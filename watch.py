@@ -0,0 +1,107 @@
+import os
+import time
+import argparse
+from dataclasses import dataclass
+import backends
+import batch
+
+# Keep the outputs of a TraceAnalysis_ini folder up to date while its ini files are edited
+# Files are polled (mtime and size, then the content hash of files which were touched), nothing OS specific is needed
+# Only the site/stage files whose ini or (transitive) #include files changed are converted again
+# Conversions run in this process, so parsed includes (batch.worker_cache), the per-stage schemas
+# and the cleaned text and compiled patterns of ini2yaml stay warm from one edit to the next
+# The state is kept in the batch manifest (.ini2yaml_manifest.json), so batch.py --incremental and the watcher agree
+
+def signature(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return(None)
+    return((st.st_mtime_ns,st.st_size))
+
+@dataclass(kw_only=True)
+class watcher:
+    root: str
+    siteList: list = None # Default: every sub-folder of root, new sites are picked up
+    stageList: list = None # Default: batch.stages
+    interval: float = 0.5 # Seconds between polls
+    fields_on_the_fly: bool = True
+    verbose: bool = False
+    output: str = 'yaml'
+    fail_soft: bool = False # See parser.fail_soft
+
+    def __post_init__(self):
+        backends.check(self.output)
+        if self.stageList is None:
+            self.stageList = batch.stages
+        self.manifest = batch.conversionManifest(root=self.root)
+        # relative path > signature when its hash in the manifest was last checked
+        self.signatures = {}
+        # (SiteID,stage) > inputs of conversions which failed or had diagnostics (not recorded in the manifest)
+        # they are only converted again once their inputs change
+        self.unrecorded = {}
+
+    def refresh(self):
+        # Forget the hash of every file whose mtime or size changed, it is hashed again if needed
+        hashes = self.manifest.hashes
+        for rel in list(hashes):
+            current = signature(os.path.join(self.root,rel))
+            if self.signatures.get(rel) != current:
+                hashes.pop(rel)
+                self.signatures[rel] = current
+
+    def poll(self):
+        # Convert the site/stage files which are out of date, return their summaries (see batch.convert)
+        # Stages are converted in order, as in convert_batch, so shared include outputs end up the same
+        self.refresh()
+        summaries = []
+        for SiteID,stage in batch.discover(self.root,siteList=self.siteList,stageList=self.stageList):
+            inputs = self.manifest.inputs(SiteID,stage)
+            if self.unrecorded.get((SiteID,stage)) == inputs or self.manifest.is_current(SiteID,stage,inputs,self.output):
+                continue
+            summary = batch.convert(self.root,SiteID,stage,self.fields_on_the_fly,self.verbose,self.output,self.fail_soft)
+            # Outputs shared with the files still to be checked (e.g., an include .yml) may have been rewritten
+            self.manifest.forget_outputs()
+            if summary['status'] == 'ok' and not summary['diagnostics']:
+                self.manifest.record(SiteID,stage,inputs,summary['outpath'],summary['include_outputs'])
+                self.unrecorded.pop((SiteID,stage),None)
+            else:
+                self.unrecorded[(SiteID,stage)] = inputs
+            summaries.append(summary)
+        if self.manifest.recorded:
+            self.manifest.save()
+        return(summaries)
+
+    def run(self,polls=None,callback=None):
+        # Poll until interrupted (or polls times), callback(summaries) is called after each poll which converted anything
+        n = 0
+        while polls is None or n < polls:
+            T1 = time.perf_counter()
+            summaries = self.poll()
+            if summaries and callback is not None:
+                callback(summaries)
+            n += 1
+            if polls is None or n < polls:
+                time.sleep(max(0,self.interval-(time.perf_counter()-T1)))
+
+def show(summaries):
+    for s in summaries:
+        print(f"{time.strftime('%H:%M:%S')} {s['SiteID']:>8} {s['stage']:<12} {s['status']:<6} {s['seconds']:8.3f}s {s['error'] or ''}")
+        for d in s['diagnostics']:
+            print(f"{'':>8} {d['fname']}, line {d['line']}: {d['action']}: {d['reason']}")
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser(description='Convert the files of a TraceAnalysis_ini folder again whenever they (or their includes) change')
+    args.add_argument('root',help='Path to the TraceAnalysis_ini folder')
+    args.add_argument('--sites',nargs='*',default=None,help='SiteIDs to watch (default: all sub-folders of root)')
+    args.add_argument('--stages',nargs='*',default=batch.stages)
+    args.add_argument('--interval',type=float,default=0.5,help='Seconds between polls')
+    args.add_argument('--output',default='yaml',choices=list(backends.extensions),help='Output format')
+    args.add_argument('--fail-soft',action='store_true',help='Skip values, traces and includes which can not be parsed instead of failing the file')
+    args = args.parse_args()
+    w = watcher(root=args.root,siteList=args.sites,stageList=args.stages,interval=args.interval,output=args.output,fail_soft=args.fail_soft)
+    print(f'Watching {args.root}, stop with Ctrl+C')
+    try:
+        w.run(callback=show)
+    except KeyboardInterrupt:
+        pass